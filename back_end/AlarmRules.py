@@ -0,0 +1,326 @@
+"""
+File: AlarmRules.py
+Author: Hannah Murphy
+Date: 2024
+Description: Alarm rules evaluated on every frame as it is decoded. Rules on a signal
+    going above or below a limit, changing too quickly or setting a fault flag are
+    declared in default_rules() and compiled into a table by signal name, so a value
+    without rules costs one dictionary lookup. Only alarms being raised or cleared
+    are reported, to be pushed to the dashboards straight away.
+
+    python AlarmRules.py benchmarks the time taken per frame.
+
+Copyright (c) 2024 WESMO. All rights reserved.
+This code is part of the WESMO Data Acquisition and Visualisation Project.
+
+"""
+
+import time
+import datetime
+from abc import ABC, abstractmethod
+from collections import deque
+import metrics
+from database import numeric_value
+from BMSTranslatorClass import BMSTranslator
+
+""" GLOBAL VARIABLES
+A threshold given as SIGNAL_MAX is the max declared by the translator for the
+signal. Alarms are cleared once the value is back past the limit by HYSTERESIS
+of it, so a value sitting on the limit doesn't raise and clear on every frame.
+"""
+SIGNAL_MAX = "max"
+HYSTERESIS = 0.02
+WARNING = "warning"
+CRITICAL = "critical"
+
+alarms_raised = metrics.Counter(
+    "wesmo_alarms_raised_total",
+    "Alarms raised by the rules evaluated at ingestion.",
+    ("severity",),
+)
+
+
+class Rule(ABC):
+    """_summary_
+    A condition on one signal. check() is given each new value and returns the
+    conditions active after it, an empty tuple when there are none. A rule keeps
+    the state of one engine, each AlarmRules has rules of its own.
+    """
+
+    kind = ""
+
+    def __init__(self, signal, severity=WARNING):
+        self.signal = signal
+        self.severity = severity
+
+    @abstractmethod
+    def check(self, value, maximum, seconds, active):
+        """_summary_
+            Args:
+                value (float): The new value of the signal.
+                maximum (float): The max the translator declares for the signal.
+                seconds (function): Returns the time of the frame as epoch seconds.
+                active (tuple): The conditions active before this value.
+        """
+
+    @abstractmethod
+    def describe(self, condition, value, maximum):
+        """Returns a message for the dashboard about a condition being raised."""
+
+    def alarm_id(self, condition):
+        return f"{self.signal} {self.kind}" + (f" {condition}" if condition else "")
+
+    def reset(self):
+        """Forgets anything kept from earlier values."""
+
+
+class Threshold(Rule):
+    """Raised while the value is above (or below) a limit."""
+
+    def __init__(self, signal, above=None, below=None, **kwargs):
+        super().__init__(signal, **kwargs)
+        self.above = above
+        self.below = below
+        self.kind = "high" if above is not None else "low"
+
+    def limit(self, maximum):
+        # A limit given as SIGNAL_MAX follows the max declared with each value
+        limit = self.above if self.above is not None else self.below
+        return float(maximum) if limit == SIGNAL_MAX else limit
+
+    def check(self, value, maximum, seconds, active):
+        limit = self.limit(maximum)
+        if self.above is not None:
+            limit = limit - HYSTERESIS * abs(limit) if active else limit
+            return ("",) if value > limit else ()
+        limit = limit + HYSTERESIS * abs(limit) if active else limit
+        return ("",) if value < limit else ()
+
+    def describe(self, condition, value, maximum):
+        if self.above is not None:
+            return f"{self.signal} is {value:g}, above {self.limit(maximum):g}"
+        return f"{self.signal} is {value:g}, below {self.limit(maximum):g}"
+
+
+class RateOfChange(Rule):
+    """_summary_
+    Raised while the value changes faster than per_second, measured over the
+    last window seconds so a single noisy reading doesn't raise it. The points
+    are only trimmed by time, so the window is covered at any frame rate.
+    """
+
+    kind = "rate"
+
+    def __init__(self, signal, per_second, window=2.0, **kwargs):
+        super().__init__(signal, **kwargs)
+        self.per_second = per_second
+        self.window = window
+        self.points = deque()
+        self.rate = 0.0
+
+    def check(self, value, maximum, seconds, active):
+        now = seconds()
+        points = self.points
+        if points and now < points[-1][0]:
+            points.clear()
+        points.append((now, value))
+        while now - points[0][0] > self.window:
+            points.popleft()
+        span = now - points[0][0]
+        if span < self.window / 2:
+            return active
+        self.rate = (value - points[0][1]) / span
+        return ("",) if abs(self.rate) > self.per_second else ()
+
+    def describe(self, condition, value, maximum):
+        return f"{self.signal} is changing by {self.rate:+.2f} per second, limit {self.per_second:g}"
+
+    def reset(self):
+        self.points.clear()
+        self.rate = 0.0
+
+
+class Bitfield(Rule):
+    """Raised for each fault flag set in the value, as named by decode(value)."""
+
+    kind = "flag"
+
+    def __init__(self, signal, decode, ignore=(), **kwargs):
+        super().__init__(signal, **kwargs)
+        self.decode = decode
+        self.ignore = set(ignore)
+
+    def check(self, value, maximum, seconds, active):
+        if not value:
+            return ()
+        return tuple(flag for flag in self.decode(int(value)) if flag not in self.ignore)
+
+    def describe(self, condition, value, maximum):
+        return f"{self.signal} reports {condition}"
+
+
+""" ALARM RULES """
+
+
+def default_rules():
+    """Returns new rules to alarm on, built for each AlarmRules as they keep its state."""
+    return [
+        Threshold("Motor Temperature", above=SIGNAL_MAX, severity=CRITICAL),
+        RateOfChange("Motor Temperature", per_second=2.0),
+        Threshold("controller temp", above=SIGNAL_MAX, severity=CRITICAL),
+        Threshold("Battery Temperature", above=SIGNAL_MAX, severity=CRITICAL),
+        RateOfChange("Battery Temperature", per_second=1.0),
+        Threshold("Battery Current", above=SIGNAL_MAX),
+        Threshold("DC Link Circuit Voltage", above=SIGNAL_MAX, severity=CRITICAL),
+        Threshold("Battery State of Charge", below=10),
+        Bitfield(
+            "Battery Status",
+            BMSTranslator().index_failsafe_status,
+            ignore=["CELL_BALENCING", "RESERVED"],
+            severity=CRITICAL,
+        ),
+        Threshold("APPS Voltage fault", above=0, severity=CRITICAL),
+        Threshold("APPS Mismatch fault", above=0, severity=CRITICAL),
+        Threshold("Break Conflict", above=0),
+        Threshold("VCU Error Present", above=0, severity=CRITICAL),
+    ]
+
+
+class AlarmRules:
+    def __init__(self, rules=None):
+        """_summary_
+            Args:
+                rules (list): The rules to evaluate, any number per signal, by default
+                    those of default_rules(). They mustn't be shared with another AlarmRules.
+        """
+        if rules is None:
+            rules = default_rules()
+        self.table = {}
+        for rule in rules:
+            self.table.setdefault(rule.signal, []).append(rule)
+        self.table = {signal: tuple(signal_rules) for signal, signal_rules in self.table.items()}
+        # The conditions active per rule, and every active alarm by id
+        self.active = {}
+        self.alarms = {}
+
+    def evaluate(self, timestamp, values):
+        """_summary_
+        Checks the values of a frame against the rules of their signals.
+            Args:
+                timestamp (str): Time of the frame, 'YYYY-MM-DD HH:MM:SS.ffffff'.
+                values (list): The {name, value, unit, max} of the frame.
+            Returns:
+                list: The alarms raised or cleared by the frame, usually none.
+        """
+        events = []
+        seconds = None
+        for value in values:
+            rules = self.table.get(value["name"])
+            if rules is None:
+                continue
+            number = numeric_value(value["value"])
+            if number is None:
+                continue
+            if seconds is None:
+                seconds = frame_seconds(timestamp)
+            for rule in rules:
+                before = self.active.get(rule, ())
+                after = rule.check(number, value["max"], seconds, before)
+                if after != before:
+                    self.active[rule] = after
+                    events += self.transitions(rule, before, after, number, value["max"], timestamp)
+        return events
+
+    def transitions(self, rule, before, after, value, maximum, timestamp):
+        events = []
+        for condition in after:
+            if condition not in before:
+                alarm = {
+                    "id": rule.alarm_id(condition),
+                    "signal": rule.signal,
+                    "severity": rule.severity,
+                    "state": "raised",
+                    "value": value,
+                    "time": timestamp,
+                    "message": rule.describe(condition, value, maximum),
+                }
+                self.alarms[alarm["id"]] = alarm
+                alarms_raised.inc(rule.severity)
+                events.append(alarm)
+        for condition in before:
+            if condition not in after:
+                alarm = dict(self.alarms.pop(rule.alarm_id(condition)), state="cleared", value=value, time=timestamp)
+                events.append(alarm)
+        return events
+
+    def reset(self):
+        """Forgets every active alarm, so they are raised again if the conditions still hold."""
+        for rules in self.table.values():
+            for rule in rules:
+                rule.reset()
+        self.active = {}
+        self.alarms = {}
+
+
+def frame_seconds(timestamp):
+    """Returns a function giving the frame time as epoch seconds, only parsed if a rule needs it."""
+    parsed = []
+
+    def seconds():
+        if not parsed:
+            parsed.append(datetime.datetime.fromisoformat(timestamp).timestamp())
+        return parsed[0]
+
+    return seconds
+
+
+""" BENCHMARK """
+
+
+def benchmark(frames=100000):
+    """Times evaluate() on decoded frames like those of a drive, most of them without alarms."""
+    frame_values = {
+        "bms": [
+            {"name": "Battery Temperature", "value": 35, "unit": "c", "max": 60},
+            {"name": "Battery Current", "value": 40.5, "unit": "A", "max": 100},
+            {"name": "Battery State of Charge", "value": 80.0, "unit": "%", "max": 100},
+            {"name": "Battery Voltage", "value": 96.2, "unit": "V", "max": 100},
+            {"name": "Battery DCL", "value": 80, "unit": "A", "max": 80},
+            {"name": "Battery Status", "value": 0, "unit": "", "max": 100},
+            {"name": "Battery Checksum", "value": 12, "unit": "", "max": 100},
+            {"name": "Predictive State of Charge", "value": 2, "unit": "Hours", "max": 100},
+        ],
+        "mc": [
+            {"name": "controller temp", "value": 40, "unit": "c", "max": 100},
+            {"name": "Motor Temperature", "value": 55, "unit": "c", "max": 100},
+            {"name": "DC Link Circuit Voltage", "value": 96, "unit": "V", "max": 400},
+            {"name": "logic power supply voltage", "value": 24, "unit": "V", "max": 100},
+        ],
+        "wheels": [
+            {"name": "Wheel Speed RR", "value": 400, "unit": "RPM", "max": 0},
+            {"name": "Wheel Speed RL", "value": 400, "unit": "RPM", "max": 0},
+            {"name": "Wheel Speed FR", "value": 395, "unit": "RPM", "max": 0},
+            {"name": "Wheel Speed FL", "value": 396, "unit": "RPM", "max": 0},
+        ],
+    }
+    start = datetime.datetime(2024, 1, 1)
+    timestamps = [str(start + datetime.timedelta(milliseconds=10 * i)) for i in range(frames)]
+
+    print(f"{datetime.datetime.now()} - # Evaluating {frames} frames of each kind")
+    for kind, values in frame_values.items():
+        rules = AlarmRules()
+        begin = time.perf_counter()
+        for timestamp in timestamps:
+            rules.evaluate(timestamp, values)
+        print(f" # - {kind}: {(time.perf_counter() - begin) / frames * 1e6:.2f} us per frame")
+
+    rules = AlarmRules()
+    hot = [dict(value, value=value["max"] + 1 if i % 2 else 0) for i, value in enumerate(frame_values["mc"])]
+    begin = time.perf_counter()
+    for i, timestamp in enumerate(timestamps):
+        rules.evaluate(timestamp, hot if i % 100 == 0 else frame_values["mc"])
+    print(f" # - mc raising and clearing alarms every 100 frames: {(time.perf_counter() - begin) / frames * 1e6:.2f} us per frame")
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -14,8 +14,6 @@ import datetime
 from enum import Enum
 from collections import deque
 
-last_10_currents = deque(maxlen=10)
-
 
 class Status(Enum):
     VOLTAGE = 1
@@ -30,7 +28,7 @@ class Status(Enum):
 
 class BMSTranslator:
     def __init__(self):
-        pass
+        self.last_10_currents = deque(maxlen=10)
 
     def decode(self, can_data):
         predictive_soc = 0
@@ -121,10 +119,13 @@ class BMSTranslator:
     def predict_soc(self, pack_current, pack_inst_voltage, pack_soc):
         max_pack_current = 6
 
-        last_10_currents.append(pack_current)
-        avg_pack_current = sum(last_10_currents) / len(last_10_currents)
+        self.last_10_currents.append(pack_current)
+        avg_pack_current = sum(self.last_10_currents) / len(self.last_10_currents)
 
         avg_power = avg_pack_current * pack_inst_voltage
         current_kwh = pack_soc * max_pack_current
 
+        # Charging and discharging currents can average out to nothing
+        if avg_power == 0:
+            return 0
         return round(current_kwh / avg_power)
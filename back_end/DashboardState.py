@@ -0,0 +1,202 @@
+"""
+File: DashboardState.py
+Author: Hannah Murphy
+Date: 2024
+Description: The latest value of every signal as seen by the websocket server,
+    versioned so clients can be sent only what changed since their last update.
+
+Copyright (c) 2024 WESMO. All rights reserved.
+This code is part of the WESMO Data Acquisition and Visualisation Project.
+
+"""
+
+import datetime
+import threading
+import msgpack
+import numpy as np
+from database import numeric_value
+
+""" GLOBAL VARIABLES
+Groups clients can subscribe to instead of receiving every signal, any signal
+not listed here is in the vehicle group.
+"""
+SIGNAL_GROUPS = {
+    "motor": [
+        "Motor Speed",
+        "Motor Temperature",
+        "DC Link Circuit Voltage",
+        "Velocity Actual Value",
+        "Target Velocity",
+        "Target Torque",
+        "torque actual",
+        "torque regulator",
+        "flux regulator count",
+        "motor current actual",
+        "current demand",
+        "controller temp",
+        "electrical angle",
+        "phase a current",
+        "phase b current",
+        "position actual",
+        "logic power supply voltage",
+        "status word",
+        "Control Word",
+        "MCU is RTD",
+        "NMT is Operational",
+        "Motor Speed Average",
+    ],
+    "battery": [
+        "Battery Temperature",
+        "Battery Current",
+        "Battery State of Charge",
+        "Predictive State of Charge",
+        "Battery Voltage",
+        "Battery Power",
+        "Battery Power Average",
+        "Battery Energy Used",
+        "Battery DCL",
+        "Battery Status",
+        "Battery Checksum",
+    ],
+    "pedals": [
+        "Accelerator Travel 1",
+        "Accelerator Travel 2",
+        "Break Pressure Front",
+        "Break Pressure Rear",
+        "Break Conflict",
+        "APPS Mismatch fault",
+        "APPS Voltage fault",
+    ],
+    "wheel_speeds": ["Wheel Speed FL", "Wheel Speed FR", "Wheel Speed RL", "Wheel Speed RR", "Wheel Slip"],
+    "vehicle": [],
+}
+DEFAULT_GROUP = "vehicle"
+
+# Encodings clients can ask for the values in, see DashboardState.encode
+ENCODINGS = ("json", "msgpack", "packed")
+GROUP_OF = {name: group for group, names in SIGNAL_GROUPS.items() for name in names}
+
+
+class DashboardState:
+    """_summary_
+    Every signal is given a small integer id the first time it is seen. The
+    version goes up by one for every delta, a client holding version N can apply
+    the delta with base N, anything else means it missed one and needs a snapshot.
+    Snapshots and deltas look like:
+        {"version": 7, "signals": {"3": {"name": "Motor Speed", "unit": "rpm"}},
+         "values": {"3": ["2024-05-01 12:00:00.123456", 1500]}}
+    with deltas also carrying "base" and only the signals first seen since the last one.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+        self.ids = {}
+        self.units = {}
+        self.version = 0
+        self.changed = set()
+        self.changed_groups = set()
+        self.new_signals = []
+
+    def update(self, records):
+        """_summary_
+        Records the latest values from the change feed.
+            Args:
+                records (list): {time, name, value, unit} dictionaries.
+        """
+        with self.lock:
+            for record in records:
+                name = record["name"]
+                if name not in self.ids:
+                    self.ids[name] = len(self.ids) + 1
+                    self.new_signals.append(name)
+                self.values[name] = record
+                self.units[name] = record["unit"]
+                self.changed.add(name)
+                self.changed_groups.add(GROUP_OF.get(name, DEFAULT_GROUP))
+
+    def clear(self):
+        """Forgets every value, clients are sent a fresh (empty) snapshot after this."""
+        with self.lock:
+            self.values = {}
+            self.changed = set()
+            self.changed_groups = set()
+            self.version += 1
+
+    def latest(self, group=None):
+        """Returns every value, or those of one group, as the legacy list of {time, name, value, unit}."""
+        with self.lock:
+            if group is None:
+                return list(self.values.values())
+            return [record for name, record in self.values.items() if GROUP_OF.get(name, DEFAULT_GROUP) == group]
+
+    def take_changed_groups(self):
+        """Returns the groups with a value changed since the last call."""
+        with self.lock:
+            groups, self.changed_groups = self.changed_groups, set()
+            return groups
+
+    def snapshot(self):
+        """Returns the current version, the metadata of every signal and every value."""
+        with self.lock:
+            return {
+                "version": self.version,
+                "signals": {self.ids[name]: self.signal_meta(name) for name in self.ids},
+                "values": {self.ids[name]: self.compact(record) for name, record in self.values.items()},
+            }
+
+    def take_delta(self):
+        """_summary_
+        Returns the values changed since the previous delta and moves to the next
+        version, or None if nothing changed.
+        """
+        with self.lock:
+            if not self.changed:
+                return None
+            self.version += 1
+            delta = {
+                "version": self.version,
+                "base": self.version - 1,
+                "signals": {self.ids[name]: self.signal_meta(name) for name in self.new_signals},
+                "values": {self.ids[name]: self.compact(self.values[name]) for name in self.changed},
+            }
+            self.changed = set()
+            self.new_signals = []
+            return delta
+
+    def signal_table(self):
+        """Returns the name and unit of every signal by id, for decoding packed values."""
+        with self.lock:
+            return {self.ids[name]: self.signal_meta(name) for name in self.ids}
+
+    def encode(self, records, encoding):
+        """_summary_
+        Encodes a list of values for sending.
+            json: the list itself, sent as JSON.
+            msgpack: the list packed with msgpack.
+            packed: little endian arrays of the signal ids (uint16), times as
+                epoch seconds (float64) and values (float64, NaN if not numeric),
+                one after the other. Names and units come from signal_table().
+        """
+        if encoding == "msgpack":
+            return msgpack.packb(records, default=str)
+        if encoding != "packed":
+            return records
+        with self.lock:
+            ids = np.array([self.ids[record["name"]] for record in records], dtype="<u2")
+        times = np.array([epoch_seconds(record["time"]) for record in records], dtype="<f8")
+        values = np.array([numeric_value(record["value"]) for record in records], dtype="<f8")
+        return ids.tobytes() + times.tobytes() + values.tobytes()
+
+    def signal_meta(self, name):
+        return {"name": name, "unit": self.units[name]}
+
+    def compact(self, record):
+        return [record["time"], record["value"]]
+
+
+def epoch_seconds(timestamp):
+    try:
+        return datetime.datetime.fromisoformat(timestamp).timestamp()
+    except (TypeError, ValueError):
+        return float("nan")
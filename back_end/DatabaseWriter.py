@@ -0,0 +1,302 @@
+"""
+File: DatabaseWriter.py
+Author: Hannah Murphy
+Date: 2024
+Description: Writes decoded rows to the storage backend in batches from a background
+    thread so the MQTT thread never waits on the database. Batches the backend
+    can't accept in time are spilled to disk and replayed in order once it recovers.
+    Rows the backend rejects outright are moved to a quarantine file. An unexpected
+    error is logged and the writer carries on, the batch it was handling is spilled.
+
+    Rows are only held in memory between being queued and their batch being
+    written or spilled, at most flush_interval plus one write while the backend
+    keeps up. Stopping with SIGTERM spills them, a crash or SIGKILL loses them,
+    but the frames aren't recorded as stored (see put_frame) so the broker's
+    redelivery of any it wasn't acknowledged for is processed again.
+
+Copyright (c) 2024 WESMO. All rights reserved.
+This code is part of the WESMO Data Acquisition and Visualisation Project.
+
+"""
+
+import os
+import json
+import time
+import queue
+import datetime
+import threading
+import metrics
+from SpillBuffer import SpillBuffer
+from StorageBackend import StorageUnavailable, StorageRejected
+
+QUARANTINE_FILE = "quarantine.jsonl"
+
+
+class DatabaseWriter:
+    def __init__(
+        self,
+        storage,
+        spill_dir,
+        batch_size=500,
+        flush_interval=0.1,
+        high_water=20000,
+        on_session_closed=None,
+        on_frames_stored=None,
+    ):
+        """_summary_
+            Args:
+                storage (StorageBackend): Where the rows are written, used only by the writer thread.
+                spill_dir (str): Directory for the on disk spill segments.
+                batch_size (int): Most rows written in a single transaction.
+                flush_interval (float): Longest time in seconds a row waits before being written.
+                high_water (int): Queue depth at which new batches go straight to disk.
+                on_session_closed (function): Called with the id of each session once it is closed.
+                on_frames_stored (function): Called with the keys queued by put_frame once the
+                    rows queued before them are stored or spilled.
+        """
+        self.storage = storage
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.high_water = high_water
+        self.on_session_closed = on_session_closed
+        self.on_frames_stored = on_frames_stored
+        self.queue = queue.SimpleQueue()
+        self.spill = SpillBuffer(spill_dir)
+        self.quarantine_path = os.path.join(spill_dir, QUARANTINE_FILE)
+        self.signal_meta = {}
+        self.last_rtd = None
+        self.running = False
+        self.thread = None
+
+        metrics.Gauge("wesmo_db_queue_depth", "Rows waiting to be written to storage.", self.queue.qsize)
+        metrics.Gauge("wesmo_spill_bytes", "Bytes waiting in the on disk spill.", self.spill.size_bytes)
+        metrics.Gauge("wesmo_spill_segments", "Segment files in the on disk spill.", self.spill.segment_count)
+        metrics.Gauge("wesmo_spill_lag_seconds", "Age of the oldest spilled batch.", self.spill.lag_seconds)
+        metrics.Gauge("wesmo_db_writer_alive", "1 while the database writer thread is running.", self.alive)
+        self.rows_total = metrics.Counter("wesmo_db_rows_total", "Rows handled by the database writer.", ("outcome",))
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="database-writer", daemon=True)
+        self.thread.start()
+
+    def alive(self):
+        return int(self.thread is not None and self.thread.is_alive())
+
+    def stop(self):
+        """Stops the writer thread, anything still queued is spilled so it isn't lost."""
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+        batch = self.take_batch(timeout=0, limit=None)
+        if batch:
+            frames = batch.pop("frames")
+            if not batch["rows"] or self.spill_batch(batch):
+                self.frames_stored(frames)
+        self.spill.close()
+
+    def register_signal(self, name, source, pdo, unit, maximum):
+        """_summary_
+        Records the metadata of a signal, it is stored by the backend the first
+        time a row for the signal is written.
+        """
+        if name not in self.signal_meta:
+            self.signal_meta[name] = (source, pdo, unit, maximum)
+
+    def put(self, row):
+        """_summary_
+        Queues a single row, called from the MQTT thread and never blocks.
+            Args:
+                row (tuple): (time, signal name, value)
+            Raises:
+                RuntimeError: The writer thread has died, so the frame isn't acknowledged
+                    and the broker redelivers it once the subscriber is restarted.
+        """
+        if self.running and not self.thread.is_alive():
+            raise RuntimeError("the database writer thread has stopped")
+        self.queue.put(row)
+
+    def put_rtd_state(self, time, rtd):
+        """_summary_
+        Queues a change of RTD state, rows queued after it are recorded in a new
+        session. Called from the MQTT thread for every vehicle status frame.
+            Args:
+                time (str): Timestamp of the frame.
+                rtd (bool): Whether the car is ready to drive.
+        """
+        if rtd != self.last_rtd:
+            self.last_rtd = rtd
+            self.queue.put({"time": time, "rtd": rtd})
+
+    def put_lap(self, lap):
+        """_summary_
+        Queues a lap to be recorded, after the rows it was made from.
+            Args:
+                lap (dict): A lap from LapTracker.update.
+        """
+        self.queue.put({"time": lap["ended_at"], "lap": lap})
+
+    def put_frame(self, key):
+        """_summary_
+        Queues the key of a frame after its rows, it is passed to on_frames_stored
+        once they are stored or spilled.
+            Args:
+                key (str): The frame's key, see mqtt_subscriber.frame_key.
+        """
+        self.queue.put({"frame": key})
+
+    def run(self):
+        while self.running:
+            batch = None
+            try:
+                batch = self.take_batch(timeout=self.flush_interval, limit=self.batch_size)
+                if batch:
+                    self.handle_batch(batch)
+                    batch = None
+
+                if self.spill.has_pending() and self.queue.qsize() < self.batch_size:
+                    self.replay()
+            except Exception as e:
+                # Nothing may stop the thread, rows would pile up in memory unwritten
+                metrics.errors_total.inc("db_writer")
+                print(f"{datetime.datetime.now()} -! # Unexpected error in the database writer: {e!r}")
+                if batch is not None:
+                    self.spill_batch(batch)
+                time.sleep(self.flush_interval)
+
+    def handle_batch(self, batch):
+        frames = batch.pop("frames")
+        if not batch["rows"]:
+            stored = True
+        elif self.spill.has_pending() or self.queue.qsize() > self.high_water:
+            # Keep ordering, nothing jumps ahead of spilled data
+            stored = self.spill_batch(batch)
+        else:
+            stored = self.write_batch(batch) or self.spill_batch(batch)
+        if stored:
+            self.frames_stored(frames)
+
+    def take_batch(self, timeout, limit):
+        """Collects up to limit rows, waiting at most timeout seconds for the first one."""
+        try:
+            first = self.queue.get(timeout=timeout) if timeout else self.queue.get_nowait()
+        except queue.Empty:
+            return None
+
+        items = [first]
+        while limit is None or len(items) < limit:
+            try:
+                items.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        # Frame keys aren't stored, they only follow the rows of their frame
+        rows = [item for item in items if not (isinstance(item, dict) and "frame" in item)]
+        frames = [item["frame"] for item in items if isinstance(item, dict) and "frame" in item]
+        return {"queued_at": time.time(), "rows": rows, "frames": frames}
+
+    def spill_batch(self, batch):
+        """_summary_
+        Appends the batch to the on disk spill.
+            Returns:
+                bool: True if the batch was spilled, False if it was lost.
+        """
+        try:
+            self.spill.append(batch)
+            self.rows_total.inc("spilled", amount=self.batch_rows(batch))
+            return True
+        except OSError as e:
+            metrics.errors_total.inc("spill")
+            print(f"{datetime.datetime.now()} -! # Error writing spill segment, {self.batch_rows(batch)} rows lost: {e}")
+            return False
+
+    def frames_stored(self, frames):
+        if frames and self.on_frames_stored is not None:
+            self.notify(self.on_frames_stored, frames)
+
+    def notify(self, callback, argument):
+        # The rows are already stored, a failing callback mustn't have them spilled again
+        try:
+            callback(argument)
+        except Exception as e:
+            metrics.errors_total.inc("db_writer")
+            print(f"{datetime.datetime.now()} -! # Error in database writer callback {callback.__name__}: {e!r}")
+
+    def replay(self):
+        """Replays spilled batches oldest first until the spill is empty, the
+        database fails again or live rows start backing up."""
+        while self.running and self.queue.qsize() < self.batch_size:
+            batch = self.spill.peek()
+            if batch is None:
+                print(f"{datetime.datetime.now()} - # Spill fully replayed")
+                return
+            # A batch cut short part way through a rejected batch's rows is
+            # replayed whole, so rows written before the outage are written twice
+            if not self.write_batch(batch):
+                return
+            self.spill.commit()
+            self.rows_total.inc("replayed", amount=self.batch_rows(batch))
+
+    def write_batch(self, batch):
+        """_summary_
+        Hands every row of the batch to the storage backend.
+            Returns:
+                bool: True if the batch was stored.
+        """
+        if not self.storage.ready():
+            return False
+
+        db_start = time.perf_counter_ns()
+        unstored = self.store_rows(batch["rows"])
+        if unstored:
+            # Only what wasn't written is spilled
+            batch["rows"] = unstored
+            return False
+        metrics.stage_latency.observe_since(db_start, "db_write", "batch")
+        return True
+
+    def store_rows(self, rows):
+        """_summary_
+        Writes rows to the backend. When the backend rejects them, or fails in
+        a way it doesn't expect, they are halved until the rows at fault are
+        found, those are quarantined and the rest written.
+            Returns:
+                list: The rows not written because the backend became unavailable.
+        """
+        try:
+            closed_sessions = self.storage.write_batch(rows, self.signal_meta)
+        except StorageUnavailable as e:
+            metrics.errors_total.inc("db_write")
+            print(f"{datetime.datetime.now()} -! # Error writing batch to storage, spilling: {e}")
+            return rows
+        except Exception as e:
+            metrics.errors_total.inc("db_write")
+            if len(rows) == 1:
+                self.quarantine(rows, e if isinstance(e, StorageRejected) else repr(e))
+                return []
+            middle = len(rows) // 2
+            unstored = self.store_rows(rows[:middle])
+            if unstored:
+                return unstored + rows[middle:]
+            return self.store_rows(rows[middle:])
+
+        self.rows_total.inc("written", amount=self.batch_rows({"rows": rows}))
+        if self.on_session_closed is not None:
+            for session_id in closed_sessions:
+                self.notify(self.on_session_closed, session_id)
+        return []
+
+    def quarantine(self, rows, error):
+        """Appends rows the backend rejects to the quarantine file, to be looked at by hand."""
+        self.rows_total.inc("quarantined", amount=len(rows))
+        print(f"{datetime.datetime.now()} -! # Storage rejected {rows}, quarantined: {error}")
+        try:
+            with open(self.quarantine_path, "a") as f:
+                f.write(json.dumps({"time": time.time(), "error": str(error), "rows": rows}, default=str) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError as e:
+            metrics.errors_total.inc("spill")
+            print(f"{datetime.datetime.now()} -! # Error writing quarantine file, {len(rows)} rows lost: {e}")
+
+    def batch_rows(self, batch):
+        return sum(1 for row in batch["rows"] if not isinstance(row, dict))
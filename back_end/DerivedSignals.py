@@ -0,0 +1,198 @@
+"""
+File: DerivedSignals.py
+Author: Hannah Murphy
+Date: 2024
+Description: Signals computed from the decoded ones as frames arrive, such as battery
+    power from the pack voltage and current. Each derived signal is declared in
+    DERIVED_SIGNALS over its inputs and updated in constant time per frame with
+    a fixed amount of state, its values are stored and sent to the dashboards
+    like any decoded signal.
+
+Copyright (c) 2024 WESMO. All rights reserved.
+This code is part of the WESMO Data Acquisition and Visualisation Project.
+
+"""
+
+import os
+import datetime
+from abc import ABC, abstractmethod
+from collections import deque
+from database import numeric_value
+
+""" GLOBAL VARIABLES
+GEAR_RATIO is the motor revolutions per wheel revolution, used to compare the
+motor speed with the wheel speeds. Integrals ignore gaps longer than MAX_GAP
+seconds, e.g. while the car is off, rather than bridging them.
+"""
+GEAR_RATIO = float(os.environ.get("WESMO_GEAR_RATIO", 1.0))
+MAX_GAP = 5.0
+MIN_SLIP_SPEED = 10
+
+
+class Derived(ABC):
+    """_summary_
+    A signal computed from others. update() is called whenever one of the
+    inputs has a new value and returns the new value, or None if there isn't one.
+    """
+
+    def __init__(self, name, inputs, unit="", maximum=None):
+        self.name = name
+        self.inputs = tuple(inputs)
+        self.unit = unit
+        self.max = maximum
+
+    @abstractmethod
+    def update(self, latest, seconds):
+        """_summary_
+            Args:
+                latest (dict): The latest numeric value of every signal by name.
+                seconds (float): Time of the frame as epoch seconds.
+        """
+
+
+class Product(Derived):
+    """The product of the inputs times a scale, e.g. power from voltage and current."""
+
+    def __init__(self, name, inputs, scale=1.0, **kwargs):
+        super().__init__(name, inputs, **kwargs)
+        self.scale = scale
+
+    def update(self, latest, seconds):
+        value = self.scale
+        for name in self.inputs:
+            if name not in latest:
+                return None
+            value *= latest[name]
+        return value
+
+
+class RollingMean(Derived):
+    """The mean of the last samples values of one input, kept as a running sum."""
+
+    def __init__(self, name, source, samples=50, **kwargs):
+        super().__init__(name, [source], **kwargs)
+        self.window = deque(maxlen=samples)
+        self.total = 0.0
+        self.updates = 0
+
+    def update(self, latest, seconds):
+        if len(self.window) == self.window.maxlen:
+            self.total -= self.window[0]
+        self.window.append(latest[self.inputs[0]])
+        self.total += self.window[-1]
+        # Summed again now and then so rounding errors don't build up
+        self.updates += 1
+        if self.updates % self.window.maxlen == 0:
+            self.total = sum(self.window)
+        return self.total / len(self.window)
+
+
+class Integral(Derived):
+    """_summary_
+    The integral of one input over time (trapezoidal), e.g. energy from power.
+    Starts again from zero whenever the reset_on signal changes value.
+    """
+
+    def __init__(self, name, source, scale=1.0, reset_on=None, **kwargs):
+        super().__init__(name, [source] + ([reset_on] if reset_on else []), **kwargs)
+        self.scale = scale
+        self.reset_on = reset_on
+        self.reset_value = None
+        self.last = None
+        self.total = 0.0
+
+    def update(self, latest, seconds):
+        if self.reset_on is not None and latest.get(self.reset_on) != self.reset_value:
+            self.reset_value = latest.get(self.reset_on)
+            self.total = 0.0
+            self.last = None
+        value = latest.get(self.inputs[0])
+        if value is None:
+            return None
+        if self.last is not None and 0 < seconds - self.last[0] <= MAX_GAP:
+            self.total += (self.last[1] + value) / 2 * (seconds - self.last[0]) * self.scale
+        if self.last is None or seconds >= self.last[0]:
+            self.last = (seconds, value)
+        return self.total
+
+
+class Slip(Derived):
+    """_summary_
+    How much faster the driven wheels turn than the reference wheels, in percent.
+    The driven wheel speed is worked out from the motor speed and gear ratio.
+    """
+
+    def __init__(self, name, motor, reference_wheels, ratio=GEAR_RATIO, **kwargs):
+        super().__init__(name, [motor] + list(reference_wheels), **kwargs)
+        self.ratio = ratio
+
+    def update(self, latest, seconds):
+        if any(name not in latest for name in self.inputs):
+            return None
+        reference = sum(latest[name] for name in self.inputs[1:]) / (len(self.inputs) - 1)
+        # Meaningless at walking pace, where a single count is a large fraction
+        if abs(reference) < MIN_SLIP_SPEED:
+            return 0.0
+        return (latest[self.inputs[0]] / self.ratio - reference) / reference * 100
+
+
+""" DERIVED SIGNALS
+Inputs are decoded signals or derived signals declared above them.
+"""
+DERIVED_SIGNALS = [
+    Product("Battery Power", ["Battery Voltage", "Battery Current"], scale=0.001, unit="kW", maximum=80),
+    RollingMean("Battery Power Average", "Battery Power", samples=50, unit="kW", maximum=80),
+    Integral("Battery Energy Used", "Battery Power", scale=1 / 3600, reset_on="RTD Running", unit="kWh", maximum=10),
+    RollingMean("Motor Speed Average", "Motor Speed", samples=50, unit="RPM", maximum=10000),
+    Slip("Wheel Slip", "Motor Speed", ["Wheel Speed FL", "Wheel Speed FR"], unit="%", maximum=100),
+]
+
+
+class DerivedSignals:
+    def __init__(self, definitions=DERIVED_SIGNALS):
+        """_summary_
+            Args:
+                definitions (list): Derived signals, each only using those before it.
+            Raises:
+                ValueError: A derived signal uses one declared after it.
+        """
+        self.definitions = definitions
+        self.latest = {}
+        names = [derived.name for derived in definitions]
+        for position, derived in enumerate(definitions):
+            later = [name for name in derived.inputs if name in names[position:]]
+            if later:
+                raise ValueError(f"{derived.name} uses {later}, which must be declared before it")
+        self.inputs = {name for derived in definitions for name in derived.inputs}
+
+    def update(self, timestamp, values):
+        """_summary_
+        Updates every derived signal with an input in the frame.
+            Args:
+                timestamp (str): Time of the frame, 'YYYY-MM-DD HH:MM:SS.ffffff'.
+                values (list): The decoded {name, value, unit, max} of the frame.
+            Returns:
+                list: The new {name, value, unit, max} of the derived signals.
+        """
+        changed = set()
+        for value in values:
+            if value["name"] in self.inputs:
+                number = numeric_value(value["value"])
+                if number is not None:
+                    self.latest[value["name"]] = number
+                    changed.add(value["name"])
+        if not changed:
+            return []
+
+        seconds = datetime.datetime.fromisoformat(timestamp).timestamp()
+        derived_values = []
+        for derived in self.definitions:
+            if changed.isdisjoint(derived.inputs):
+                continue
+            value = derived.update(self.latest, seconds)
+            if value is None:
+                continue
+            self.latest[derived.name] = value
+            changed.add(derived.name)
+            derived_values.append({"name": derived.name, "value": round(value, 3), "unit": derived.unit, "max": derived.max})
+        return derived_values
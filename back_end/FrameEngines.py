@@ -0,0 +1,65 @@
+"""
+File: FrameEngines.py
+Author: Hannah Murphy
+Date: 2024
+Description: The engines run on every decoded frame after its values are queued for
+    the database: the derived signals, the lap tracker and the alarm rules. They
+    follow each signal from frame to frame, so the subscriber builds one set and
+    hands it to every save (see database.save_values), and nothing else keeps a
+    copy of their state.
+
+Copyright (c) 2024 WESMO. All rights reserved.
+This code is part of the WESMO Data Acquisition and Visualisation Project.
+
+"""
+
+from DerivedSignals import DerivedSignals
+from AlarmRules import AlarmRules
+from LapTracker import LapTracker
+
+
+class FrameEngines:
+    def __init__(self, on_values, on_alarms, enabled=True):
+        """_summary_
+            Args:
+                on_values (function): Called with the split timestamp and the values of
+                    each frame, derived signals included, e.g. to cache them.
+                on_alarms (function): Called with the alarms raised or cleared by a frame.
+                enabled (bool): False to only pass the decoded values on, when each
+                    instance is given a share of the frames.
+        """
+        self.on_values = on_values
+        self.on_alarms = on_alarms
+        self.enabled = enabled
+        self.derived_signals = DerivedSignals()
+        self.alarm_rules = AlarmRules()
+        self.lap_tracker = LapTracker()
+
+    def update(self, writer, time, values):
+        """_summary_
+        Runs the engines on a frame whose values are already queued on the writer.
+            Args:
+                writer (DatabaseWriter): Where derived values and laps are queued.
+                time (list): The split frame timestamp.
+                values (list): The {name, value, unit, max} of the frame.
+        """
+        if not self.enabled:
+            self.on_values(time, values)
+            return
+
+        # Stored and cached with the frame they were computed from
+        timestamp = time[1] + " " + time[2]
+        derived = self.derived_signals.update(timestamp, values)
+        for value in derived:
+            writer.register_signal(value["name"], "derived", None, value["unit"], value["max"])
+            writer.put((timestamp, value["name"], value["value"]))
+
+        for lap in self.lap_tracker.update(timestamp, values + derived):
+            writer.put_lap(lap)
+
+        # Alarms go out ahead of the values rather than with the next broadcast
+        alarms = self.alarm_rules.evaluate(timestamp, values + derived)
+        if alarms:
+            self.on_alarms(alarms)
+
+        self.on_values(time, values + derived)
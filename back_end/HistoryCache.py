@@ -0,0 +1,160 @@
+"""
+File: HistoryCache.py
+Author: Hannah Murphy
+Date: 2024
+Description: Caches history responses in the websocket server so dashboards opening
+    the same graph share one query. Entries for past windows are dropped as soon
+    as the change feed brings a value which would change them, entries covering
+    up to now are shared for a short time instead, as their signals change on
+    almost every frame. Least recently used entries are evicted to stay under a
+    memory limit.
+
+Copyright (c) 2024 WESMO. All rights reserved.
+This code is part of the WESMO Data Acquisition and Visualisation Project.
+
+"""
+
+import json
+import time
+import datetime
+import threading
+from collections import OrderedDict
+import metrics
+
+""" GLOBAL VARIABLES """
+MISSING = object()
+
+cache_requests = metrics.Counter(
+    "wesmo_history_cache_requests_total",
+    "History requests by whether they were answered from the cache.",
+    ("result",),
+)
+cache_evictions = metrics.Counter(
+    "wesmo_history_cache_evictions_total",
+    "History cache entries removed before they expired.",
+    ("reason",),
+)
+
+
+class HistoryCache:
+    def __init__(self, max_bytes=64 * 2**20, ttl=60, live_ttl=1):
+        """_summary_
+            Args:
+                max_bytes (int): Most bytes of responses kept, measured as JSON.
+                ttl (float): Seconds an entry is kept at most, in case a change was missed.
+                live_ttl (float): Seconds an entry covering up to now is kept, from when
+                    its query started, so how far behind such a response may be.
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.live_ttl = live_ttl
+        self.lock = threading.Lock()
+        # key -> (response, size, names, end, expires), least recently used first
+        self.entries = OrderedDict()
+        self.by_signal = {}
+        self.size = 0
+        # When each signal last changed, so a response for a past window queried
+        # before a change but finished after it isn't cached
+        self.changed_at = {}
+        metrics.Gauge("wesmo_history_cache_bytes", "Bytes of responses in the history cache.", lambda: self.size)
+        metrics.Gauge("wesmo_history_cache_entries", "Responses in the history cache.", lambda: len(self.entries))
+
+    def get(self, key):
+        """Returns the cached response for the key, or MISSING."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[4] < time.monotonic():
+                self.remove(key)
+                entry = None
+            if entry is None:
+                cache_requests.inc("miss")
+                return MISSING
+            self.entries.move_to_end(key)
+            cache_requests.inc("hit")
+            return entry[0]
+
+    def put(self, key, response, names, end=None, queried_at=None):
+        """_summary_
+        Caches a response. Responses covering up to now (end None) are kept for
+        live_ttl seconds and not dropped by changes, the rest until a change
+        reaches their window.
+            Args:
+                key (hashable): What the request is looked up by.
+                response: The response, anything JSON serialisable.
+                names (list): The signals the response is made of.
+                end (float): Epoch seconds the response covers up to, None if up to now.
+                queried_at (float): time.monotonic() when the query started.
+        """
+        size = len(json.dumps(response, default=str))
+        if size > self.max_bytes:
+            return
+        names = list(dict.fromkeys(names))
+        now = time.monotonic()
+        if end is None:
+            expires = (now if queried_at is None else queried_at) + min(self.live_ttl, self.ttl)
+            if expires <= now:
+                return
+        else:
+            expires = now + self.ttl
+        with self.lock:
+            if end is not None and queried_at is not None:
+                if any(self.changed_at.get(name, 0) >= queried_at for name in names):
+                    return
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (response, size, names, end, expires)
+            self.size += size
+            # Only past windows are dropped by changes
+            if end is not None:
+                for name in names:
+                    self.by_signal.setdefault(name, set()).add(key)
+            while self.size > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+                cache_evictions.inc("memory")
+
+    def invalidate(self, records):
+        """_summary_
+        Drops the entries a batch from the change feed makes out of date, those
+        of the batch's signals whose window ends past the new values. Entries
+        covering up to now are left to expire.
+            Args:
+                records (list): {time, name, value, unit} dictionaries.
+        """
+        earliest = {}
+        now = time.monotonic()
+        with self.lock:
+            for record in records:
+                self.changed_at[record["name"]] = now
+                if record["name"] in self.by_signal and record["name"] not in earliest:
+                    earliest[record["name"]] = record["time"]
+            for name, record_time in earliest.items():
+                seconds = epoch_seconds(record_time)
+                for key in list(self.by_signal.get(name, ())):
+                    if self.entries[key][3] > seconds:
+                        self.remove(key)
+                        cache_evictions.inc("changed")
+
+    def clear(self):
+        with self.lock:
+            self.entries = OrderedDict()
+            self.by_signal = {}
+            self.size = 0
+
+    def remove(self, key):
+        # Called with the lock held
+        response, size, names, end, expires = self.entries.pop(key)
+        self.size -= size
+        for name in names:
+            keys = self.by_signal.get(name)
+            if keys is None:
+                continue
+            keys.discard(key)
+            if not keys:
+                del self.by_signal[name]
+
+
+def epoch_seconds(timestamp):
+    try:
+        return datetime.datetime.fromisoformat(timestamp).timestamp()
+    except (TypeError, ValueError):
+        return float("-inf")
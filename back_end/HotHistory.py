@@ -0,0 +1,155 @@
+"""
+File: HotHistory.py
+Author: Hannah Murphy
+Date: 2024
+Description: Keeps the most recent points of every signal in memory in the
+    websocket server, fed by the change feed, so recent history requests
+    never reach the database. Older windows are passed on to the storage backend.
+
+Copyright (c) 2024 WESMO. All rights reserved.
+This code is part of the WESMO Data Acquisition and Visualisation Project.
+
+"""
+
+import datetime
+import threading
+import numpy as np
+from StorageBackend import StorageBackend
+from database import rollup_resolution, numeric_value
+from downsample import latest_rows, window_rows
+
+
+class RingBuffer:
+    """_summary_
+    A fixed size, preallocated buffer of (time, value) points. Every point is
+    written twice, capacity apart, so the newest n points are always one
+    contiguous slice and can be returned as a view without copying.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.times = np.zeros(capacity * 2, dtype=np.float64)
+        self.values = np.zeros(capacity * 2, dtype=np.float64)
+        self.head = 0
+        self.count = 0
+
+    def append(self, time, value):
+        self.times[self.head] = self.times[self.head + self.capacity] = time
+        self.values[self.head] = self.values[self.head + self.capacity] = value
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def latest(self, n=None):
+        """Returns views of the newest n points (all of them by default), oldest first."""
+        n = self.count if n is None else min(n, self.count)
+        end = self.head + self.capacity
+        return self.times[end - n : end], self.values[end - n : end]
+
+    def full(self):
+        return self.count == self.capacity
+
+    def oldest_time(self):
+        return self.times[self.head + self.capacity - self.count] if self.count else None
+
+
+class HotHistory(StorageBackend):
+    def __init__(self, storage, capacity=30000):
+        """_summary_
+            Args:
+                storage (StorageBackend): Where requests not covered by memory are sent.
+                capacity (int): Points kept per signal (5 minutes at 100 Hz by default).
+        """
+        self.storage = storage
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.buffers = {}
+        self.since = None
+
+    def reset(self):
+        """_summary_
+        Empties every buffer, called whenever the change feed (re)connects since
+        anything published while it was down is missing from memory.
+        """
+        with self.lock:
+            self.buffers = {}
+            self.since = None
+
+    def update(self, records):
+        """_summary_
+        Appends the values from the change feed.
+            Args:
+                records (list): {time, name, value, unit} dictionaries.
+        """
+        with self.lock:
+            for record in records:
+                try:
+                    time = datetime.datetime.fromisoformat(record["time"]).timestamp()
+                except (TypeError, ValueError):
+                    continue
+                # Stored as NaN like the database stores NULL for non numeric values
+                value = numeric_value(record["value"])
+                value = float("nan") if value is None else value
+                if self.since is None:
+                    self.since = time
+                buffer = self.buffers.get(record["name"])
+                if buffer is None:
+                    buffer = self.buffers[record["name"]] = RingBuffer(self.capacity)
+                buffer.append(time, value)
+
+    def covered_since(self, names):
+        """_summary_
+        Returns the time from which memory holds every point of the given
+        signals, or None before anything has arrived on the change feed.
+        """
+        if self.since is None:
+            return None
+        covered = self.since
+        for name in names:
+            buffer = self.buffers.get(name)
+            if buffer is not None and buffer.full():
+                covered = max(covered, buffer.oldest_time())
+        return covered
+
+    def query_history(self, names, limit):
+        with self.lock:
+            covered = self.covered_since(names)
+            if covered is not None:
+                series = [(name, *self.buffers[name].latest(limit)) for name in names if name in self.buffers]
+                rows = latest_rows(series, limit)
+                # Only complete if the oldest row returned is newer than anything evicted
+                if len(rows) == limit and rows[-1][0].timestamp() >= covered:
+                    return rows
+        return self.storage.query_history(names, limit)
+
+    def query_history_window(self, names, start, end, width):
+        resolution = rollup_resolution(start, end, width)
+        first, last = start.timestamp(), end.timestamp()
+        if resolution:
+            first = first // resolution * resolution
+        with self.lock:
+            covered = self.covered_since(names)
+            if covered is not None and first >= covered:
+                series = []
+                for name in names:
+                    if name in self.buffers:
+                        times, values = self.buffers[name].latest()
+                        lo, hi = np.searchsorted(times, (first, last), side="left")
+                        series.append((name, times[lo:hi], values[lo:hi]))
+                return resolution, window_rows(series, resolution)
+        return self.storage.query_history_window(names, start, end, width)
+
+    def write_batch(self, rows, signal_meta):
+        # The buffers are fed by the change feed, writes go straight through
+        return self.storage.write_batch(rows, signal_meta)
+
+    def session_start(self, session_id=None):
+        return self.storage.session_start(session_id)
+
+    def query_laps(self, session_id=None):
+        return self.storage.query_laps(session_id)
+
+    def export_rows(self, names, start, end, *args):
+        return self.storage.export_rows(names, start, end, *args)
+
+    def close(self):
+        self.storage.close()
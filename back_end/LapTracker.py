@@ -0,0 +1,150 @@
+"""
+File: LapTracker.py
+Author: Hannah Murphy
+Date: 2024
+Description: Splits driving into stints and laps as frames are decoded. A stint is an
+    RTD cycle (one session, see database.change_session), and a lap ends every
+    LAP_LENGTH metres travelled, measured by integrating the wheel speeds. Each lap
+    is stored with its aggregates, such as the highest motor temperature and the
+    energy used, so laps are compared without reading the raw telemetry.
+
+Copyright (c) 2024 WESMO. All rights reserved.
+This code is part of the WESMO Data Acquisition and Visualisation Project.
+
+"""
+
+import os
+import datetime
+from database import numeric_value
+from DerivedSignals import MAX_GAP
+
+""" GLOBAL VARIABLES
+WESMO_LAP_LENGTH is the length of the track in metres, WESMO_WHEEL_CIRCUMFERENCE
+the rolling circumference of the tyres in metres (the wheel speeds are in RPM).
+"""
+LAP_LENGTH = float(os.environ.get("WESMO_LAP_LENGTH", 1000))
+WHEEL_CIRCUMFERENCE = float(os.environ.get("WESMO_WHEEL_CIRCUMFERENCE", 1.44))
+RTD_SIGNAL = "RTD Running"
+POWER_SIGNAL = "Battery Power"
+WHEEL_SIGNALS = ("Wheel Speed FL", "Wheel Speed FR", "Wheel Speed RL", "Wheel Speed RR")
+
+# Aggregates kept per lap: name -> (signal, max or min)
+LAP_AGGREGATES = {
+    "max_motor_temp": ("Motor Temperature", max),
+    "max_battery_temp": ("Battery Temperature", max),
+    "min_soc": ("Battery State of Charge", min),
+}
+
+
+class LapTracker:
+    def __init__(self, lap_length=LAP_LENGTH, wheel_circumference=WHEEL_CIRCUMFERENCE):
+        """_summary_
+            Args:
+                lap_length (float): Metres travelled per lap.
+                wheel_circumference (float): Metres travelled per wheel revolution.
+        """
+        self.lap_length = lap_length
+        self.wheel_circumference = wheel_circumference
+        self.inputs = {RTD_SIGNAL, POWER_SIGNAL, *WHEEL_SIGNALS}
+        self.inputs.update(signal for signal, _ in LAP_AGGREGATES.values())
+        self.latest = {}
+        self.running = False
+        self.lap = None
+        # (seconds, value) of the last speed and power, to integrate them
+        self.last_speed = None
+        self.last_power = None
+
+    def update(self, timestamp, values):
+        """_summary_
+        Updates the current lap with the values of a frame.
+            Args:
+                timestamp (str): Time of the frame, 'YYYY-MM-DD HH:MM:SS.ffffff'.
+                values (list): The {name, value, unit, max} of the frame, derived signals included.
+            Returns:
+                list: The laps the frame ended, usually none (see new_lap for their keys).
+        """
+        changed = set()
+        for value in values:
+            if value["name"] in self.inputs:
+                number = numeric_value(value["value"])
+                if number is not None:
+                    self.latest[value["name"]] = number
+                    changed.add(value["name"])
+        # Nothing to do off track until RTD changes
+        if not changed or (self.lap is None and RTD_SIGNAL not in changed):
+            return []
+
+        seconds = datetime.datetime.fromisoformat(timestamp).timestamp()
+        laps = []
+        if RTD_SIGNAL in changed and bool(self.latest[RTD_SIGNAL]) != self.running:
+            # A stint ending part way round still records the partial lap
+            self.running = not self.running
+            if self.lap is not None:
+                laps.append(self.end_lap(timestamp, seconds, complete=False))
+            self.lap = self.new_lap(1, timestamp, seconds) if self.running else None
+            self.last_speed = None
+            self.last_power = None
+        if self.lap is None:
+            return laps
+
+        lap = self.lap
+        for key, (signal, pick) in LAP_AGGREGATES.items():
+            if signal in changed:
+                lap[key] = self.latest[signal] if lap[key] is None else pick(lap[key], self.latest[signal])
+        if POWER_SIGNAL in changed:
+            # kW over seconds, in kWh
+            lap["energy_used"] += integrate(self.last_power, seconds, self.latest[POWER_SIGNAL]) / 3600
+            self.last_power = (seconds, self.latest[POWER_SIGNAL])
+        if not changed.isdisjoint(WHEEL_SIGNALS):
+            wheels = [abs(self.latest[name]) for name in WHEEL_SIGNALS if name in self.latest]
+            speed = sum(wheels) / len(wheels) / 60 * self.wheel_circumference
+            lap["distance"] += integrate(self.last_speed, seconds, speed)
+            self.last_speed = (seconds, speed)
+            if lap["distance"] >= self.lap_length:
+                # The distance past the line counts towards the next lap
+                extra = lap["distance"] - self.lap_length
+                lap["distance"] = self.lap_length
+                laps.append(self.end_lap(timestamp, seconds, complete=True))
+                self.lap = self.new_lap(lap["number"] + 1, timestamp, seconds)
+                self.lap["distance"] = extra
+        return laps
+
+    def new_lap(self, number, timestamp, seconds):
+        """_summary_
+        Starts a lap, the keys are those of the laps returned by update.
+            Args:
+                number (int): Lap number within the stint, from 1.
+                timestamp (str): When the lap started.
+                seconds (float): The same as epoch seconds.
+        """
+        lap = {
+            "number": number,
+            "started_at": timestamp,
+            "ended_at": None,
+            "duration": 0.0,
+            "distance": 0.0,
+            "energy_used": 0.0,
+            "complete": False,
+            "start_seconds": seconds,
+        }
+        # Values already known at the start belong to this lap as well
+        for key, (signal, _) in LAP_AGGREGATES.items():
+            lap[key] = self.latest.get(signal)
+        return lap
+
+    def end_lap(self, timestamp, seconds, complete):
+        lap = self.lap
+        self.lap = None
+        lap["ended_at"] = timestamp
+        lap["duration"] = round(seconds - lap.pop("start_seconds"), 3)
+        lap["distance"] = round(lap["distance"], 1)
+        lap["energy_used"] = round(lap["energy_used"], 4)
+        lap["complete"] = complete
+        return lap
+
+
+def integrate(last, seconds, value):
+    """Returns the area (trapezoidal) since the last (seconds, value), none across gaps over MAX_GAP."""
+    if last is None or not 0 < seconds - last[0] <= MAX_GAP:
+        return 0.0
+    return (last[1] + value) / 2 * (seconds - last[0])
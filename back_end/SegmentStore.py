@@ -0,0 +1,387 @@
+"""
+File: SegmentStore.py
+Author: Hannah Murphy
+Date: 2024
+Description: An embedded storage backend for bench testing and trackside laptops,
+    so no PostgreSQL server is needed. Each signal is stored as append-only
+    column files of float64 times and values, split into fixed size segments
+    which are memory mapped for reading.
+
+Copyright (c) 2024 WESMO. All rights reserved.
+This code is part of the WESMO Data Acquisition and Visualisation Project.
+
+"""
+
+import os
+import json
+import mmap
+import datetime
+import threading
+from array import array
+import numpy as np
+from StorageBackend import StorageBackend, StorageUnavailable, StorageRejected, EXPORT_CHUNK_ROWS
+from database import rollup_resolution
+from downsample import latest_rows, window_rows, to_datetime
+
+""" GLOBAL VARIABLES
+Layout of the store directory:
+    signals.json            name -> id, source, pdo, unit and max
+    sessions.jsonl          one line per session opened or closed
+    laps.jsonl              one line per lap, with the session it was driven in
+    <signal id>/<n>.time    epoch seconds, float64
+    <signal id>/<n>.value   the values, float64 (NaN for no value)
+A segment holds SEGMENT_POINTS points (8 MiB per column) before the next is
+started. Times of a signal are expected to arrive in order, as they do from a
+single car, so segments are picked by their first and last times, read without
+mapping them, and a point within a segment is found by binary search. Every
+file written by a batch is synced before the batch is reported stored.
+"""
+SEGMENT_POINTS = 1 << 20
+POINT_BYTES = 8
+SIGNALS_FILE = "signals.json"
+SESSIONS_FILE = "sessions.jsonl"
+LAPS_FILE = "laps.jsonl"
+
+
+def epoch_seconds(timestamp):
+    return datetime.datetime.fromisoformat(timestamp).timestamp()
+
+
+class SegmentStore(StorageBackend):
+    def __init__(self, directory):
+        """_summary_
+            Args:
+                directory (str): Directory holding the store, created if missing.
+        """
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.signals = {}
+        self.writers = {}
+        self.maps = {}
+        # Path of a time column -> (points, first time, last time)
+        self.bounds = {}
+        os.makedirs(directory, exist_ok=True)
+        self.load_signals()
+        # The session left open by a previous run is resumed
+        self.session = self.load_sessions()[1]
+
+    """ WRITING """
+
+    def write_batch(self, rows, signal_meta):
+        """Appends the batch to the column files of each signal, in order."""
+        closed_sessions = []
+        columns = {}
+        try:
+            for row in rows:
+                if isinstance(row, dict) and "lap" in row:
+                    self.save_lap(row["lap"])
+                    continue
+                if isinstance(row, dict):
+                    closed_id = self.change_session(row["rtd"], epoch_seconds(row["time"]))
+                    if closed_id is not None:
+                        closed_sessions.append(closed_id)
+                    continue
+
+                seconds = epoch_seconds(row[0])
+                if self.session is None:
+                    self.change_session(False, seconds)
+                column = columns.get(row[1])
+                if column is None:
+                    column = columns[row[1]] = (array("d"), array("d"))
+                column[0].append(seconds)
+                column[1].append(float("nan") if row[2] is None else row[2])
+
+            for name, (times, values) in columns.items():
+                self.append(self.register(name, signal_meta), times, values)
+            # The subscriber records the frames as stored once this returns
+            for signal_id in {self.signals[name]["id"] for name in columns}:
+                writer = self.writers[signal_id]
+                sync(writer["time"])
+                sync(writer["value"])
+        except ValueError as e:
+            raise StorageRejected(e) from e
+        except OSError as e:
+            raise StorageUnavailable(e) from e
+        return closed_sessions
+
+    def register(self, name, signal_meta):
+        signal = self.signals.get(name)
+        if signal is None:
+            source, pdo, unit, maximum = signal_meta.get(name, ("", None, "", None))
+            signal = {"id": len(self.signals) + 1, "source": source, "pdo": pdo, "unit": unit, "max": maximum}
+            self.signals[name] = signal
+            os.makedirs(self.signal_dir(signal["id"]), exist_ok=True)
+            # Replaced atomically so readers never see a partial file
+            path = os.path.join(self.directory, SIGNALS_FILE)
+            with open(path + ".partial", "w") as f:
+                json.dump(self.signals, f)
+                sync(f)
+            os.replace(path + ".partial", path)
+        return signal["id"]
+
+    def append(self, signal_id, times, values):
+        writer = self.writers.get(signal_id) or self.open_writer(signal_id)
+        written = 0
+        while written < len(times):
+            if writer["count"] == SEGMENT_POINTS:
+                writer = self.open_writer(signal_id, writer["sequence"] + 1)
+            take = min(len(times) - written, SEGMENT_POINTS - writer["count"])
+            # Times are written first, a reader only uses points present in both files
+            writer["time"].write(times[written : written + take].tobytes())
+            writer["value"].write(values[written : written + take].tobytes())
+            writer["time"].flush()
+            writer["value"].flush()
+            writer["count"] += take
+            written += take
+
+    def open_writer(self, signal_id, sequence=None):
+        old = self.writers.pop(signal_id, None)
+        if old is not None:
+            # A full segment is synced here, the batch only syncs the segment it ends in
+            sync(old["time"])
+            sync(old["value"])
+            old["time"].close()
+            old["value"].close()
+
+        if sequence is None:
+            sequences = self.list_segments(signal_id)
+            sequence = sequences[-1] if sequences else 0
+        base = os.path.join(self.signal_dir(signal_id), f"{sequence:06d}")
+        time_file = open(base + ".time", "ab")
+        value_file = open(base + ".value", "ab")
+
+        # A crash between the two writes leaves the columns uneven, cut them back
+        count = min(time_file.tell(), value_file.tell()) // POINT_BYTES
+        for f in (time_file, value_file):
+            if f.tell() != count * POINT_BYTES:
+                f.truncate(count * POINT_BYTES)
+                f.seek(0, os.SEEK_END)
+
+        writer = {"sequence": sequence, "count": count, "time": time_file, "value": value_file}
+        self.writers[signal_id] = writer
+        return writer
+
+    def change_session(self, rtd, seconds):
+        """Closes the open session and starts a new one if the RTD state changed."""
+        if self.session is not None and self.session["rtd"] == rtd:
+            return None
+
+        closed_id = None
+        events = []
+        if self.session is not None:
+            closed_id = self.session["id"]
+            events.append({"id": closed_id, "ended_at": seconds})
+        self.session = {"id": (closed_id or self.last_session_id()) + 1, "started_at": seconds, "rtd": rtd}
+        events.append(self.session)
+        with open(os.path.join(self.directory, SESSIONS_FILE), "a") as f:
+            f.write("".join(json.dumps(event) + "\n" for event in events))
+            sync(f)
+        return closed_id
+
+    def save_lap(self, lap):
+        """Appends a lap, recorded against the session it started in, as database.save_lap."""
+        started = epoch_seconds(lap["started_at"])
+        sessions = [s for s in self.load_sessions()[0].values() if s.get("started_at", started + 1) <= started]
+        if not sessions:
+            return
+        session_id = max(sessions, key=lambda s: (s["started_at"], s["id"]))["id"]
+        session_laps = [stored for stored in self.load_laps() if stored["session"] == session_id]
+        if any(stored["started_at"] == lap["started_at"] for stored in session_laps):
+            return
+        number = max([lap["number"]] + [stored["number"] + 1 for stored in session_laps])
+        with open(os.path.join(self.directory, LAPS_FILE), "a") as f:
+            f.write(json.dumps(dict(lap, number=number, session=session_id)) + "\n")
+            sync(f)
+
+    def last_session_id(self):
+        sessions = self.load_sessions()[0]
+        return max(sessions) if sessions else 0
+
+    def close(self):
+        for writer in self.writers.values():
+            writer["time"].close()
+            writer["value"].close()
+        self.writers = {}
+        with self.lock:
+            self.maps = {}
+
+    """ READING """
+
+    def query_history(self, names, limit):
+        return latest_rows([(name, *self.read_latest(name, limit)) for name in names], limit)
+
+    def query_history_window(self, names, start, end, width):
+        resolution = rollup_resolution(start, end, width)
+        start, end = start.timestamp(), end.timestamp()
+        if resolution:
+            start = start // resolution * resolution
+        return resolution, window_rows([(name, *self.read_range(name, start, end)) for name in names], resolution)
+
+    def session_start(self, session_id=None):
+        sessions, open_session = self.load_sessions()
+        session = open_session if session_id is None else sessions.get(session_id)
+        return to_datetime(session["started_at"]) if session else None
+
+    def query_laps(self, session_id=None):
+        laps = {}
+        for lap in self.load_laps():
+            laps.setdefault((lap.pop("session"), lap["number"]), lap)
+        if session_id is None:
+            session_id = max((session for session, _ in laps), default=None)
+        session_laps = [lap for (session, _), lap in laps.items() if session == session_id]
+        for lap in session_laps:
+            lap["started_at"] = datetime.datetime.fromisoformat(lap["started_at"])
+            lap["ended_at"] = datetime.datetime.fromisoformat(lap["ended_at"])
+        return session_id, sorted(session_laps, key=lambda lap: lap["number"])
+
+    def load_laps(self):
+        laps = []
+        try:
+            with open(os.path.join(self.directory, LAPS_FILE)) as f:
+                for line in f:
+                    try:
+                        laps.append(json.loads(line))
+                    except ValueError:
+                        continue
+        except FileNotFoundError:
+            pass
+        return laps
+
+    def export_rows(self, names, start, end, chunk_size=EXPORT_CHUNK_ROWS):
+        for name in names:
+            times, values = self.read_range(name, start.timestamp(), end.timestamp())
+            for i in range(0, len(times), chunk_size):
+                yield window_rows([(name, times[i : i + chunk_size], values[i : i + chunk_size])], 0)
+
+    def read_latest(self, name, limit):
+        """Returns the last limit (times, values) of a signal, oldest first."""
+        signal = self.signal(name)
+        if signal is None:
+            return np.empty(0), np.empty(0)
+        parts = []
+        remaining = limit
+        for sequence in reversed(self.list_segments(signal["id"])):
+            times, values = self.segment(signal["id"], sequence)
+            take = min(remaining, len(times))
+            if take:
+                parts.insert(0, (times[len(times) - take :], values[len(values) - take :]))
+                remaining -= take
+            if remaining == 0:
+                break
+        return self.join(parts)
+
+    def read_range(self, name, start, end):
+        """Returns the (times, values) of a signal with start <= time < end."""
+        signal = self.signal(name)
+        if signal is None:
+            return np.empty(0), np.empty(0)
+        parts = []
+        for sequence in self.list_segments(signal["id"]):
+            bounds = self.segment_bounds(signal["id"], sequence)
+            # Only segments overlapping the range are mapped
+            if bounds is None or bounds[1] < start or bounds[0] >= end:
+                continue
+            times, values = self.segment(signal["id"], sequence)
+            lo, hi = np.searchsorted(times, (start, end), side="left")
+            if hi > lo:
+                parts.append((times[lo:hi], values[lo:hi]))
+        return self.join(parts)
+
+    def segment_bounds(self, signal_id, sequence):
+        """_summary_
+        Returns the first and last time of a segment, read from the time column
+        without mapping it, or None if the segment is empty.
+        """
+        path = os.path.join(self.signal_dir(signal_id), f"{sequence:06d}")
+        try:
+            count = min(os.path.getsize(path + ".time"), os.path.getsize(path + ".value")) // POINT_BYTES
+            if count == 0:
+                return None
+            cached = self.bounds.get(path)
+            if cached is None or cached[0] != count:
+                with open(path + ".time", "rb") as f:
+                    first = f.read(POINT_BYTES)
+                    f.seek((count - 1) * POINT_BYTES)
+                    last = f.read(POINT_BYTES)
+                cached = (count, *np.frombuffer(first + last, dtype=np.float64))
+                self.bounds[path] = cached
+        except OSError:
+            return None
+        return cached[1], cached[2]
+
+    def segment(self, signal_id, sequence):
+        """_summary_
+        Returns the (times, values) of a segment as arrays over the memory mapped
+        files, without copying. A segment still being appended to is mapped
+        again whenever it has grown.
+        """
+        base = os.path.join(self.signal_dir(signal_id), f"{sequence:06d}")
+        try:
+            count = min(os.path.getsize(base + ".time"), os.path.getsize(base + ".value")) // POINT_BYTES
+        except OSError:
+            count = 0
+        columns = []
+        with self.lock:
+            for suffix in (".time", ".value"):
+                cached = self.maps.get(base + suffix)
+                if cached is None or cached[0] < count:
+                    # The old map is left to close once no array refers to it
+                    if count == 0:
+                        return np.empty(0), np.empty(0)
+                    with open(base + suffix, "rb") as f:
+                        cached = (count, mmap.mmap(f.fileno(), count * POINT_BYTES, access=mmap.ACCESS_READ))
+                    self.maps[base + suffix] = cached
+                columns.append(np.frombuffer(cached[1], dtype=np.float64, count=count))
+        return columns[0], columns[1]
+
+    def join(self, parts):
+        if not parts:
+            return np.empty(0), np.empty(0)
+        if len(parts) == 1:
+            return parts[0]
+        return np.concatenate([p[0] for p in parts]), np.concatenate([p[1] for p in parts])
+
+    def signal(self, name):
+        # Signals first seen by the subscriber after this process loaded the file
+        if name not in self.signals:
+            self.load_signals()
+        return self.signals.get(name)
+
+    def load_signals(self):
+        try:
+            with open(os.path.join(self.directory, SIGNALS_FILE)) as f:
+                self.signals = json.load(f)
+        except FileNotFoundError:
+            self.signals = {}
+
+    def load_sessions(self):
+        """Returns every session by id and the open session, or None."""
+        sessions = {}
+        try:
+            with open(os.path.join(self.directory, SESSIONS_FILE)) as f:
+                for line in f:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        continue
+                    sessions.setdefault(event["id"], {}).update(event)
+        except FileNotFoundError:
+            pass
+        open_sessions = [s for s in sessions.values() if "ended_at" not in s and "started_at" in s]
+        return sessions, max(open_sessions, key=lambda s: s["id"]) if open_sessions else None
+
+    def list_segments(self, signal_id):
+        try:
+            names = os.listdir(self.signal_dir(signal_id))
+        except FileNotFoundError:
+            return []
+        return sorted(int(name[:-5]) for name in names if name.endswith(".time"))
+
+    def signal_dir(self, signal_id):
+        return os.path.join(self.directory, str(signal_id))
+
+
+def sync(f):
+    """Writes a file's buffer out and waits for it to reach the disk."""
+    f.flush()
+    os.fsync(f.fileno())
@@ -0,0 +1,145 @@
+"""
+File: SessionArchiver.py
+Author: Hannah Murphy
+Date: 2024
+Description: Archives closed sessions to compressed Parquet files from a background
+    thread, then drops the day partitions of TELEMETRY which are fully archived
+    and older than the retention period.
+
+Copyright (c) 2024 WESMO. All rights reserved.
+This code is part of the WESMO Data Acquisition and Visualisation Project.
+
+"""
+
+import os
+import queue
+import datetime
+import threading
+import psycopg2
+import pyarrow as pa
+import pyarrow.parquet as pq
+from database import unarchived_sessions, mark_session_archived, drop_archived_partitions
+
+""" GLOBAL VARIABLES
+Rows are assigned to a session in the order they arrive, so a frame can be
+stamped slightly outside of its session's start and end. The archive query
+looks this far either side of the session so partitions can still be pruned.
+"""
+SESSION_TIME_MARGIN = datetime.timedelta(hours=1)
+FETCH_SIZE = 50000
+RESCAN_INTERVAL = 600
+
+ARCHIVE_SCHEMA = pa.schema(
+    [
+        ("time", pa.timestamp("us", tz="UTC")),
+        ("signal", pa.dictionary(pa.int16(), pa.string())),
+        ("value", pa.float64()),
+    ]
+)
+
+
+class SessionArchiver:
+    def __init__(self, connect, archive_dir, retention_days=7):
+        """_summary_
+            Args:
+                connect (function): Returns a new (cursor, conn) pair for the wesmo database.
+                archive_dir (str): Directory the session Parquet files are written to.
+                retention_days (int): Days of raw telemetry kept in the database.
+        """
+        self.connect = connect
+        self.archive_dir = archive_dir
+        self.retention_days = retention_days
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+        os.makedirs(archive_dir, exist_ok=True)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="session-archiver", daemon=True)
+        self.thread.start()
+
+    def session_closed(self, session_id):
+        """Called by the database writer once a session has been closed."""
+        self.queue.put(session_id)
+
+    def run(self):
+        while True:
+            # Sessions which failed to archive are picked up by the next rescan
+            self.archive_pending()
+            try:
+                self.queue.get(timeout=RESCAN_INTERVAL)
+            except queue.Empty:
+                pass
+
+    def archive_pending(self):
+        try:
+            cursor, conn = self.connect()
+        except psycopg2.Error as e:
+            print(f"{datetime.datetime.now()} -! # Session archiver failed to connect: {e}")
+            return
+
+        try:
+            conn.autocommit = False
+            for session_id, started_at, ended_at in unarchived_sessions(cursor):
+                conn.commit()
+                self.archive_session(cursor, conn, session_id, started_at, ended_at)
+
+            dropped = drop_archived_partitions(cursor, self.retention_days)
+            conn.commit()
+            if dropped:
+                print(f"{datetime.datetime.now()} - # Dropped archived partitions: {', '.join(dropped)}")
+        except (psycopg2.Error, OSError) as e:
+            conn.rollback()
+            print(f"{datetime.datetime.now()} -! # Error archiving sessions: {e}")
+        finally:
+            conn.close()
+
+    def archive_session(self, cursor, conn, session_id, started_at, ended_at):
+        """_summary_
+        Streams the rows of one session into a Parquet file and records its path.
+        The session row stays locked while exporting so a second subscriber
+        instance skips it rather than archiving it twice.
+        """
+        cursor.execute(
+            "SELECT ID FROM SESSION WHERE ID = %s AND ARCHIVE_PATH IS NULL FOR UPDATE SKIP LOCKED",
+            (session_id,),
+        )
+        if cursor.fetchone() is None:
+            conn.rollback()
+            return
+
+        path = os.path.join(self.archive_dir, f"session-{session_id:06d}.parquet")
+        partial_path = path + ".partial"
+        rows = conn.cursor(name=f"archive_session_{session_id}")
+        rows.itersize = FETCH_SIZE
+        rows.execute(
+            """SELECT t.TIME, s.NAME, t.VALUE FROM TELEMETRY t
+            JOIN SIGNAL s ON s.ID = t.SIGNAL_ID
+            WHERE t.SESSION_ID = %s AND t.TIME BETWEEN %s AND %s
+            ORDER BY t.TIME""",
+            (session_id, started_at - SESSION_TIME_MARGIN, ended_at + SESSION_TIME_MARGIN),
+        )
+
+        count = 0
+        with pq.ParquetWriter(partial_path, ARCHIVE_SCHEMA, compression="zstd") as writer:
+            while True:
+                batch = rows.fetchmany(FETCH_SIZE)
+                if not batch:
+                    break
+                times, names, values = zip(*batch)
+                writer.write_table(
+                    pa.table(
+                        [
+                            pa.array(times, pa.timestamp("us", tz="UTC")),
+                            pa.array(names, pa.string()).dictionary_encode().cast(ARCHIVE_SCHEMA.field("signal").type),
+                            pa.array(values, pa.float64()),
+                        ],
+                        schema=ARCHIVE_SCHEMA,
+                    )
+                )
+                count += len(batch)
+        rows.close()
+
+        os.replace(partial_path, path)
+        mark_session_archived(cursor, session_id, path)
+        conn.commit()
+        print(f"{datetime.datetime.now()} - # Archived session {session_id} ({count} rows) to {path}")
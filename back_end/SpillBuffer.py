@@ -0,0 +1,164 @@
+"""
+File: SpillBuffer.py
+Author: Hannah Murphy
+Date: 2024
+Description: A durable, append-only on disk buffer for batches of rows which
+    the database could not accept in time. Batches are written as JSON lines
+    into numbered segment files and handed back oldest first for replay.
+
+Copyright (c) 2024 WESMO. All rights reserved.
+This code is part of the WESMO Data Acquisition and Visualisation Project.
+
+"""
+
+import os
+import json
+import time
+import datetime
+import threading
+
+SEGMENT_PREFIX = "spill-"
+SEGMENT_SUFFIX = ".seg"
+
+
+class SpillBuffer:
+    def __init__(self, directory, segment_bytes=8 * 1024 * 1024):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        # Segments left over from a previous run are replayed first
+        self.segments = sorted(
+            name
+            for name in os.listdir(directory)
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX)
+        )
+        self.next_sequence = (
+            int(self.segments[-1][len(SEGMENT_PREFIX) : -len(SEGMENT_SUFFIX)]) + 1
+            if self.segments
+            else 0
+        )
+        self.bytes_pending = sum(
+            os.path.getsize(os.path.join(directory, name)) for name in self.segments
+        )
+        self.active_file = None
+        self.replay_segment = None
+        self.replay_batches = []
+        self.replay_position = 0
+
+        if self.segments:
+            print(
+                f"{datetime.datetime.now()} - # Found {len(self.segments)} spill segments to replay ({self.bytes_pending} bytes)"
+            )
+
+    def has_pending(self):
+        return bool(self.segments)
+
+    def append(self, batch):
+        """_summary_
+        Appends a batch to the active segment and syncs it to disk.
+            Args:
+                batch (dict): JSON serialisable batch, must contain 'queued_at'.
+        """
+        line = (json.dumps(batch, default=str) + "\n").encode()
+        with self.lock:
+            if self.active_file is None or self.active_file.tell() >= self.segment_bytes:
+                self.roll_segment()
+            self.active_file.write(line)
+            self.active_file.flush()
+            os.fsync(self.active_file.fileno())
+            self.bytes_pending += len(line)
+
+    def roll_segment(self):
+        if self.active_file is not None:
+            self.active_file.close()
+        name = f"{SEGMENT_PREFIX}{self.next_sequence:010d}{SEGMENT_SUFFIX}"
+        self.next_sequence += 1
+        self.active_file = open(os.path.join(self.directory, name), "ab")
+        self.segments.append(name)
+
+    def peek(self):
+        """_summary_
+        Returns the oldest batch not yet replayed, or None if the buffer is empty.
+        The active segment is closed first so it is never read while being written.
+        """
+        with self.lock:
+            if self.replay_position >= len(self.replay_batches):
+                if not self.load_oldest_segment():
+                    return None
+            return self.replay_batches[self.replay_position]
+
+    def commit(self):
+        """Marks the batch returned by peek() as replayed, removing its segment once drained."""
+        with self.lock:
+            self.replay_position += 1
+            if self.replay_position < len(self.replay_batches):
+                return
+            path = os.path.join(self.directory, self.replay_segment)
+            self.bytes_pending -= os.path.getsize(path)
+            os.remove(path)
+            self.segments.remove(self.replay_segment)
+            self.replay_segment = None
+            self.replay_batches = []
+            self.replay_position = 0
+
+    def load_oldest_segment(self):
+        while self.segments:
+            name = self.segments[0]
+            if self.active_file is not None and self.active_file.name.endswith(name):
+                self.active_file.close()
+                self.active_file = None
+
+            batches = []
+            with open(os.path.join(self.directory, name), "rb") as f:
+                for line in f:
+                    try:
+                        batches.append(json.loads(line))
+                    except ValueError:
+                        # A torn final line from a crash mid-write
+                        print(f"{datetime.datetime.now()} -! # Skipping corrupt line in spill segment {name}")
+
+            if batches:
+                self.replay_segment = name
+                self.replay_batches = batches
+                self.replay_position = 0
+                return True
+
+            self.bytes_pending -= os.path.getsize(os.path.join(self.directory, name))
+            os.remove(os.path.join(self.directory, name))
+            self.segments.pop(0)
+        return False
+
+    def segment_count(self):
+        return len(self.segments)
+
+    def size_bytes(self):
+        return self.bytes_pending
+
+    def lag_seconds(self):
+        """Age of the oldest batch still waiting to be replayed, worked out afresh on every call."""
+        with self.lock:
+            if not self.segments:
+                return 0
+            name = self.segments[0]
+            if name == self.replay_segment and self.replay_position < len(self.replay_batches):
+                oldest = self.replay_batches[self.replay_position]["queued_at"]
+            else:
+                oldest = self.first_queued_at(name)
+        return round(time.time() - oldest, 3)
+
+    def first_queued_at(self, name):
+        # The first batch of a segment, or when it was last written if that can't be read
+        path = os.path.join(self.directory, name)
+        try:
+            with open(path, "rb") as f:
+                return json.loads(f.readline())["queued_at"]
+        except (ValueError, KeyError):
+            return os.path.getmtime(path)
+
+    def close(self):
+        with self.lock:
+            if self.active_file is not None:
+                self.active_file.close()
+                self.active_file = None
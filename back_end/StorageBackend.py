@@ -0,0 +1,421 @@
+"""
+File: StorageBackend.py
+Author: Hannah Murphy
+Date: 2024
+Description: The interface between the backend and wherever telemetry is stored.
+    The database writer hands each batch of rows to a backend and the history
+    queries read through one, so PostgreSQL can be swapped for the embedded
+    segment store (see SegmentStore.py) by setting WESMO_STORAGE.
+
+Copyright (c) 2024 WESMO. All rights reserved.
+This code is part of the WESMO Data Acquisition and Visualisation Project.
+
+"""
+
+import os
+import time
+import uuid
+import datetime
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+import psycopg2
+from psycopg2.extras import execute_values
+from database import (
+    start_postgresql,
+    setup_db,
+    connect_to_db,
+    create_telemetry_tables,
+    create_telemetry_partition,
+    upsert_signal,
+    current_session,
+    change_session,
+    save_rollups,
+    save_lap,
+    query_laps,
+    query_history,
+    query_history_window,
+    query_export,
+    session_start,
+)
+
+""" GLOBAL VARIABLES
+WESMO_STORAGE is 'postgres' (default) or 'segment', the segment store keeps
+its files in WESMO_SEGMENT_DIR.
+"""
+STORAGE = os.environ.get("WESMO_STORAGE", "postgres")
+SEGMENT_DIR = os.environ.get("WESMO_SEGMENT_DIR", "segments")
+
+# Reads (history requests) use a pool of at most WESMO_DB_POOL_SIZE connections
+# per process, waiting up to WESMO_DB_CHECKOUT_TIMEOUT seconds for a free one
+POOL_SIZE = int(os.environ.get("WESMO_DB_POOL_SIZE", 4))
+CHECKOUT_TIMEOUT = float(os.environ.get("WESMO_DB_CHECKOUT_TIMEOUT", 5))
+
+# Exports have WESMO_EXPORT_CONNECTIONS connections of their own, so they never
+# hold up history requests, and are read EXPORT_CHUNK_ROWS rows at a time. A
+# fetch may scan a long range, so it has WESMO_EXPORT_STATEMENT_TIMEOUT_MS
+# rather than the statement timeout of the history requests
+EXPORT_CONNECTIONS = int(os.environ.get("WESMO_EXPORT_CONNECTIONS", 2))
+EXPORT_STATEMENT_TIMEOUT_MS = int(os.environ.get("WESMO_EXPORT_STATEMENT_TIMEOUT_MS", 300000))
+EXPORT_CHUNK_ROWS = 10000
+
+INSERT_SQL = "INSERT INTO TELEMETRY(TIME, VALUE, SESSION_ID, SIGNAL_ID) VALUES %s"
+
+
+class StorageUnavailable(Exception):
+    """The batch couldn't be stored right now, it is spilled and retried later."""
+
+
+class StorageRejected(Exception):
+    """The batch can never be stored, retrying it would fail the same way."""
+
+
+class StorageBackend(ABC):
+    """_summary_
+    Methods every storage backend implements. Rows are (time, signal name, value)
+    with time as 'YYYY-MM-DD HH:MM:SS.ffffff' local time, batches may also hold
+    {"time", "rtd"} markers which start a new session from that point on and
+    {"time", "lap"} markers of laps to record (see LapTracker.py).
+    """
+
+    def setup(self):
+        """Creates whatever the backend needs before the first write."""
+
+    def ready(self):
+        """Returns False while the backend can't be written to, so batches are spilled."""
+        return True
+
+    @abstractmethod
+    def write_batch(self, rows, signal_meta):
+        """_summary_
+        Stores every row of the batch, in order.
+            Args:
+                rows (list): Rows and session markers.
+                signal_meta (dict): (source, pdo, unit, max) by signal name.
+            Returns:
+                list: Ids of the sessions closed by the batch.
+        """
+
+    @abstractmethod
+    def query_history(self, names, limit):
+        """Returns the latest (time, value, name) rows of the given signals, newest first."""
+
+    @abstractmethod
+    def query_history_window(self, names, start, end, width):
+        """Returns (resolution, rows) as database.query_history_window does."""
+
+    @abstractmethod
+    def session_start(self, session_id=None):
+        """Returns when the given session, or the open session, started."""
+
+    @abstractmethod
+    def query_laps(self, session_id=None):
+        """Returns (session id, laps) for the given session, or the latest one with laps."""
+
+    @abstractmethod
+    def export_rows(self, names, start, end, chunk_size=EXPORT_CHUNK_ROWS):
+        """_summary_
+        Yields every raw row of the given signals between start and end, one
+        signal after the other and oldest first, holding only one chunk in
+        memory at a time. Closing the generator stops the export.
+            Returns:
+                generator: Lists of up to chunk_size (time, value, name) rows.
+        """
+
+    def close(self):
+        pass
+
+
+class ConnectionPool:
+    """_summary_
+    A bounded pool of PostgreSQL connections shared by the handlers of a
+    process, each request checks one out for as long as it runs. Connections
+    are opened when first needed, checked with a trivial query when they have
+    been idle for a while, and replaced after a failure.
+    """
+
+    def __init__(
+        self,
+        connect=connect_to_db,
+        size=POOL_SIZE,
+        statement_timeout_ms=2000,
+        checkout_timeout=CHECKOUT_TIMEOUT,
+        health_check_interval=30,
+    ):
+        """_summary_
+            Args:
+                connect (function): Returns a new (cursor, conn) pair for the wesmo database.
+                size (int): Most connections open at once.
+                statement_timeout_ms (int): Queries slower than this are cancelled by the server.
+                checkout_timeout (float): Seconds to wait for a free connection.
+                health_check_interval (float): Seconds idle after which a connection is checked before use.
+        """
+        self.connect = connect
+        self.size = size
+        self.statement_timeout_ms = statement_timeout_ms
+        self.checkout_timeout = checkout_timeout
+        self.health_check_interval = health_check_interval
+        self.slots = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+        self.idle = []
+
+    @contextmanager
+    def connection(self):
+        """_summary_
+        Checks a connection out for the body of a with block and yields its
+        cursor. The transaction is committed at the end of the block, or rolled
+        back if it raised (or was abandoned, e.g. a closed generator).
+            Raises:
+                StorageUnavailable: No connection was free in time or none could be opened.
+        """
+        if not self.slots.acquire(timeout=self.checkout_timeout):
+            raise StorageUnavailable("no free database connection")
+        try:
+            cursor, conn = self.checkout()
+            try:
+                yield cursor
+                conn.commit()
+            except BaseException:
+                self.rollback(conn)
+                raise
+            finally:
+                self.checkin(cursor, conn)
+        finally:
+            self.slots.release()
+
+    def checkout(self):
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                cursor, conn, last_used = self.idle.pop()
+            if conn.closed:
+                continue
+            if time.monotonic() - last_used < self.health_check_interval:
+                return cursor, conn
+            try:
+                cursor.execute("SELECT 1")
+                conn.commit()
+                return cursor, conn
+            except psycopg2.Error:
+                print(f"{datetime.datetime.now()} -! # Dropping a broken pooled connection")
+                self.rollback(conn)
+
+        try:
+            cursor, conn = self.connect()
+            conn.autocommit = False
+            cursor.execute(f"SET statement_timeout = {int(self.statement_timeout_ms)}")
+            conn.commit()
+            return cursor, conn
+        except psycopg2.Error as e:
+            raise StorageUnavailable(e) from e
+
+    def checkin(self, cursor, conn):
+        if conn.closed:
+            return
+        with self.lock:
+            self.idle.append((cursor, conn, time.monotonic()))
+
+    def rollback(self, conn):
+        # A connection which can't even roll back is broken, it is not reused
+        try:
+            conn.rollback()
+        except Exception:
+            conn.close()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for _, conn, _ in idle:
+            conn.close()
+
+
+class PostgresBackend(StorageBackend):
+    def __init__(self, connect=connect_to_db, statement_timeout_ms=2000, reconnect_interval=5, pool_size=POOL_SIZE):
+        """_summary_
+            Args:
+                connect (function): Returns a new (cursor, conn) pair for the wesmo database.
+                statement_timeout_ms (int): A statement slower than this is treated as a failure.
+                reconnect_interval (float): Seconds between reconnection attempts.
+                pool_size (int): Most connections used for reads at once.
+        """
+        self.connect = connect
+        self.statement_timeout_ms = statement_timeout_ms
+        self.reconnect_interval = reconnect_interval
+        self.cursor = None
+        self.conn = None
+        self.signal_ids = {}
+        self.partitions = set()
+        self.session_id = None
+        self.last_connect_attempt = 0
+        # Writes use the connection above, reads a pool so concurrent history
+        # requests don't wait for each other or for the writer
+        self.pool = ConnectionPool(connect, pool_size, statement_timeout_ms)
+        self.export_pool = ConnectionPool(connect, EXPORT_CONNECTIONS, EXPORT_STATEMENT_TIMEOUT_MS)
+
+    def setup(self):
+        cursor, conn = start_postgresql()
+        setup_db(cursor, conn)
+        conn.close()
+        cursor, conn = self.connect()
+        create_telemetry_tables(cursor, conn)
+        conn.close()
+
+    def ready(self):
+        if self.conn is not None and not self.conn.closed:
+            return True
+        if time.time() - self.last_connect_attempt < self.reconnect_interval:
+            return False
+
+        self.last_connect_attempt = time.time()
+        try:
+            self.cursor, self.conn = self.connect()
+            self.conn.autocommit = False
+            self.cursor.execute(f"SET statement_timeout = {int(self.statement_timeout_ms)}")
+            self.conn.commit()
+            print(f"{datetime.datetime.now()} - # Connected to PostgreSQL")
+            return True
+        except psycopg2.Error as e:
+            print(f"{datetime.datetime.now()} -! # Failed to connect to PostgreSQL: {e}")
+            self.cursor, self.conn = None, None
+            return False
+
+    def write_batch(self, rows, signal_meta):
+        """Inserts every row of the batch in a single transaction."""
+        if not self.ready():
+            raise StorageUnavailable("not connected")
+
+        closed_sessions = []
+        try:
+            values = []
+            for row in rows:
+                if isinstance(row, dict) and "lap" in row:
+                    self.current_session_id(row["time"])
+                    save_lap(self.cursor, row["lap"])
+                    continue
+                if isinstance(row, dict):
+                    # Rows are recorded against the session open when they arrived
+                    self.session_id, closed_id = change_session(self.cursor, row["rtd"], row["time"])
+                    if closed_id is not None:
+                        closed_sessions.append(closed_id)
+                    continue
+
+                if row[0][:10] not in self.partitions:
+                    create_telemetry_partition(self.cursor, row[0][:10])
+                    self.partitions.add(row[0][:10])
+                values.append((row[0], row[2], self.current_session_id(row[0]), self.signal_id(row[1], signal_meta)))
+
+            execute_values(self.cursor, INSERT_SQL, values, page_size=max(len(values), 1))
+            save_rollups(self.cursor, values)
+            self.conn.commit()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            # Lost connections, timeouts and deadlocks, the same rows succeed later
+            self.reset_connection()
+            raise StorageUnavailable(e) from e
+        except psycopg2.Error as e:
+            # Anything else (bad values, constraint violations) fails every time,
+            # the connection is still good so the writer can retry part of the batch
+            try:
+                self.conn.rollback()
+                self.forget_transaction()
+            except psycopg2.Error:
+                self.reset_connection()
+            raise StorageRejected(f"{e.pgcode}: {e}") from e
+        except Exception:
+            # Never leave part of the batch in a transaction the next batch commits
+            self.reset_connection()
+            raise
+        return closed_sessions
+
+    def current_session_id(self, time):
+        # Resume the session left open by a previous run, or start one
+        if self.session_id is None:
+            session = current_session(self.cursor)
+            if session is None:
+                self.session_id, _ = change_session(self.cursor, False, time)
+            else:
+                self.session_id = session[0]
+        return self.session_id
+
+    def signal_id(self, name, signal_meta):
+        signal_id = self.signal_ids.get(name)
+        if signal_id is None:
+            source, pdo, unit, maximum = signal_meta.get(name, ("", None, "", None))
+            signal_id = upsert_signal(self.cursor, name, source, pdo, unit, maximum)
+            self.signal_ids[name] = signal_id
+        return signal_id
+
+    def query_history(self, names, limit):
+        return self.read(query_history, names, limit)
+
+    def query_history_window(self, names, start, end, width):
+        return self.read(query_history_window, names, start, end, width)
+
+    def session_start(self, session_id=None):
+        return self.read(session_start, session_id)
+
+    def query_laps(self, session_id=None):
+        return self.read(query_laps, session_id)
+
+    def export_rows(self, names, start, end, chunk_size=EXPORT_CHUNK_ROWS):
+        # Rows are fetched through a server side cursor, which is closed with the
+        # transaction when the generator finishes or is closed early
+        try:
+            with self.export_pool.connection() as cursor:
+                for name in names:
+                    rows = cursor.connection.cursor(name=f"export_{uuid.uuid4().hex}")
+                    query_export(rows, name, start, end)
+                    while True:
+                        chunk = rows.fetchmany(chunk_size)
+                        if not chunk:
+                            break
+                        yield chunk
+                    rows.close()
+        except psycopg2.Error as e:
+            raise StorageUnavailable(e) from e
+
+    def read(self, query, *args):
+        # Reads end their transaction straight away so the connection is never
+        # left idle in a transaction between requests.
+        with self.pool.connection() as cursor:
+            return query(cursor, *args)
+
+    def reset_connection(self):
+        # Drop the connection after any failure, a rolled back or broken
+        # session is simply replaced on the next attempt.
+        try:
+            self.conn.rollback()
+            self.conn.close()
+        except Exception:
+            pass
+        self.cursor, self.conn = None, None
+        self.forget_transaction()
+
+    def forget_transaction(self):
+        # Anything created in the failed transaction was rolled back with it
+        self.signal_ids = {}
+        self.partitions = set()
+        self.session_id = None
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.cursor, self.conn = None, None
+        self.pool.close()
+        self.export_pool.close()
+
+
+def open_storage():
+    """_summary_
+    Returns the storage backend selected by WESMO_STORAGE. Each caller gets its
+    own instance. Its reads may come from several threads or greenlets at once,
+    the websocket server shares one instance between all its requests, but only
+    one thread (the database writer's) may write to it.
+    """
+    if STORAGE == "segment":
+        from SegmentStore import SegmentStore
+
+        return SegmentStore(SEGMENT_DIR)
+    if STORAGE != "postgres":
+        print(f"{datetime.datetime.now()} -! # Unknown WESMO_STORAGE '{STORAGE}', using postgres")
+    return PostgresBackend()
@@ -54,3 +54,11 @@ class TrackTimer:
             timer_display = self.format_elapsed_time(elapsed_time)
 
         return [{"name": "Track Time", "value": timer_display, "unit": "", "max": ""}]
+
+    def state(self):
+        """Returns the timer as a dictionary, to share it with the other websocket workers."""
+        return {"timer_started": self.timer_started, "start_time": self.start_time}
+
+    def load_state(self, state):
+        self.timer_started = state["timer_started"]
+        self.start_time = state["start_time"]
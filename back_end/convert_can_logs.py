@@ -0,0 +1,288 @@
+"""
+File: convert_can_logs.py
+Author: Hannah Murphy
+Date: 2024
+Description: Converts raw CAN logs into columns for post-session analysis. Reads the
+    logs written by raw_can_collector.py, the captures in raspberry-pi/data and
+    candump logs, and writes one memory mappable .npy file per signal with an
+    index of every CAN id. Logs are parsed in parallel by a process pool, in
+    chunks so a single large log is split between the processes too, and the
+    signals of each message are decoded for all its frames at once with numpy.
+
+    python convert_can_logs.py raw_can_*.txt --out columns
+
+    Loading a signal afterwards takes no parsing at all:
+    times, values = load_signal("columns", "Pack_SOC")
+
+Copyright (c) 2024 WESMO. All rights reserved.
+This code is part of the WESMO Data Acquisition and Visualisation Project.
+
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import binascii
+import datetime
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import cantools
+
+""" GLOBAL VARIABLES
+Logs are split into chunks of CHUNK_BYTES for the processes. Layout of the
+output directory:
+    index.json              every CAN id and signal, see write_index
+    <id>/time.npy           frame times of the id as epoch seconds, float64
+    <id>/data.npy           the frames' data, uint8 with 8 columns (zero padded)
+    <id>/dl.npy             the frames' data length, uint8
+    <id>/<signal>.npy       a decoded signal of the id's message, float64
+"""
+DBC_FILES = ["dbc/EV24.dbc", "dbc/bms.dbc"]
+CHUNK_BYTES = 16 * 2**20
+INDEX_FILE = "index.json"
+
+
+""" PARSING """
+
+
+def parse_line(line):
+    """_summary_
+    Parses one logged frame, as printed by python-can
+    ('Timestamp: 1718756828.879031  ID: 0181  S Rx  DL:  8  27 00 c6 ...  Channel: can0')
+    or by candump -L ('(1718756828.879031) can0 181#2700C6') or candump -t a
+    ('(1718756828.879031)  can0  181   [8]  27 00 C6 ...').
+        Args:
+            line (bytes): The line, as read from the log.
+        Returns:
+            tuple: (time, id, data length, data) or None if the line isn't a frame.
+    """
+    fields = line.split()
+    if len(fields) < 3:
+        return None
+    if fields[0] == b"Timestamp:":
+        dl_at = fields.index(b"DL:")
+        dl = int(fields[dl_at + 1])
+        return float(fields[1]), int(fields[3], 16), dl, binascii.unhexlify(b"".join(fields[dl_at + 2 : dl_at + 2 + dl]))
+    if fields[0].startswith(b"("):
+        if b"#" in fields[2]:
+            can_id, data = fields[2].split(b"#", 1)
+            data = binascii.unhexlify(data)
+            return float(fields[0][1:-1]), int(can_id, 16), len(data), data
+        dl = int(fields[3].strip(b"[]"))
+        return float(fields[0][1:-1]), int(fields[2], 16), dl, binascii.unhexlify(b"".join(fields[4 : 4 + dl]))
+    return None
+
+
+def parse_chunk(path, start, end):
+    """_summary_
+    Parses the lines of a log starting between the start and end byte offsets,
+    run in the process pool.
+        Returns:
+            tuple: (times, ids, data lengths, data as n x 8 uint8, lines skipped)
+    """
+    times, ids, dls = array("d"), array("I"), array("B")
+    payload = bytearray()
+    skipped = 0
+    with open(path, "rb") as f:
+        # A chunk starts at the first whole line, the previous chunk reads the line cut in two
+        if start:
+            f.seek(start - 1)
+            f.readline()
+        position = f.tell()
+        while position < end:
+            line = f.readline()
+            if not line:
+                break
+            position += len(line)
+            try:
+                frame = parse_line(line)
+            except (ValueError, IndexError, binascii.Error):
+                frame = None
+            if frame is None or frame[2] > 8 or len(frame[3]) != frame[2]:
+                skipped += bool(line.strip())
+                continue
+            times.append(frame[0])
+            ids.append(frame[1])
+            dls.append(frame[2])
+            payload += frame[3].ljust(8, b"\0")
+    data = np.frombuffer(bytes(payload), dtype=np.uint8).reshape(-1, 8)
+    return np.frombuffer(times, dtype=np.float64), np.frombuffer(ids, dtype=np.uint32), np.frombuffer(dls, dtype=np.uint8), data, skipped
+
+
+def log_chunks(paths, chunk_bytes=CHUNK_BYTES):
+    """Returns the (path, start, end) chunks the logs are parsed in, in order."""
+    chunks = []
+    for path in paths:
+        size = os.path.getsize(path)
+        for start in range(0, max(size, 1), chunk_bytes):
+            chunks.append((path, start, min(start + chunk_bytes, size)))
+    return chunks
+
+
+""" DECODING """
+
+
+def decode_signal(data, signal):
+    """_summary_
+    Decodes a signal from every frame of its message at once.
+        Args:
+            data (np.ndarray): The frames' data, n x 8 uint8.
+            signal (cantools Signal): The signal, from the DBC.
+        Returns:
+            np.ndarray: The scaled values, float64.
+    """
+    mask = np.uint64((1 << signal.length) - 1)
+    if signal.byte_order == "little_endian":
+        words = data.view("<u8")[:, 0]
+        raw = (words >> np.uint64(signal.start)) & mask
+    else:
+        # The start bit is the most significant bit, numbered 7..0 within each byte
+        msb = signal.start // 8 * 8 + 7 - signal.start % 8
+        words = data.view(">u8")[:, 0]
+        raw = (words >> np.uint64(64 - msb - signal.length)) & mask
+    values = raw.astype(np.float64)
+    if signal.is_signed:
+        values[raw >= np.uint64(1 << (signal.length - 1))] -= float(1 << signal.length)
+    return values * signal.scale + signal.offset
+
+
+def group_by_id(times, ids):
+    """Returns (id, frame positions) for every CAN id, the positions in time order."""
+    order = np.lexsort((times, ids))
+    boundaries = np.flatnonzero(np.diff(ids[order])) + 1
+    return [(int(ids[group[0]]), group) for group in np.split(order, boundaries) if len(group)]
+
+
+def write_columns(out_dir, times, ids, dls, data, database):
+    """_summary_
+    Writes the frames of each CAN id, and the signals of those the DBC
+    describes, as .npy files.
+        Returns:
+            tuple: (ids, signals) for the index, see write_index.
+    """
+    id_index, signal_index = {}, {}
+    for can_id, group in group_by_id(times, ids):
+        name = f"{can_id:03x}"
+        directory = os.path.join(out_dir, name)
+        os.makedirs(directory, exist_ok=True)
+        frame_data = np.ascontiguousarray(data[group])
+        np.save(os.path.join(directory, "time.npy"), times[group])
+        np.save(os.path.join(directory, "data.npy"), frame_data)
+        np.save(os.path.join(directory, "dl.npy"), dls[group])
+        entry = {"frames": len(group), "first": float(times[group[0]]), "last": float(times[group[-1]]), "message": None, "signals": []}
+        id_index[name] = entry
+
+        try:
+            message = database.get_message_by_frame_id(can_id)
+        except KeyError:
+            continue
+        # Frames shorter than the message are kept in data.npy but not decoded
+        complete = dls[group] >= message.length
+        if not complete.all():
+            frame_data[~complete] = 0
+        entry["message"] = message.name
+        for signal in message.signals:
+            values = decode_signal(frame_data, signal)
+            values[~complete] = np.nan
+            np.save(os.path.join(directory, f"{signal.name}.npy"), values)
+            key = signal.name if signal.name not in signal_index else f"{message.name}.{signal.name}"
+            signal_index[key] = {"id": name, "file": f"{name}/{signal.name}.npy", "unit": signal.unit or ""}
+            entry["signals"].append(signal.name)
+    return id_index, signal_index
+
+
+def write_index(out_dir, paths, id_index, signal_index, frames, skipped):
+    """_summary_
+    Writes index.json, which holds:
+        ids         CAN id (hex) -> frames, first and last time, message name and signal names
+        signals     signal name -> CAN id, .npy file and unit
+    Signal names used by more than one message are given as 'message.signal'.
+    """
+    index = {
+        "created": str(datetime.datetime.now()),
+        "sources": [os.path.abspath(path) for path in paths],
+        "frames": frames,
+        "skipped_lines": skipped,
+        "ids": id_index,
+        "signals": signal_index,
+    }
+    with open(os.path.join(out_dir, INDEX_FILE + ".partial"), "w") as f:
+        json.dump(index, f, indent=1)
+    os.replace(os.path.join(out_dir, INDEX_FILE + ".partial"), os.path.join(out_dir, INDEX_FILE))
+
+
+def convert(paths, out_dir, dbc_files=DBC_FILES, workers=None, chunk_bytes=CHUNK_BYTES):
+    """_summary_
+    Converts logs into columns, see the layout above.
+        Args:
+            paths (list): The log files.
+            out_dir (str): Directory the columns are written to, created if missing.
+            dbc_files (list): DBC files describing the messages.
+            workers (int): Processes parsing the logs, one per CPU by default.
+            chunk_bytes (int): Bytes of a log parsed by one process at a time.
+        Returns:
+            dict: The index written to index.json.
+    """
+    database = cantools.database.Database()
+    for dbc_file in dbc_files:
+        database.add_dbc_file(dbc_file)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        parts = list(pool.map(parse_chunk, *zip(*log_chunks(paths, chunk_bytes))))
+    times = np.concatenate([part[0] for part in parts])
+    ids = np.concatenate([part[1] for part in parts])
+    dls = np.concatenate([part[2] for part in parts])
+    data = np.concatenate([part[3] for part in parts])
+    skipped = sum(part[4] for part in parts)
+
+    os.makedirs(out_dir, exist_ok=True)
+    id_index, signal_index = write_columns(out_dir, times, ids, dls, data, database)
+    write_index(out_dir, paths, id_index, signal_index, len(times), skipped)
+    with open(os.path.join(out_dir, INDEX_FILE)) as f:
+        return json.load(f)
+
+
+def load_signal(out_dir, name):
+    """_summary_
+    Opens a converted signal without reading it into memory.
+        Args:
+            out_dir (str): Directory written by convert.
+            name (str): Signal name, as in the index.
+        Returns:
+            tuple: (times, values) memory mapped arrays.
+    """
+    with open(os.path.join(out_dir, INDEX_FILE)) as f:
+        signal = json.load(f)["signals"][name]
+    times = np.load(os.path.join(out_dir, signal["id"], "time.npy"), mmap_mode="r")
+    return times, np.load(os.path.join(out_dir, signal["file"]), mmap_mode="r")
+
+
+""" MAIN """
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert raw CAN logs into one .npy file per signal.")
+    parser.add_argument("logs", nargs="+", help="log files, python-can or candump text")
+    parser.add_argument("--out", default="columns", help="output directory")
+    parser.add_argument("--dbc", action="append", help="DBC file(s), the EV24 and BMS files by default")
+    parser.add_argument("--workers", type=int, help="parsing processes, one per CPU by default")
+    args = parser.parse_args()
+
+    missing = [path for path in args.logs if not os.path.isfile(path)]
+    if missing:
+        print(f"{datetime.datetime.now()} -! # Log files not found: {', '.join(missing)}")
+        sys.exit(1)
+
+    start = time.perf_counter()
+    print(f"{datetime.datetime.now()} - # Converting {len(args.logs)} logs to {args.out}")
+    index = convert(args.logs, args.out, args.dbc or DBC_FILES, args.workers)
+    print(f" # - Frames: {index['frames']}, lines skipped: {index['skipped_lines']}")
+    print(f" # - CAN ids: {len(index['ids'])}, signals decoded: {len(index['signals'])}")
+    print(f" # - Took {time.perf_counter() - start:.1f} s")
+
+
+if __name__ == "__main__":
+    main()
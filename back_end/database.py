@@ -9,9 +9,13 @@ This code is part of the WESMO Data Acquisition and Visualisation Project.
 
 """
 
-import csv
 import psycopg2
-from datetime import datetime
+import psycopg2.errors
+from psycopg2.extras import execute_values
+from datetime import datetime, timedelta
+
+# Rollup tables by bucket width in seconds, finest first
+ROLLUP_TABLES = {1: "ROLLUP_1S", 10: "ROLLUP_10S", 60: "ROLLUP_1M"}
 
 
 def start_postgresql():
@@ -55,166 +59,477 @@ def setup_db(cursor, conn):
         print(" -! # Error creating database - wesmo")
 
 
-def create_mc_table(cursor, conn):
+def create_telemetry_tables(cursor, conn):
+    """_summary_
+    Creates the SIGNAL metadata table, the SESSION table and the narrow
+    TELEMETRY table if they don't already exist, so restarting keeps all data.
+    TELEMETRY holds one row per decoded value, referencing its name, unit and
+    max in SIGNAL and the run it was recorded in from SESSION. It is
+    partitioned by day (see create_telemetry_partition).
+    Columns are ordered widest first so rows need no alignment padding.
+    """
     try:
-        cursor.execute("DROP TABLE IF EXISTS MOTOR_CONTROLLER")
-
-        sql = """CREATE TABLE MOTOR_CONTROLLER(
-            TIME TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,  -- Auto-filled timestamp,
-            PDO INT,
-            NAME CHAR(50),
-            VALUE INT,
-            UNIT CHAR(25),
-            MAX CHAR(25)
+        cursor.execute(
+            """CREATE TABLE IF NOT EXISTS SIGNAL(
+            ID SMALLSERIAL PRIMARY KEY,
+            NAME TEXT NOT NULL UNIQUE,
+            SOURCE TEXT NOT NULL,  -- mc, bms, vcu or derived
+            PDO SMALLINT,
+            UNIT TEXT NOT NULL DEFAULT '',
+            MAX DOUBLE PRECISION
         )"""
-
-        cursor.execute(sql)
-        print(" # - Motor Controller table created successfully")
+        )
+        cursor.execute(
+            """CREATE TABLE IF NOT EXISTS SESSION(
+            ID SERIAL PRIMARY KEY,
+            STARTED_AT TIMESTAMPTZ NOT NULL,
+            ENDED_AT TIMESTAMPTZ,
+            RTD BOOLEAN NOT NULL,  -- one session per RTD cycle, and one for each gap between them
+            ARCHIVE_PATH TEXT
+        )"""
+        )
+        cursor.execute(
+            """CREATE TABLE IF NOT EXISTS TELEMETRY(
+            TIME TIMESTAMPTZ NOT NULL,
+            VALUE DOUBLE PRECISION,
+            SESSION_ID INT,
+            SIGNAL_ID SMALLINT NOT NULL REFERENCES SIGNAL(ID)
+        ) PARTITION BY RANGE (TIME)"""
+        )
+        # Tables created before sessions were added
+        cursor.execute("ALTER TABLE TELEMETRY ADD COLUMN IF NOT EXISTS SESSION_ID INT")
+
+        # One row per lap of a stint (an RTD session) with its aggregates, see LapTracker.py
+        cursor.execute(
+            """CREATE TABLE IF NOT EXISTS LAP(
+            STARTED_AT TIMESTAMPTZ NOT NULL,
+            ENDED_AT TIMESTAMPTZ NOT NULL,
+            DURATION DOUBLE PRECISION NOT NULL,
+            DISTANCE DOUBLE PRECISION NOT NULL,
+            ENERGY_USED DOUBLE PRECISION NOT NULL,
+            MAX_MOTOR_TEMP DOUBLE PRECISION,
+            MAX_BATTERY_TEMP DOUBLE PRECISION,
+            MIN_SOC DOUBLE PRECISION,
+            SESSION_ID INT NOT NULL REFERENCES SESSION(ID),
+            NUMBER SMALLINT NOT NULL,
+            COMPLETE BOOLEAN NOT NULL,
+            PRIMARY KEY (SESSION_ID, NUMBER)
+        )"""
+        )
+        # A lap is recognised by when it started, its number may be moved on (see save_lap)
+        cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS LAP_STARTED ON LAP(SESSION_ID, STARTED_AT)")
+
+        # Per signal aggregates of TELEMETRY kept up to date by the database writer
+        for table in ROLLUP_TABLES.values():
+            cursor.execute(
+                f"""CREATE TABLE IF NOT EXISTS {table}(
+                BUCKET TIMESTAMPTZ NOT NULL,
+                LAST_TIME TIMESTAMPTZ NOT NULL,
+                SUM DOUBLE PRECISION NOT NULL,
+                MIN DOUBLE PRECISION NOT NULL,
+                MAX DOUBLE PRECISION NOT NULL,
+                LAST DOUBLE PRECISION NOT NULL,
+                COUNT INT NOT NULL,
+                SIGNAL_ID SMALLINT NOT NULL REFERENCES SIGNAL(ID),
+                PRIMARY KEY (SIGNAL_ID, BUCKET)
+            ) PARTITION BY RANGE (BUCKET)"""
+            )
+        print(" # - Telemetry tables ready")
         conn.commit()
     except Exception as e:
         conn.rollback()
-        print(" -! # Error creating table - Motor Contoller")
+        print(f" -! # Error creating telemetry tables: {e}")
 
+    create_telemetry_indexes(cursor, conn)
 
-def create_vcu_table(cursor, conn):
-    try:
-        cursor.execute("DROP TABLE IF EXISTS VEHICLE_CONTROLL_UNIT")
-
-        sql = """CREATE TABLE VEHICLE_CONTROLL_UNIT(
-            TIME TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,  -- Auto-filled timestamp,
-            NAME CHAR(50),
-            VALUE INT,
-            UNIT CHAR(25),
-            MAX CHAR(25)
-        )"""
 
-        cursor.execute(sql)
-        print(" # - Vehicle Control Unit table created successfully")
+def create_telemetry_indexes(cursor, conn):
+    """_summary_
+    Creates the TELEMETRY indexes, indexes on the partitioned table are
+    created on every existing and future partition.
+    TELEMETRY_SIGNAL_TIME lets history lookups read only the newest rows of a
+    signal, TELEMETRY_TIME_BRIN keeps time range scans cheap. SESSION_STARTED
+    finds the session a lap was driven in.
+    """
+    try:
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS TELEMETRY_SIGNAL_TIME ON TELEMETRY (SIGNAL_ID, TIME DESC)"
+        )
+        cursor.execute("CREATE INDEX IF NOT EXISTS TELEMETRY_TIME_BRIN ON TELEMETRY USING BRIN (TIME)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS SESSION_OPEN ON SESSION (ID) WHERE ENDED_AT IS NULL")
+        cursor.execute("CREATE INDEX IF NOT EXISTS SESSION_STARTED ON SESSION (STARTED_AT)")
         conn.commit()
     except Exception as e:
         conn.rollback()
-        print(" -! # Error creating table - Vehicle Control Unit")
+        print(f" -! # Error creating telemetry indexes: {e}")
+
+
+def create_telemetry_partition(cursor, day):
+    """_summary_
+    Creates the TELEMETRY and rollup partitions holding a single day, if they don't exist.
+        Args:
+            day (str): The day as 'YYYY-MM-DD'.
+    """
+    start = datetime.strptime(day, "%Y-%m-%d")
+    end = start + timedelta(days=1)
+    for table in ["TELEMETRY"] + list(ROLLUP_TABLES.values()):
+        cursor.execute(
+            f"""CREATE TABLE IF NOT EXISTS {table}_{start:%Y%m%d} PARTITION OF {table}
+            FOR VALUES FROM ('{start:%Y-%m-%d}') TO ('{end:%Y-%m-%d}')"""
+        )
+
+
+def upsert_signal(cursor, name, source, pdo, unit, maximum):
+    """_summary_
+    Registers a signal (or updates its unit and max) and returns its ID.
+    """
+    cursor.execute(
+        """INSERT INTO SIGNAL(NAME, SOURCE, PDO, UNIT, MAX) VALUES (%s, %s, %s, %s, %s)
+        ON CONFLICT (NAME) DO UPDATE SET UNIT = EXCLUDED.UNIT, MAX = EXCLUDED.MAX
+        RETURNING ID""",
+        (name, source, pdo, unit, maximum),
+    )
+    return cursor.fetchone()[0]
 
 
-def create_bms_table(cursor, conn):
-    try:
-        cursor.execute("DROP TABLE IF EXISTS BATTERY_MANAGEMENT_SYSTEM")
-
-        sql = """CREATE TABLE BATTERY_MANAGEMENT_SYSTEM(
-            TIME TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,  -- Auto-filled timestamp,
-            NAME CHAR(50),
-            VALUE INT,
-            UNIT CHAR(25),
-            MAX CHAR(25)
-        )"""
+def current_session(cursor):
+    """_summary_
+    Returns the (id, rtd) of the open session, or None if there isn't one.
+    """
+    cursor.execute(
+        "SELECT ID, RTD FROM SESSION WHERE ENDED_AT IS NULL ORDER BY ID DESC LIMIT 1 FOR UPDATE"
+    )
+    return cursor.fetchone()
+
+
+def change_session(cursor, rtd, time):
+    """_summary_
+    Makes sure the open session matches the RTD state, closing the open session
+    and starting a new one at the given time if it doesn't.
+        Args:
+            rtd (bool): Whether the car is ready to drive.
+            time (str): Timestamp of the frame the RTD state came from.
+        Returns:
+            tuple: (open session id, id of the session that was closed or None)
+    """
+    session = current_session(cursor)
+    if session is not None and session[1] == rtd:
+        return session[0], None
+
+    closed_id = None
+    if session is not None:
+        cursor.execute("UPDATE SESSION SET ENDED_AT = %s WHERE ENDED_AT IS NULL", (time,))
+        closed_id = session[0]
+    cursor.execute(
+        "INSERT INTO SESSION(STARTED_AT, RTD) VALUES (%s, %s) RETURNING ID", (time, rtd)
+    )
+    return cursor.fetchone()[0], closed_id
+
+
+def save_lap(cursor, lap):
+    """_summary_
+    Stores a lap against the session it started in. A lap already stored, e.g.
+    from a replayed spill, is left as it is. The tracker numbers laps from 1
+    again after the subscriber restarts part way through a stint, so the lap is
+    numbered after those already stored for the session.
+        Args:
+            lap (dict): A lap from LapTracker.update.
+    """
+    cursor.execute(
+        """INSERT INTO LAP(STARTED_AT, ENDED_AT, DURATION, DISTANCE, ENERGY_USED,
+            MAX_MOTOR_TEMP, MAX_BATTERY_TEMP, MIN_SOC, SESSION_ID, NUMBER, COMPLETE)
+        SELECT %(started_at)s, %(ended_at)s, %(duration)s, %(distance)s, %(energy_used)s,
+            %(max_motor_temp)s, %(max_battery_temp)s, %(min_soc)s, ID,
+            GREATEST(%(number)s, (SELECT COALESCE(MAX(NUMBER), 0) + 1 FROM LAP WHERE SESSION_ID = SESSION.ID)),
+            %(complete)s
+        FROM SESSION WHERE STARTED_AT <= %(started_at)s ORDER BY STARTED_AT DESC, ID DESC LIMIT 1
+        ON CONFLICT (SESSION_ID, STARTED_AT) DO NOTHING""",
+        lap,
+    )
 
-        cursor.execute(sql)
-        print(" # - Battery Management System table created successfully")
-        conn.commit()
-    except Exception as e:
-        conn.rollback()
-        print(" -! # Error creating table - Battery Management System")
 
+def query_laps(cursor, session_id=None):
+    """_summary_
+    Returns the laps of a session, or of the latest session with any, read from
+    the LAP primary key.
+        Returns:
+            tuple: (session id or None, list of lap dictionaries by number)
+    """
+    if session_id is None:
+        cursor.execute("SELECT MAX(SESSION_ID) FROM LAP")
+        session_id = cursor.fetchone()[0]
+        if session_id is None:
+            return None, []
+    cursor.execute(
+        """SELECT NUMBER, STARTED_AT, ENDED_AT, DURATION, DISTANCE, ENERGY_USED,
+            MAX_MOTOR_TEMP, MAX_BATTERY_TEMP, MIN_SOC, COMPLETE
+        FROM LAP WHERE SESSION_ID = %s ORDER BY NUMBER""",
+        (session_id,),
+    )
+    columns = [column.name.lower() for column in cursor.description]
+    return session_id, [dict(zip(columns, row)) for row in cursor.fetchall()]
 
-def save_to_db_mc(cursor, conn, data, pdo):
-    from mqtt_subscriber import cache_data
 
-    if len(data) < 2:
-        return
-    time = data[0].split(" ")
+def unarchived_sessions(cursor):
+    """_summary_
+    Returns the (id, started_at, ended_at) of closed sessions not yet archived, oldest first.
+    """
+    cursor.execute(
+        """SELECT ID, STARTED_AT, ENDED_AT FROM SESSION
+        WHERE ENDED_AT IS NOT NULL AND ARCHIVE_PATH IS NULL ORDER BY ID"""
+    )
+    return cursor.fetchall()
+
+
+def mark_session_archived(cursor, session_id, path):
+    cursor.execute("UPDATE SESSION SET ARCHIVE_PATH = %s WHERE ID = %s", (path, session_id))
+
+
+def drop_archived_partitions(cursor, retention_days):
+    """_summary_
+    Drops whole TELEMETRY day partitions older than the retention period once
+    every session with rows in them has been archived. Dropping a partition is
+    instant, unlike deleting its rows.
+        Returns:
+            list: Names of the dropped partitions.
+    """
+    cursor.execute(
+        """SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+        WHERE p.relname = 'telemetry' ORDER BY c.relname"""
+    )
+    cutoff = datetime.now() - timedelta(days=retention_days)
+    dropped = []
+    for (partition,) in cursor.fetchall():
+        start = datetime.strptime(partition[len("telemetry_") :], "%Y%m%d")
+        end = start + timedelta(days=1)
+        if end > cutoff:
+            continue
+        cursor.execute(
+            """SELECT 1 FROM SESSION WHERE ARCHIVE_PATH IS NULL
+            AND STARTED_AT < %s AND (ENDED_AT IS NULL OR ENDED_AT >= %s) LIMIT 1""",
+            (end, start),
+        )
+        if cursor.fetchone() is None:
+            # The 1 s rollups go with the raw rows, coarser rollups are kept
+            cursor.execute(f"DROP TABLE {partition}")
+            cursor.execute(f"DROP TABLE IF EXISTS {ROLLUP_TABLES[1]}_{start:%Y%m%d}")
+            dropped.append(partition)
+    return dropped
+
+
+def rollup_bucket(timestamp, resolution):
+    """_summary_
+    Truncates a 'YYYY-MM-DD HH:MM:SS[.ffffff]' timestamp to the start of its rollup bucket.
+        Args:
+            resolution (int): One of the keys of ROLLUP_TABLES.
+    """
+    if resolution == 1:
+        return timestamp[:19]
+    if resolution == 10:
+        return timestamp[:18] + "0"
+    return timestamp[:16] + ":00"
+
+
+def save_rollups(cursor, rows):
+    """_summary_
+    Folds a batch of rows into every rollup table. The batch is aggregated in
+    memory first so each bucket is upserted once per batch.
+        Args:
+            rows (list): (time, value, session id, signal id) tuples.
+    """
+    for resolution, table in ROLLUP_TABLES.items():
+        buckets = {}
+        for time, value, _, signal_id in rows:
+            if value is None:
+                continue
+            key = (rollup_bucket(time, resolution), signal_id)
+            bucket = buckets.get(key)
+            if bucket is None:
+                buckets[key] = [time, value, value, value, value, 1]
+                continue
+            if time >= bucket[0]:
+                bucket[0], bucket[4] = time, value
+            bucket[1] += value
+            bucket[2] = min(bucket[2], value)
+            bucket[3] = max(bucket[3], value)
+            bucket[5] += 1
+
+        execute_values(
+            cursor,
+            f"""INSERT INTO {table} AS r (BUCKET, SIGNAL_ID, LAST_TIME, SUM, MIN, MAX, LAST, COUNT) VALUES %s
+            ON CONFLICT (SIGNAL_ID, BUCKET) DO UPDATE SET
+                SUM = r.SUM + EXCLUDED.SUM,
+                MIN = LEAST(r.MIN, EXCLUDED.MIN),
+                MAX = GREATEST(r.MAX, EXCLUDED.MAX),
+                LAST = CASE WHEN EXCLUDED.LAST_TIME >= r.LAST_TIME THEN EXCLUDED.LAST ELSE r.LAST END,
+                LAST_TIME = GREATEST(r.LAST_TIME, EXCLUDED.LAST_TIME),
+                COUNT = r.COUNT + EXCLUDED.COUNT""",
+            [(bucket, signal_id, *values) for (bucket, signal_id), values in buckets.items()],
+            page_size=1000,
+        )
+
+
+def rollup_resolution(start, end, width):
+    """_summary_
+    Picks the coarsest resolution whose buckets are still no wider than a pixel.
+        Args:
+            start (datetime): Start of the window.
+            end (datetime): End of the window.
+            width (int): Width of the chart in pixels.
+        Returns:
+            int: Bucket width in seconds, or 0 for raw rows.
+    """
+    seconds_per_pixel = (end - start).total_seconds() / max(width, 1)
+    resolution = 0
+    for bucket_seconds in ROLLUP_TABLES:
+        if bucket_seconds <= seconds_per_pixel:
+            resolution = bucket_seconds
+    return resolution
+
+
+def query_history_window(cursor, names, start, end, width):
+    """_summary_
+    Returns the given signals between start and end, oldest first, at the
+    resolution suited to the chart width.
+        Args:
+            names (list): Signal names.
+            start (datetime): Start of the window.
+            end (datetime): End of the window.
+            width (int): Width of the chart in pixels.
+        Returns:
+            tuple: (resolution, rows), raw rows are (time, value, name) and
+                rollup rows (bucket, mean, min, max, last, name).
+    """
+    resolution = rollup_resolution(start, end, width)
+    if resolution == 0:
+        cursor.execute(
+            """SELECT t.TIME, t.VALUE, s.NAME FROM TELEMETRY t
+            JOIN SIGNAL s ON s.ID = t.SIGNAL_ID
+            WHERE s.NAME = ANY(%s) AND t.TIME >= %s AND t.TIME < %s
+            ORDER BY t.TIME""",
+            (list(names), start, end),
+        )
+    else:
+        cursor.execute(
+            f"""SELECT r.BUCKET, r.SUM / r.COUNT, r.MIN, r.MAX, r.LAST, s.NAME FROM {ROLLUP_TABLES[resolution]} r
+            JOIN SIGNAL s ON s.ID = r.SIGNAL_ID
+            WHERE s.NAME = ANY(%s) AND r.BUCKET >= %s AND r.BUCKET < %s
+            ORDER BY r.BUCKET""",
+            (list(names), start, end),
+        )
+    return resolution, cursor.fetchall()
+
+
+def query_export(rows, name, start, end):
+    """_summary_
+    Selects every raw row of one signal between start and end, oldest first,
+    read in time order from TELEMETRY_SIGNAL_TIME so nothing has to be sorted.
+        Args:
+            rows (cursor): A named (server side) cursor, rows are fetched from it.
+            name (str): Signal name.
+            start (datetime): Start of the range.
+            end (datetime): End of the range.
+    """
+    rows.execute(
+        """SELECT t.TIME, t.VALUE, s.NAME FROM TELEMETRY t
+        JOIN SIGNAL s ON s.ID = t.SIGNAL_ID
+        WHERE s.NAME = %s AND t.TIME >= %s AND t.TIME < %s
+        ORDER BY t.TIME""",
+        (name, start, end),
+    )
+
+
+def session_start(cursor, session_id=None):
+    """Returns when the given session, or the open session, started."""
+    if session_id is None:
+        cursor.execute("SELECT STARTED_AT FROM SESSION WHERE ENDED_AT IS NULL ORDER BY ID DESC LIMIT 1")
+    else:
+        cursor.execute("SELECT STARTED_AT FROM SESSION WHERE ID = %s", (session_id,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def query_history(cursor, names, limit):
+    """_summary_
+    Returns the latest rows for the given signals, newest first.
+    Each signal's rows are read newest first from TELEMETRY_SIGNAL_TIME and
+    merged, so the cost depends on the limit and not the size of the table.
+        Args:
+            names (list): Signal names.
+            limit (int): Most rows returned across all the signals.
+        Returns:
+            list: (time, value, name) tuples.
+    """
+    return execute_prepared(cursor, "HISTORY_QUERY", (list(names), limit))
+
+
+PREPARED_STATEMENTS = {
+    "HISTORY_QUERY": """PREPARE HISTORY_QUERY(TEXT[], INT) AS
+        SELECT h.TIME, h.VALUE, s.NAME FROM SIGNAL s
+        CROSS JOIN LATERAL (
+            SELECT TIME, VALUE FROM TELEMETRY
+            WHERE SIGNAL_ID = s.ID
+            ORDER BY TIME DESC LIMIT $2
+        ) h
+        WHERE s.NAME = ANY($1)
+        ORDER BY h.TIME DESC LIMIT $2""",
+}
+
+
+def execute_prepared(cursor, name, params):
+    """_summary_
+    Executes one of PREPARED_STATEMENTS, preparing it on the cursor's
+    connection the first time it is used there.
+        Returns:
+            list: The fetched rows.
+    """
+    placeholders = ", ".join(["%s"] * len(params))
+    try:
+        cursor.execute(f"EXECUTE {name} ({placeholders})", params)
+    except psycopg2.errors.InvalidSqlStatementName:
+        if not cursor.connection.autocommit:
+            cursor.connection.rollback()
+        cursor.execute(PREPARED_STATEMENTS[name])
+        cursor.execute(f"EXECUTE {name} ({placeholders})", params)
+    return cursor.fetchall()
+
 
-    for value in data[2:]:
-        query = f"""INSERT INTO MOTOR_CONTROLLER(
-        TIME, PDO, NAME, VALUE, UNIT, MAX)
-        VALUES ('{time[1]+" "+time[2]}', {pdo}, '{value["name"]}', {value["value"]}, '{value["unit"]}', '{value["max"]}')"""
-        try:
-            cursor.execute(query)
-            conn.commit()
-        except Exception as e:
-            conn.rollback()
-            print(f" -! # Error in saving to database - Motor Controller Table : {e}")
+def numeric_value(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
 
-        cache_data(time, value)
 
+def save_values(writer, engines, source, pdo, time, values):
+    timestamp = time[1] + " " + time[2]
+    for value in values:
+        if value["name"] != "Track Time":
+            if value["name"] == "RTD Running":
+                writer.put_rtd_state(timestamp, bool(value["value"]))
+            writer.register_signal(value["name"], source, pdo, value["unit"], value["max"])
+            writer.put((timestamp, value["name"], numeric_value(value["value"])))
+    engines.update(writer, time, values)
 
-def save_to_db_vcu(cursor, conn, data):
-    from mqtt_subscriber import cache_data
 
+def save_to_db_mc(writer, engines, data, pdo):
     if len(data) < 2:
         return
     time = data[0].split(" ")
-    for value in data[1:]:
-        if value["name"] != "Track Time":
-            query = f"""INSERT INTO VEHICLE_CONTROLL_UNIT(
-            TIME, NAME, VALUE, UNIT, MAX)
-            VALUES ('{time[1]+" "+time[2]}', '{value["name"]}', {value["value"]}, '{value["unit"]}', '{value["max"]}')"""
-            try:
-                cursor.execute(query)
-                conn.commit()
-            except Exception as e:
-                conn.rollback()
-                print(f" -! # Error in saving to database - VCU table: {e}")
+    save_values(writer, engines, "mc", int(pdo), time, data[2:])
 
-        cache_data(time, value)
 
+def save_to_db_vcu(writer, engines, data):
+    if len(data) < 2:
+        return
+    time = data[0].split(" ")
+    save_values(writer, engines, "vcu", None, time, data[1:])
 
-def save_to_db_bms(cursor, conn, data):
-    from mqtt_subscriber import cache_data
 
+def save_to_db_bms(writer, engines, data):
     if len(data) < 2:
         return
     time = data[0].split(" ")
-    for value in data[1:]:
-        query = f"""INSERT INTO BATTERY_MANAGEMENT_SYSTEM(
-        TIME, NAME, VALUE, UNIT, MAX)
-        VALUES ('{time[1]+" "+time[2]}', '{value["name"]}', {value["value"]}, '{value["unit"]}', '{value["max"]}')"""
-        try:
-            cursor.execute(query)
-            conn.commit()
-        except Exception as e:
-            conn.rollback()
-            print(f" -! # Error in saving to database - BMS table: {e}")
-
-        cache_data(time, value)
-
-
-# ONLY TO BE USED IN SIMULATION
-def export_and_clear_database(cursor, conn):
-    # BMS
-    cursor.execute("SELECT * FROM BATTERY_MANAGEMENT_SYSTEM")
-    results = cursor.fetchall()
-
-    date_time = datetime.now()
-    formatted_date = f"{date_time.year}-{date_time.month:02d}-{date_time.day:02d}"
-    filepath = f"/home/ubuntu/WESMO-2024/back_end/database/bms-{formatted_date}.txt"
-
-    with open(filepath, "w") as f:
-        for row in results:
-            f.write("\t".join(str(cell) for cell in row) + "\n")
-
-    cursor.execute("DELETE FROM BATTERY_MANAGEMENT_SYSTEM")
-    conn.commit()
-
-    # VCU
-    cursor.execute("SELECT * FROM VEHICLE_CONTROLL_UNIT")
-    results = cursor.fetchall()
-    filepath = f"/home/ubuntu/WESMO-2024/back_end/database/vcu-{formatted_date}.txt"
-
-    with open(filepath, "w") as f:
-        for row in results:
-            f.write("\t".join(str(cell) for cell in row) + "\n")
-
-    cursor.execute("DELETE FROM VEHICLE_CONTROLL_UNIT")
-    conn.commit()
-
-    # MC
-    cursor.execute("SELECT * FROM MOTOR_CONTROLLER")
-    results = cursor.fetchall()
-    filepath = f"/home/ubuntu/WESMO-2024/back_end/database/mc-{formatted_date}.txt"
-
-    with open(filepath, "w") as f:
-        for row in results:
-            f.write("\t".join(str(cell) for cell in row) + "\n")
-
-    cursor.execute("DELETE FROM MOTOR_CONTROLLER")
-    conn.commit()
+    save_values(writer, engines, "bms", None, time, data[1:])
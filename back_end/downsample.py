@@ -0,0 +1,160 @@
+"""
+File: downsample.py
+Author: Hannah Murphy
+Date: 2024
+Description: Reduces a time series to a target number of points while keeping
+    its shape, used to bound the size of history responses. Also turns series
+    held in memory into the rows the PostgreSQL history queries return.
+
+Copyright (c) 2024 WESMO. All rights reserved.
+This code is part of the WESMO Data Acquisition and Visualisation Project.
+
+"""
+
+import datetime
+import numpy as np
+
+METHODS = ("lttb", "minmax")
+
+
+def downsample(times, values, points, method="lttb"):
+    """_summary_
+    Picks which points of a series to keep.
+        Args:
+            times (ndarray): Increasing timestamps in seconds.
+            values (ndarray): The values, NaN values are never picked.
+            points (int): Most points returned.
+            method (str): 'lttb' or 'minmax'.
+        Returns:
+            ndarray: Sorted indexes of the points to keep.
+    """
+    present = np.flatnonzero(~np.isnan(values))
+    if len(present) <= points:
+        return present
+    times, values = times[present], values[present]
+    if method == "minmax":
+        return present[min_max(times, values, points)]
+    return present[lttb(times, values, points)]
+
+
+def bucket_edges(length, buckets):
+    """Splits range(length) into buckets of (almost) equal size, returning their start indexes."""
+    return np.linspace(0, length, buckets + 1).astype(np.int64)
+
+
+def lttb(times, values, points):
+    """_summary_
+    Largest-Triangle-Three-Buckets. The first and last points are always kept,
+    the rest are split into points - 2 buckets and from each the point forming
+    the largest triangle with the point kept from the previous bucket and the
+    average of the next bucket is kept.
+    The bucket averages are computed for all buckets at once, only the choice
+    within each bucket depends on the previous one.
+    """
+    if points < 3:
+        return np.array([0, len(times) - 1][: max(points, 0)], dtype=np.int64)
+
+    edges = bucket_edges(len(times) - 2, points - 2) + 1
+    counts = np.diff(edges)
+    mean_times = np.add.reduceat(times[1:-1], edges[:-1] - 1) / counts
+    mean_values = np.add.reduceat(values[1:-1], edges[:-1] - 1) / counts
+    # The bucket after the last one is the final point
+    next_times = np.append(mean_times[1:], times[-1])
+    next_values = np.append(mean_values[1:], values[-1])
+
+    keep = np.empty(points, dtype=np.int64)
+    keep[0], keep[-1] = 0, len(times) - 1
+    a = 0
+    for i in range(points - 2):
+        lo, hi = edges[i], edges[i + 1]
+        # Twice the area of the triangle (a, candidate, next bucket average)
+        area = np.abs(
+            (times[a] - next_times[i]) * (values[lo:hi] - values[a])
+            - (times[a] - times[lo:hi]) * (next_values[i] - values[a])
+        )
+        a = lo + int(np.argmax(area))
+        keep[i + 1] = a
+    return keep
+
+
+def min_max(times, values, points):
+    """_summary_
+    Keeps the smallest and largest value of each of points / 2 buckets, so no
+    peak is ever lost. Fully vectorised, the first point of each bucket equal
+    to the bucket's min (or max) is found with one pass over the series.
+    """
+    buckets = max(points // 2, 1)
+    edges = bucket_edges(len(times), buckets)
+    counts = np.diff(edges)
+    bucket_ids = np.repeat(np.arange(buckets), counts)
+    keep = []
+    for reduce in (np.minimum, np.maximum):
+        extremes = np.repeat(reduce.reduceat(values, edges[:-1]), counts)
+        matches = np.flatnonzero(values == extremes)
+        _, first = np.unique(bucket_ids[matches], return_index=True)
+        keep.append(matches[first])
+    return np.unique(np.concatenate(keep))
+
+
+def to_datetime(seconds):
+    return datetime.datetime.fromtimestamp(seconds, datetime.timezone.utc)
+
+
+def latest_rows(series, limit):
+    """_summary_
+    Merges the newest points of several signals like database.query_history.
+        Args:
+            series (list): (name, times, values) with times increasing.
+            limit (int): Most rows returned across all the signals.
+        Returns:
+            list: (time, value, name) tuples, newest first.
+    """
+    rows = []
+    for name, times, values in series:
+        rows += zip(times[-limit:].tolist(), values[-limit:].tolist(), [name] * min(len(times), limit))
+    rows.sort(key=lambda row: row[0], reverse=True)
+    return [(to_datetime(t), None if v != v else v, name) for t, v, name in rows[:limit]]
+
+
+def window_rows(series, resolution):
+    """_summary_
+    Merges several signals into the rows of database.query_history_window,
+    aggregating them into buckets of the rollup tables when resolution isn't 0.
+        Args:
+            series (list): (name, times, values) with times increasing.
+            resolution (int): Bucket width in seconds, or 0 for raw rows.
+        Returns:
+            list: Raw rows (time, value, name) or rollup rows
+                (bucket, mean, min, max, last, name), oldest first.
+    """
+    keys, rows = [], []
+    for name, times, values in series:
+        if resolution == 0:
+            keys.append(times)
+            rows += zip(times.tolist(), values.tolist(), [name] * len(times))
+            continue
+
+        present = ~np.isnan(values)
+        times, values = times[present], values[present]
+        if not len(times):
+            continue
+        buckets = np.floor(times / resolution) * resolution
+        starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+        ends = np.r_[starts[1:], len(values)]
+        means = np.add.reduceat(values, starts) / (ends - starts)
+        keys.append(buckets[starts])
+        rows += zip(
+            buckets[starts].tolist(),
+            means.tolist(),
+            np.minimum.reduceat(values, starts).tolist(),
+            np.maximum.reduceat(values, starts).tolist(),
+            values[ends - 1].tolist(),
+            [name] * len(starts),
+        )
+
+    if not rows:
+        return []
+    order = np.argsort(np.concatenate(keys), kind="stable")
+    if resolution == 0:
+        return [(to_datetime(rows[i][0]), None if rows[i][1] != rows[i][1] else rows[i][1], rows[i][2]) for i in order]
+    return [(to_datetime(rows[i][0]), *rows[i][1:]) for i in order]
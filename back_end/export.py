@@ -0,0 +1,105 @@
+"""
+File: export.py
+Author: Hannah Murphy
+Date: 2024
+Description: Encodes exported telemetry as CSV, NDJSON or Parquet one chunk of rows
+    at a time, so an export of any length is streamed with constant memory.
+
+Copyright (c) 2024 WESMO. All rights reserved.
+This code is part of the WESMO Data Acquisition and Visualisation Project.
+
+"""
+
+import io
+import csv
+import json
+import pyarrow as pa
+import pyarrow.parquet as pq
+from SessionArchiver import ARCHIVE_SCHEMA
+
+""" GLOBAL VARIABLES
+Export formats with their content type and file extension. Parquet files use
+the same schema as the session archives.
+"""
+FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+
+
+def encode_export(chunks, export_format):
+    """_summary_
+    Encodes chunks of rows as they are read.
+        Args:
+            chunks (iterable): Lists of (time, value, name) rows, see StorageBackend.export_rows.
+            export_format (str): One of FORMATS.
+        Returns:
+            generator: The encoded file in pieces of bytes.
+    """
+    if export_format == "parquet":
+        return encode_parquet(chunks)
+    if export_format == "ndjson":
+        return encode_ndjson(chunks)
+    return encode_csv(chunks)
+
+
+def encode_csv(chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(["time", "signal", "value"])
+    for chunk in chunks:
+        writer.writerows((time.isoformat(), name, "" if value is None else value) for time, value, name in chunk)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue().encode()
+
+
+def encode_ndjson(chunks):
+    for chunk in chunks:
+        yield "".join(
+            json.dumps({"time": time.isoformat(), "signal": name, "value": value}) + "\n" for time, value, name in chunk
+        ).encode()
+
+
+class ChunkSink:
+    """A write-only file the Parquet writer writes to, emptied after every chunk."""
+
+    def __init__(self):
+        self.parts = []
+        self.closed = False
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data, self.parts = b"".join(self.parts), []
+        return data
+
+
+def encode_parquet(chunks):
+    # Every chunk becomes a row group, written out as soon as it is complete
+    sink = ChunkSink()
+    with pq.ParquetWriter(sink, ARCHIVE_SCHEMA, compression="zstd") as writer:
+        for chunk in chunks:
+            times, values, names = zip(*chunk)
+            writer.write_table(
+                pa.table(
+                    [
+                        pa.array(times, pa.timestamp("us", tz="UTC")),
+                        pa.array(names, pa.string()).dictionary_encode().cast(ARCHIVE_SCHEMA.field("signal").type),
+                        pa.array(values, pa.float64()),
+                    ],
+                    schema=ARCHIVE_SCHEMA,
+                )
+            )
+            yield sink.take()
+    yield sink.take()
@@ -0,0 +1,259 @@
+"""
+File: load_test.py
+Author: Hannah Murphy
+Date: 2024
+Description: Load test for the websocket server. Connects many simulated dashboards
+    which behave like the data page (a 'timer' request on every update) and the
+    history graphs ('send_history'), while publishing probe messages to the MQTT
+    broker. The subscriber passes the probes on to the websocket without storing
+    or caching them. Reports how many clients connected, the latency from a probe
+    being published to MQTT to each client receiving it, history response times
+    and the CPU and memory used by the server.
+    Only runs against a server and broker on this machine, never the live site.
+
+    python load_test.py --clients 1000 --duration 60
+
+Copyright (c) 2024 WESMO. All rights reserved.
+This code is part of the WESMO Data Acquisition and Visualisation Project.
+
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import datetime
+import urllib.parse
+import numpy as np
+import socketio
+from paho.mqtt import client as mqtt_client
+from mqtt_subscriber import HISTORY_SIGNALS, HISTORY_GROUPS, PROBE_PREFIX, port, topic, username, password
+
+""" GLOBAL VARIABLES """
+LOCAL_HOSTS = ("localhost", "127.0.0.1", "::1")
+MODES = ("legacy", "deltas", "msgpack")
+CONNECT_CONCURRENCY = 100
+
+
+class Stats:
+    def __init__(self):
+        self.connected = 0
+        self.failed = 0
+        self.disconnected = 0
+        self.fan_out = []
+        self.history = []
+        self.timer_replies = 0
+
+
+def probe_latency(probe):
+    """Returns the seconds since a probe was published."""
+    return time.time() - probe["time"]
+
+
+async def run_client(url, mode, stats, stop, history_interval, connecting):
+    """_summary_
+    One simulated dashboard, connected until stop is set.
+        Args:
+            url (str): The websocket server.
+            mode (str): 'legacy' (the full list as JSON on 'data'), 'deltas' or 'msgpack'.
+            stats (Stats): Where the results are recorded.
+            stop (asyncio.Event): Set at the end of the test.
+            history_interval (float): Mean seconds between history requests.
+            connecting (asyncio.Semaphore): Limits how many clients connect at once.
+    """
+    sio = socketio.AsyncClient(reconnection=False)
+    pending_history = []
+
+    @sio.on("data")
+    async def on_data(data):
+        # The data page asks for the track timer on every update
+        await sio.emit("timer")
+
+    # Probes are pushed to every client, whichever way it receives the values
+    @sio.on("probe")
+    async def on_probe(probes):
+        stats.fan_out += [probe_latency(probe) for probe in probes]
+
+    @sio.on("timerRecieve")
+    async def on_timer(timer):
+        stats.timer_replies += 1
+
+    @sio.on("recieve_historic_data")
+    async def on_history(data):
+        if pending_history:
+            stats.history.append(time.monotonic() - pending_history.pop(0))
+
+    @sio.on("disconnect")
+    async def on_disconnect(*args):
+        if not stop.is_set():
+            stats.disconnected += 1
+
+    query = {"legacy": "", "deltas": "?deltas=1", "msgpack": "?encoding=msgpack"}[mode]
+    try:
+        async with connecting:
+            await sio.connect(url + query, transports=["websocket"], wait_timeout=10)
+    except (socketio.exceptions.ConnectionError, asyncio.TimeoutError, OSError):
+        stats.failed += 1
+        return
+    stats.connected += 1
+
+    names = HISTORY_SIGNALS + list(HISTORY_GROUPS)
+    try:
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(stop.wait(), random.expovariate(1 / history_interval))
+            except asyncio.TimeoutError:
+                pending_history.append(time.monotonic())
+                await sio.emit("send_history", random.choice(names))
+    finally:
+        await sio.disconnect()
+
+
+async def publish_probe(broker, rate, stop):
+    """Publishes probes on the topic the subscriber reads CAN frames from."""
+    client = mqtt_client.Client(mqtt_client.CallbackAPIVersion.VERSION2, f"wesmo-load-test-{os.getpid()}")
+    client.username_pw_set(username, password)
+    client.connect(broker, port)
+    client.loop_start()
+    sequence = 0
+    while not stop.is_set():
+        sequence += 1
+        probe = {"time": time.time(), "value": sequence}
+        client.publish(topic, PROBE_PREFIX + json.dumps(probe), qos=1)
+        try:
+            await asyncio.wait_for(stop.wait(), 1 / rate)
+        except asyncio.TimeoutError:
+            pass
+    client.loop_stop()
+    client.disconnect()
+
+
+""" SERVER USAGE """
+
+
+def find_server_pids():
+    pids = []
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f"/proc/{pid}/cmdline", "rb") as f:
+                args = f.read().split(b"\0")
+        except OSError:
+            continue
+        if any(arg.endswith(b"websocket.py") for arg in args):
+            pids.append(int(pid))
+    return pids
+
+
+def cpu_seconds(pid):
+    with open(f"/proc/{pid}/stat") as f:
+        # utime and stime, counted after the command name which may hold spaces
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def rss_bytes(pid):
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+async def monitor_server(pids, usage, stop):
+    """Samples the CPU time and memory of the server processes every second."""
+    start = time.monotonic()
+    start_cpu = sum(cpu_seconds(pid) for pid in pids)
+    while not stop.is_set():
+        try:
+            usage["peak_rss"] = max(usage["peak_rss"], sum(rss_bytes(pid) for pid in pids))
+            usage["cpu"] = (sum(cpu_seconds(pid) for pid in pids) - start_cpu) / (time.monotonic() - start)
+        except OSError:
+            print(f"{datetime.datetime.now()} -! # The websocket server stopped during the test")
+            return
+        try:
+            await asyncio.wait_for(stop.wait(), 1)
+        except asyncio.TimeoutError:
+            pass
+
+
+""" MAIN """
+
+
+async def load_test(args):
+    stats = Stats()
+    stop = asyncio.Event()
+    pids = args.pid or find_server_pids()
+    usage = {"peak_rss": 0, "cpu": 0.0}
+    tasks = []
+    if pids:
+        tasks.append(asyncio.create_task(monitor_server(pids, usage, stop)))
+    else:
+        print(f"{datetime.datetime.now()} -! # No websocket.py process found, server usage not reported")
+
+    modes = list(MODES) if args.mode == "mixed" else [args.mode]
+    connecting = asyncio.Semaphore(CONNECT_CONCURRENCY)
+
+    async def start_client(i):
+        # Clients are spread over the ramp up rather than all connecting at once
+        await asyncio.sleep(args.ramp * i / args.clients)
+        await run_client(args.url, modes[i % len(modes)], stats, stop, args.history_interval, connecting)
+
+    print(f"{datetime.datetime.now()} - # Connecting {args.clients} clients to {args.url}")
+    tasks += [asyncio.create_task(start_client(i)) for i in range(args.clients)]
+    await asyncio.sleep(args.ramp)
+    stats.fan_out = []
+    tasks.append(asyncio.create_task(publish_probe(args.broker, args.probe_rate, stop)))
+    print(f"{datetime.datetime.now()} - # Measuring for {args.duration} s")
+    await asyncio.sleep(args.duration)
+    stop.set()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    report(args, stats, usage if pids else None)
+
+
+def percentiles(values):
+    if not values:
+        return "no samples"
+    p50, p99 = np.percentile(np.array(values) * 1000, [50, 99])
+    return f"p50 {p50:.1f} ms, p99 {p99:.1f} ms, max {max(values) * 1000:.1f} ms ({len(values)} samples)"
+
+
+def report(args, stats, usage):
+    print(f"{datetime.datetime.now()} - # Load test finished")
+    print(f" # - Clients connected: {stats.connected}/{args.clients}, failed: {stats.failed}")
+    print(f" # - Dropped during the test: {stats.disconnected}")
+    print(f" # - Fan-out latency: {percentiles(stats.fan_out)}")
+    print(f" # - History response time: {percentiles(stats.history)}")
+    print(f" # - Timer replies received: {stats.timer_replies}")
+    if usage is not None:
+        print(f" # - Server CPU: {usage['cpu'] * 100:.0f}% of a core, peak memory {usage['peak_rss'] / 2**20:.0f} MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the websocket server with simulated dashboards.")
+    parser.add_argument("--url", default="http://localhost:5001", help="websocket server, must be on this machine")
+    parser.add_argument("--clients", type=int, default=100, help="simulated dashboards")
+    parser.add_argument("--mode", choices=MODES + ("mixed",), default="legacy", help="how clients receive values")
+    parser.add_argument("--ramp", type=float, default=10, help="seconds over which clients connect")
+    parser.add_argument("--duration", type=float, default=30, help="seconds measured once every client connected")
+    parser.add_argument("--broker", default="localhost", help="MQTT broker the subscriber reads, must be on this machine")
+    parser.add_argument("--probe-rate", type=float, default=10, help="probes published per second")
+    parser.add_argument("--history-interval", type=float, default=10, help="mean seconds between history requests")
+    parser.add_argument("--pid", type=int, action="append", help="server process id(s), found by name by default")
+    args = parser.parse_args()
+
+    if urllib.parse.urlparse(args.url).hostname not in LOCAL_HOSTS:
+        print(f"{datetime.datetime.now()} -! # Refusing to load test {args.url}, only servers on this machine")
+        sys.exit(1)
+    if args.broker not in LOCAL_HOSTS:
+        print(f"{datetime.datetime.now()} -! # Refusing to publish probes to {args.broker}, only brokers on this machine")
+        sys.exit(1)
+    asyncio.run(load_test(args))
+
+
+if __name__ == "__main__":
+    main()
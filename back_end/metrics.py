@@ -0,0 +1,213 @@
+"""
+File: metrics.py
+Author: Hannah Murphy
+Date: 2024
+Description: Lightweight counters, gauges and latency histograms for the backend,
+    exposed on a local HTTP endpoint in the Prometheus text format.
+
+Copyright (c) 2024 WESMO. All rights reserved.
+This code is part of the WESMO Data Acquisition and Visualisation Project.
+
+"""
+
+import time
+import datetime
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+""" GLOBAL VARIABLES
+Histograms use HDR style log-linear buckets over integer microseconds, values
+below 2^(SUB_BUCKET_BITS + 1) are exact and above that every power of two is
+split into 2^SUB_BUCKET_BITS buckets (~25% worst case error). Anything above
+MAX_SHIFT only lands in the +Inf bucket.
+"""
+SUB_BUCKET_BITS = 2
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+LINEAR_LIMIT = SUB_BUCKETS << 1
+MAX_SHIFT = 25
+BUCKET_COUNT = LINEAR_LIMIT + MAX_SHIFT * SUB_BUCKETS
+
+registry = []
+
+
+def bucket_index(value):
+    if value < LINEAR_LIMIT:
+        return value if value > 0 else 0
+    shift = value.bit_length() - (SUB_BUCKET_BITS + 1)
+    return shift * SUB_BUCKETS + (value >> shift)
+
+
+def bucket_upper_bound(index):
+    """Largest value (in microseconds) that falls into the given bucket."""
+    if index < LINEAR_LIMIT:
+        return index
+    shift = index // SUB_BUCKETS - 1
+    mantissa = index % SUB_BUCKETS + SUB_BUCKETS
+    return ((mantissa + 1) << shift) - 1
+
+
+def format_labels(label_names, label_values, extra=""):
+    pairs = [f'{name}="{value}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            values = list(self.values.items())
+        for label_values, value in values:
+            lines.append(f"{self.name}{format_labels(self.label_names, label_values)} {value}")
+        return lines
+
+
+class Gauge:
+    """A gauge whose value is read from a callback when the endpoint is scraped."""
+
+    def __init__(self, name, help_text, callback):
+        self.name = name
+        self.help_text = help_text
+        self.callback = callback
+        registry.append(self)
+
+    def render(self):
+        try:
+            value = self.callback()
+        except Exception as e:
+            print(f"{datetime.datetime.now()} -! # Error reading gauge {self.name}: {e}")
+            return []
+        return [
+            f"# HELP {self.name} {self.help_text}",
+            f"# TYPE {self.name} gauge",
+            f"{self.name} {value}",
+        ]
+
+
+class Histogram:
+    """Latency histogram, observations are recorded in nanoseconds from
+    time.perf_counter_ns() and exported in seconds."""
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.series = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def observe_ns(self, duration_ns, *label_values):
+        micros = duration_ns // 1000
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [[0] * BUCKET_COUNT, 0, 0]
+            index = bucket_index(micros)
+            if index < BUCKET_COUNT:
+                series[0][index] += 1
+            series[1] += duration_ns
+            series[2] += 1
+
+    def observe_since(self, start_ns, *label_values):
+        self.observe_ns(time.perf_counter_ns() - start_ns, *label_values)
+
+    def observe_seconds(self, seconds, *label_values):
+        self.observe_ns(int(seconds * 1e9), *label_values)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            snapshot = [(labels, list(s[0]), s[1], s[2]) for labels, s in self.series.items()]
+        for label_values, buckets, total_ns, count in snapshot:
+            cumulative = 0
+            for index, bucket in enumerate(buckets):
+                cumulative += bucket
+                le = f'le="{(bucket_upper_bound(index) + 1) / 1e6:.6f}"'
+                lines.append(
+                    f"{self.name}_bucket{format_labels(self.label_names, label_values, le)} {cumulative}"
+                )
+            labels = format_labels(self.label_names, label_values)
+            inf = format_labels(self.label_names, label_values, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{inf} {count}")
+            lines.append(f"{self.name}_sum{labels} {total_ns / 1e9:.9f}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+def render_metrics():
+    lines = []
+    for metric in list(registry):
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = render_metrics().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port, host="127.0.0.1"):
+    """_summary_
+    Serves the registered metrics at http://host:port/metrics from a daemon thread.
+        Args:
+            port (int): The port to listen on.
+            host (str): The interface to bind, local only by default.
+    """
+    try:
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+    except OSError as e:
+        print(f"{datetime.datetime.now()} -! # Error starting metrics endpoint on {host}:{port}: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"{datetime.datetime.now()} - # Metrics available at http://{host}:{port}/metrics")
+    return server
+
+
+""" INGESTION METRICS
+Shared by mqtt_subscriber.py and database.py, the stage label is one of
+parse, decode, db_write or redis_write.
+"""
+stage_latency = Histogram(
+    "wesmo_ingest_stage_seconds",
+    "Time spent in each stage of handling a CAN frame.",
+    ("stage", "translator"),
+)
+end_to_end_latency = Histogram(
+    "wesmo_ingest_end_to_end_seconds",
+    "Time from the Raspberry Pi frame timestamp until the frame is fully handled.",
+)
+frames_total = Counter(
+    "wesmo_frames_total",
+    "CAN frames received over MQTT.",
+    ("can_id",),
+)
+errors_total = Counter(
+    "wesmo_errors_total",
+    "Errors raised while handling frames.",
+    ("stage",),
+)
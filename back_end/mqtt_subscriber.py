@@ -9,51 +9,126 @@ This code is part of the WESMO Data Acquisition and Visualisation Project.
 
 """
 
+import os
+import socket
+import hashlib
 import requests
 import threading
-import random
 import redis
 import pickle
+import json
 import datetime
+import time
+import signal
+from time import perf_counter_ns
+import numpy as np
+import metrics
+from downsample import downsample, METHODS
 from paho.mqtt import client as mqtt_client
+from paho.mqtt.properties import Properties
+from paho.mqtt.packettypes import PacketTypes
 from MCTranslatorClass import MCTranslator
 from BMSTranslatorClass import BMSTranslator
 from VCUTranslatorClass import VCUTranslator
+from FrameEngines import FrameEngines
+from DatabaseWriter import DatabaseWriter
+from SessionArchiver import SessionArchiver
+from StorageBackend import PostgresBackend, open_storage
 from database import (
-    start_postgresql,
-    setup_db,
     connect_to_db,
-    create_mc_table,
     save_to_db_mc,
     save_to_db_bms,
-    create_bms_table,
-    create_vcu_table,
     save_to_db_vcu,
 )
 
 
 """ GLOBAL VARIABLES
 Set the Parameter of MQTT Broker Connection
-Set the address, port and topic of MQTT Broker connection. 
-At the same time, we call the Python function random.randint 
-to randomly generate the MQTT client id.
+Set the address, port and topic of MQTT Broker connection.
+The client id is stable across restarts so the broker can resume the
+persistent session (and redeliver any unacknowledged QoS 1 frames).
+Set WESMO_MQTT_CLIENT_ID per instance when running more than one subscriber,
+and WESMO_MQTT_SHARE_GROUP to have the instances split the topic between them
+using an MQTT v5 shared subscription. WESMO_MQTT_BROKER points a local copy at
+a local broker, e.g. for load_test.py.
 """
-broker = "52.64.83.72"
+broker = os.environ.get("WESMO_MQTT_BROKER", "52.64.83.72")
 port = 1883
 topic = "/wesmo-data"
-client_id = f"wesmo-{random.randint(0, 100)}"
+client_id = os.environ.get("WESMO_MQTT_CLIENT_ID", f"wesmo-subscriber-{socket.gethostname()}")
+share_group = os.environ.get("WESMO_MQTT_SHARE_GROUP", "")
+qos = 1
+session_expiry = int(os.environ.get("WESMO_MQTT_SESSION_EXPIRY", 3600))
 username = "wesmo"
 password = "public"
 client_list = []
+metrics_port = int(os.environ.get("WESMO_METRICS_PORT", 9108))
+spill_dir = os.environ.get("WESMO_SPILL_DIR", "spill")
+archive_dir = os.environ.get("WESMO_ARCHIVE_DIR", "archive")
+retention_days = int(os.environ.get("WESMO_RETENTION_DAYS", 7))
+
+# Redelivered frames are recognised by a key derived from the raw frame, kept
+# in a separate Redis db so it never shows up in the latest data cache.
+DEDUP_DB = 1
+DEDUP_TTL = 600
+
+# Every frame's values are published here as JSON for the websocket to push out
+CHANGE_CHANNEL = "wesmo:changes"
+cache_client = None
+
+# Load test probes (messages starting with PROBE_PREFIX) are passed on to the
+# websocket here as they are, never decoded, stored or cached
+PROBE_PREFIX = "PROBE "
+PROBE_CHANNEL = "wesmo:probe"
+
+# Alarms raised or cleared are published here as soon as the frame is decoded,
+# the active ones are kept in a hash in their own Redis db for new dashboards
+ALARM_CHANNEL = "wesmo:alarms"
+ALARM_DB = 3
+ACTIVE_ALARMS_KEY = "wesmo:active_alarms"
+alarm_client = None
 
 TIMEOUT = 30
 timeout_timer = None
 is_timed_out = False
 
+""" HISTORY
+Signals the dashboard can request the history of, the grouped names return
+the rows of several signals together.
+"""
+HISTORY_LIMIT = 50
+HISTORY_SIGNALS = [
+    "Motor Temperature",
+    "Motor Speed",
+    "DC Link Circuit Voltage",
+    "Battery Temperature",
+    "Battery Current",
+    "Battery State of Charge",
+    "Battery Voltage",
+    "Battery Power",
+    "Battery Energy Used",
+    "Battery DCL",
+    "Battery Status",
+    "Battery Checksum",
+    "Predictive State of Charge",
+    "Wheel Slip",
+]
+HISTORY_GROUPS = {
+    "Wheel Speed": ["Wheel Speed RR", "Wheel Speed RL", "Wheel Speed FR", "Wheel Speed FL"],
+    "Brakes and APPS": [
+        "Break Pressure Rear",
+        "Break Pressure Front",
+        "Accelerator Travel 1",
+        "Accelerator Travel 2",
+    ],
+}
+
 """ COMPONENT TRANSLATORS """
 mc_translator = MCTranslator()
 bms_translator = BMSTranslator()
 vcu_translator = VCUTranslator()
+# The derived signals, alarms and laps, built when the subscriber starts
+frame_engines = None
 
 
 """
@@ -110,63 +185,148 @@ def query_latest(data_name):
         return None
 
 
-def cache_data(time, value):
-    redis_client = redis.Redis(host="localhost", port=6379, db=0)
-    try:
-        redis_key = value["name"]
-        redis_value = {
+def cache_frame(time, values):
+    """_summary_
+    Stores the latest value of every signal in a frame and announces them on
+    CHANGE_CHANNEL, in a single round trip to Redis.
+        Args:
+            time (list): The split frame timestamp.
+            values (list): The decoded values of the frame.
+    """
+    global cache_client
+    if cache_client is None:
+        cache_client = start_redis()
+    records = [
+        {
             "time": time[1] + " " + time[2],
             "name": value["name"],
             "value": value["value"],
             "unit": value["unit"],
         }
-        redis_client.set(
-            redis_key,
-            pickle.dumps(redis_value),
-        )
+        for value in values
+    ]
+    try:
+        redis_start = perf_counter_ns()
+        pipe = cache_client.pipeline(transaction=False)
+        for record in records:
+            pipe.set(record["name"], pickle.dumps(record))
+        pipe.publish(CHANGE_CHANNEL, json.dumps(records, default=str))
+        pipe.execute()
+        metrics.stage_latency.observe_since(redis_start, "redis_write", "")
+    except Exception as e:
+        metrics.errors_total.inc("redis_write")
+        print(f"{datetime.datetime.now()} -! # Error caching {len(records)} values: {e}")
+
+
+def publish_alarms(alarms):
+    """_summary_
+    Publishes alarms raised or cleared on ALARM_CHANNEL and keeps the active
+    ones in ACTIVE_ALARMS_KEY, in a single round trip to Redis.
+        Args:
+            alarms (list): The alarms from AlarmRules.evaluate.
+    """
+    try:
+        pipe = get_alarm_client().pipeline(transaction=False)
+        for alarm in alarms:
+            if alarm["state"] == "raised":
+                pipe.hset(ACTIVE_ALARMS_KEY, alarm["id"], json.dumps(alarm, default=str))
+            else:
+                pipe.hdel(ACTIVE_ALARMS_KEY, alarm["id"])
+        pipe.publish(ALARM_CHANNEL, json.dumps(alarms, default=str))
+        pipe.execute()
     except Exception as e:
-        print(f"{datetime.datetime.now()} -! # Error with {redis_key}: {e}")
+        metrics.errors_total.inc("alarm_publish")
+        print(f"{datetime.datetime.now()} -! # Error publishing {len(alarms)} alarms: {e}")
+    for alarm in alarms:
+        description = alarm["message"] if alarm["state"] == "raised" else alarm["id"]
+        print(f"{datetime.datetime.now()} - # Alarm {alarm['state']}: {description}")
 
 
-def query_data(data_name, cursor, conn):
+def clear_alarms():
+    """_summary_
+    Clears every active alarm, those left in ACTIVE_ALARMS_KEY by a previous run
+    included, publishing them as cleared so the dashboards drop them too.
+    """
+    frame_engines.alarm_rules.reset()
     try:
-        if (
-            data_name == "Motor Temperature"
-            or data_name == "Motor Speed"
-            or data_name == "DC Link Circuit Voltage"
-        ):
-            query = f"SELECT time, value from MOTOR_CONTROLLER where name = '{data_name}' ORDER BY time DESC LIMIT 50;"
-        elif data_name == "Wheel Speed":
-            query = f"SELECT time, value, name FROM VEHICLE_CONTROLL_UNIT WHERE name IN ('Wheel Speed RR', 'Wheel Speed RL', 'Wheel Speed FR', 'Wheel Speed FL') ORDER BY time DESC LIMIT 50;"
-        elif data_name == "Brakes and APPS":
-            query = f"SELECT time, value, name FROM VEHICLE_CONTROLL_UNIT WHERE name IN ('Break Pressure Rear', 'Break Pressure Front', 'Accelerator Travel 1', 'Accelerator Travel 2') ORDER BY time DESC LIMIT 50;"
-        elif (
-            data_name == "Battery Temperature"
-            or data_name == "Battery Current"
-            or data_name == "Battery State of Charge"
-            or data_name == "Battery Voltage"
-            or data_name == "Battery Power"
-            or data_name == "Battery DCL"
-            or data_name == "Battery Status"
-            or data_name == "Battery Checksum"
-            or data_name == "Predictive State of Charge"
-        ):
-            query = f"SELECT time, value from BATTERY_MANAGEMENT_SYSTEM where name = '{data_name}' ORDER BY time DESC LIMIT 50;"
-        else:
+        stored = get_alarm_client().hgetall(ACTIVE_ALARMS_KEY)
+    except Exception as e:
+        metrics.errors_total.inc("alarm_publish")
+        print(f"{datetime.datetime.now()} -! # Error reading active alarms: {e}")
+        return
+    now = str(datetime.datetime.now())
+    alarms = [dict(json.loads(alarm), state="cleared", time=now) for alarm in stored.values()]
+    if alarms:
+        publish_alarms(alarms)
+
+
+def get_alarm_client():
+    global alarm_client
+    if alarm_client is None:
+        alarm_client = redis.Redis(host="localhost", port=6379, db=ALARM_DB)
+    return alarm_client
+
+
+def frame_key(msg, raw_data):
+    """Returns the key a QoS 1 frame is recognised by when redelivered, None for QoS 0."""
+    if msg.qos == 0:
+        return None
+    return f"frame:{hashlib.blake2b(raw_data.encode(), digest_size=16).hexdigest()}"
+
+
+def is_duplicate_frame(msg, key):
+    """_summary_
+    Reports whether a frame is a redelivery of one whose rows are already stored.
+    Only frames the broker flags as a redelivery are checked, identical frames
+    sent twice by the car are still kept.
+        Args:
+            msg (MQTTMessage): The received MQTT message.
+            key (str): The frame's key from frame_key.
+        Returns:
+            bool: True if the frame is a redelivery of a frame already stored.
+    """
+    if key is None or not msg.dup:
+        return False
+    try:
+        return bool(dedup_client.exists(key))
+    except redis.RedisError as e:
+        print(f"{datetime.datetime.now()} -! # Error checking frame key {key}: {e}")
+        return False
+
+
+def record_frames(keys):
+    """_summary_
+    Records the keys of frames whose rows have been stored or spilled, called
+    by the database writer. A frame redelivered before its key is recorded,
+    e.g. after a crash with its rows still queued in memory, is processed again.
+        Args:
+            keys (list): Keys from frame_key.
+    """
+    try:
+        pipe = dedup_client.pipeline(transaction=False)
+        for key in keys:
+            pipe.set(key, 1, ex=DEDUP_TTL)
+        pipe.execute()
+    except redis.RedisError as e:
+        print(f"{datetime.datetime.now()} -! # Error recording {len(keys)} frame keys: {e}")
+
+
+def query_data(data_name, storage):
+    try:
+        names = history_names(data_name)
+        if names is None:
             print(f"{datetime.datetime.now()} -! #  ERROR: Data '{data_name}' does not exist in database.")
+            return None
 
-        cursor.execute(query)
-        data = cursor.fetchall()
+        data = storage.query_history(names, HISTORY_LIMIT)
         converted_data = []
 
-        if data_name == "Wheel Speed" or data_name == "Brakes and APPS":
+        if data_name in HISTORY_GROUPS:
             for dt, value, name in data:
                 timestamp = int(dt.timestamp())
-                converted_data.append(
-                    {"timestamp": timestamp, "value": value, "name": name.strip()}
-                )
+                converted_data.append({"timestamp": timestamp, "value": value, "name": name})
         else:
-            for dt, value in data:
+            for dt, value, name in data:
                 timestamp = int(dt.timestamp())
                 converted_data.append({"timestamp": timestamp, "value": value})
         return converted_data
@@ -174,6 +334,116 @@ def query_data(data_name, cursor, conn):
         print(f"{datetime.datetime.now()} -! # Error collecting data from: {e}")
 
 
+def history_names(data_name):
+    if data_name in HISTORY_GROUPS:
+        return HISTORY_GROUPS[data_name]
+    if data_name in HISTORY_SIGNALS:
+        return [data_name]
+    return None
+
+
+def query_window(request, storage):
+    """_summary_
+    Returns the history of signals over a time window, read from the rollup
+    whose resolution suits the width of the chart. When 'points' is given each
+    signal is downsampled to at most that many points, keeping its shape.
+        Args:
+            request (dict): 'name' (a signal or group) or 'names' (a list of them),
+                optional 'start' and 'end' as epoch seconds (defaulting to the open
+                session and now), 'width' in pixels, 'points' and 'method'
+                ('lttb' or 'minmax', see downsample.py).
+        Returns:
+            dict: The name(s), resolution in seconds (0 for raw) and data points.
+    """
+    try:
+        data_name = request.get("names", request.get("name"))
+        names = []
+        for requested in data_name if isinstance(data_name, list) else [data_name]:
+            requested_names = history_names(requested)
+            if requested_names is None:
+                print(f"{datetime.datetime.now()} -! #  ERROR: Data '{requested}' does not exist in database.")
+                return None
+            names += [name for name in requested_names if name not in names]
+
+        end = request.get("end")
+        end = datetime.datetime.fromtimestamp(end, datetime.timezone.utc) if end else datetime.datetime.now(datetime.timezone.utc)
+        start = request.get("start")
+        start = datetime.datetime.fromtimestamp(start, datetime.timezone.utc) if start else storage.session_start()
+        if start is None:
+            start = end - datetime.timedelta(minutes=5)
+        points = request.get("points")
+        # Read no finer than the points asked for, the rest is done by downsampling
+        width = int(request.get("width", points or 1000))
+
+        resolution, rows = storage.query_history_window(names, start, end, width)
+        converted_data = []
+        if resolution == 0:
+            for dt, value, name in rows:
+                converted_data.append({"timestamp": dt.timestamp(), "value": value, "name": name})
+        else:
+            for dt, mean, minimum, maximum, last, name in rows:
+                converted_data.append(
+                    {"timestamp": dt.timestamp(), "value": mean, "min": minimum, "max": maximum, "last": last, "name": name}
+                )
+        response = {"name": data_name, "resolution": resolution, "data": converted_data}
+
+        if points:
+            method = request.get("method", "lttb")
+            if method not in METHODS:
+                print(f"{datetime.datetime.now()} -! #  ERROR: Unknown downsampling method '{method}'.")
+                return None
+            response["data"] = downsample_points(converted_data, int(points), method)
+            response["method"] = method
+        return response
+    except Exception as e:
+        print(f"{datetime.datetime.now()} -! # Error collecting data window: {e}")
+
+
+def query_laps(session_id, storage):
+    """_summary_
+    Returns the laps of a stint with their aggregates, from the lap table rather
+    than the raw telemetry.
+        Args:
+            session_id (int): The stint's session, None for the latest stint with laps.
+        Returns:
+            dict: The session id and its laps by number, times as epoch seconds.
+    """
+    try:
+        if session_id is not None and not isinstance(session_id, int):
+            print(f"{datetime.datetime.now()} -! #  ERROR: Session must be a number, got '{session_id}'.")
+            return None
+        session_id, laps = storage.query_laps(session_id)
+        for lap in laps:
+            lap["started_at"] = lap["started_at"].timestamp()
+            lap["ended_at"] = lap["ended_at"].timestamp()
+        return {"session": session_id, "laps": laps}
+    except Exception as e:
+        print(f"{datetime.datetime.now()} -! # Error collecting laps: {e}")
+
+
+def downsample_points(converted_data, points, method):
+    """_summary_
+    Downsamples each signal of a history window separately.
+        Args:
+            converted_data (list): Points as returned by query_window, oldest first.
+        Returns:
+            list: The kept points, still oldest first.
+    """
+    by_name = {}
+    for position, point in enumerate(converted_data):
+        by_name.setdefault(point["name"], []).append(position)
+
+    kept = []
+    for positions in by_name.values():
+        positions = np.array(positions)
+        times = np.array([converted_data[p]["timestamp"] for p in positions], dtype=np.float64)
+        values = np.array([converted_data[p]["value"] for p in positions], dtype=np.float64)
+        kept.append(positions[downsample(times, values, points, method)])
+    if not kept:
+        return []
+    return [converted_data[p] for p in np.sort(np.concatenate(kept))]
+
+
 """
         MQTT
 """
@@ -190,14 +460,36 @@ def connect_mqtt() -> mqtt_client:
     def on_connect(client, userdata, flags, reason_code, properties=None):
         if reason_code != 0:
             print("Failed to connect, return code %d\n", reason_code)
-
-    client = mqtt_client.Client(mqtt_client.CallbackAPIVersion.VERSION2, client_id)
+            return
+        print(f"{datetime.datetime.now()} - # Connected as {client_id}, session present: {flags.session_present}")
+        # (Re)subscribe on every connect, the broker keeps the subscription
+        # for a resumed session but a fresh session needs it again.
+        client.subscribe(subscription_topic(), qos=qos)
+
+    client = mqtt_client.Client(
+        mqtt_client.CallbackAPIVersion.VERSION2,
+        client_id,
+        protocol=mqtt_client.MQTTv5,
+    )
     client.username_pw_set(username, password)
     client.on_connect = on_connect
-    client.connect(broker, port)
+
+    properties = Properties(PacketTypes.CONNECT)
+    properties.SessionExpiryInterval = session_expiry
+    client.connect(broker, port, clean_start=False, properties=properties)
     return client
 
 
+def subscription_topic():
+    """_summary_
+    Returns the topic filter to subscribe to, the '$share/' form is used when
+    a share group is configured so each frame goes to only one subscriber.
+    """
+    if share_group:
+        return f"$share/{share_group}/{topic}"
+    return topic
+
+
 def subscribe(client: mqtt_client, redis_client):
     """_summary_
     Subscribes to the CAN messages using MQTT.
@@ -212,9 +504,19 @@ def subscribe(client: mqtt_client, redis_client):
         if is_timed_out:
             on_timeout(False)
         data = []
+        parse_start = time.perf_counter_ns()
         raw_data = msg.payload.decode()
+        if raw_data.startswith(PROBE_PREFIX):
+            forward_probe(raw_data[len(PROBE_PREFIX) :])
+            return
+        key = frame_key(msg, raw_data)
+
+        if raw_data != "None" and not is_duplicate_frame(msg, key):
+            fields = raw_data.split()
+            can_id = fields[3].lstrip("0") if len(fields) > 3 else "unknown"
+            metrics.frames_total.inc(can_id)
+            metrics.stage_latency.observe_since(parse_start, "parse", "")
 
-        if raw_data != "None":
             # Motor Controller
             if (
                 "ID:      181" in raw_data
@@ -222,17 +524,25 @@ def subscribe(client: mqtt_client, redis_client):
                 or "ID:      381" in raw_data
                 or "ID:      481" in raw_data
             ):
+                decode_start = time.perf_counter_ns()
                 data = mc_translator.decode(raw_data)
+                metrics.stage_latency.observe_since(decode_start, "decode", "mc")
                 if data != []:
-                    save_to_db_mc(cursor, conn, data, data[1])
+                    save_to_db_mc(db_writer, frame_engines, data, data[1])
+                else:
+                    metrics.errors_total.inc("decode")
 
             # Battery Management System
             if (
                 "ID:      04d" in raw_data
             ):
+                decode_start = time.perf_counter_ns()
                 data = bms_translator.decode(raw_data)
+                metrics.stage_latency.observe_since(decode_start, "decode", "bms")
                 if data != []:
-                    save_to_db_bms(cursor, conn, data)
+                    save_to_db_bms(db_writer, frame_engines, data)
+                else:
+                    metrics.errors_total.inc("decode")
 
             # Vehicle Control Unit
             elif (
@@ -241,16 +551,45 @@ def subscribe(client: mqtt_client, redis_client):
                 or "ID:      012" in raw_data
                 or "ID:      201" in raw_data
             ):
+                decode_start = time.perf_counter_ns()
                 data = vcu_translator.decode(raw_data)
+                metrics.stage_latency.observe_since(decode_start, "decode", "vcu")
 
                 if data is not None:
                     if len(data) > 1:
-                        save_to_db_vcu(cursor, conn, data)
+                        save_to_db_vcu(db_writer, frame_engines, data)
+                else:
+                    metrics.errors_total.inc("decode")
+
+            observe_end_to_end(fields)
+            if key is not None:
+                db_writer.put_frame(key)
 
-    client.subscribe(topic)
     client.on_message = on_message
 
 
+def forward_probe(probe):
+    try:
+        redis_client.publish(PROBE_CHANNEL, probe)
+    except Exception as e:
+        metrics.errors_total.inc("redis_write")
+        print(f"{datetime.datetime.now()} -! # Error forwarding load test probe: {e}")
+
+
+def observe_end_to_end(fields):
+    """_summary_
+    Records the time from the Raspberry Pi timestamp of the frame until now.
+    Simulated frames are stamped 0 so are skipped.
+    """
+    try:
+        frame_time = float(fields[1])
+    except (IndexError, ValueError):
+        return
+    latency = time.time() - frame_time
+    if frame_time > 0 and latency >= 0:
+        metrics.end_to_end_latency.observe_seconds(latency)
+
+
 def reset_timeout():
     global timeout_timer
     if timeout_timer:
@@ -264,6 +603,8 @@ def on_timeout(timeout):
     url = "http://localhost:5001/timeout"
     is_timed_out = not is_timed_out
     redis_client.flushdb()
+    if timeout:
+        clear_alarms()
     try:
         response = requests.post(
             url, json={"timeout": timeout}, headers={"Content-Type": "application/json"}
@@ -276,26 +617,56 @@ def on_timeout(timeout):
 
 def start_mqtt_subscriber():
     # Connect & Set up DB
-    global cursor, conn, redis_client
-    cursor, conn = start_postgresql()
-    setup_db(cursor, conn)
-    cursor, conn = connect_to_db()
-
-    # Create DB tables
-    create_mc_table(cursor, conn)
-    create_bms_table(cursor, conn)
-    create_vcu_table(cursor, conn)
+    global redis_client, dedup_client, db_writer, frame_engines
+    storage = open_storage()
+    storage.setup()
+
+    # Closed sessions are archived and old partitions dropped in the background,
+    # the segment store keeps everything in its own files
+    on_session_closed = None
+    if isinstance(storage, PostgresBackend):
+        archiver = SessionArchiver(connect_to_db, archive_dir, retention_days)
+        archiver.start()
+        on_session_closed = archiver.session_closed
+
+    # Rows are written from a background thread, spilling to disk if needed
+    db_writer = DatabaseWriter(
+        storage, spill_dir, on_session_closed=on_session_closed, on_frames_stored=record_frames
+    )
+    db_writer.start()
+
+    # The derived signals, alarms and laps follow each signal from frame to frame,
+    # they would be wrong from the share of the frames each instance is given
+    frame_engines = FrameEngines(cache_frame, publish_alarms, enabled=not share_group)
 
     global is_timed_out
     is_timed_out = False
     # Initialize Redis connection
     redis_client = start_redis()
+    dedup_client = redis.Redis(host="localhost", port=6379, db=DEDUP_DB)
+    clear_alarms()
+
+    metrics.start_metrics_server(metrics_port)
+    if not frame_engines.enabled:
+        print(
+            f"{datetime.datetime.now()} -! # Sharing frames through '{share_group}', "
+            "derived signals, alarms and laps are turned off"
+        )
 
     # Set up MQTT communications
     reset_timeout()
     client = connect_mqtt()
     subscribe(client, redis_client)
-    client.loop_forever()
+
+    # supervisord stops the program with SIGTERM, exit through the finally
+    # block so rows still queued in memory are spilled to disk.
+    signal.signal(signal.SIGTERM, lambda signum, frame: client.disconnect())
+    try:
+        client.loop_forever()
+    finally:
+        if timeout_timer:
+            timeout_timer.cancel()
+        db_writer.stop()
 
 
 def main():
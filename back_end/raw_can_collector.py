@@ -38,17 +38,15 @@ def connect_mqtt() -> mqtt_client:
 
 
 def subscribe(client: mqtt_client):
+    # One file from the time the script connects, one frame per line (see convert_can_logs.py)
+    file_name = "raw_can_" + datetime.now().strftime("%Y-%m-%d %H-%M-%S") + ".txt"
+
     def on_message(client, userdata, msg):
         raw_data = msg.payload.decode()
 
         if raw_data != "None":
-            current_datetime = datetime.now().strftime("%Y-%m-%d %H-%M-%S")
-            str_current_datetime = str(current_datetime)
-
-            file_name = "raw_can_" + str_current_datetime + ".txt"
             file = open(file_name, "a")
-            file.writeline("\n")
-            file.writeline(str(raw_data))
+            file.write(str(raw_data) + "\n")
             file.close()
 
     client.subscribe(topic)
@@ -8,28 +8,122 @@ Copyright (c) 2024 WESMO. All rights reserved.
 This code is part of the WESMO Data Acquisition and Visualisation Project.
 """
 
+import os
+
+# gevent (the default) serves every connection from a greenlet on one event
+# loop. The standard library and psycopg2 are patched before anything else is
+# imported so sockets, locks, sleeps and queries yield to other greenlets
+# instead of blocking the process. WESMO_ASYNC_MODE=threading runs the old
+# threaded development server, for debugging. Nothing is patched when this file
+# is only imported, e.g. by engineio looking for the websocket-client package.
+ASYNC_MODE = os.environ.get("WESMO_ASYNC_MODE", "gevent")
+if ASYNC_MODE == "gevent" and __name__ == "__main__":
+    from gevent import monkey
+
+    monkey.patch_all()
+    from psycogreen.gevent import patch_psycopg
+
+    patch_psycopg()
+
+import json
+import time
+import uuid
 import logging
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 import datetime
-from flask import Flask, request, jsonify
-from flask_socketio import SocketIO
+import redis
+from flask import Flask, Response, request, jsonify
+from flask_socketio import SocketIO, join_room, leave_room, rooms
 from flask_cors import CORS
 from mqtt_subscriber import (
     query_data,
+    query_window,
+    query_laps,
     query_all_latest_data,
-    connect_to_db,
+    history_names,
+    CHANGE_CHANNEL,
+    PROBE_CHANNEL,
+    ALARM_CHANNEL,
+    ALARM_DB,
+    ACTIVE_ALARMS_KEY,
+    HISTORY_GROUPS,
 )
-from database import export_and_clear_database
+from StorageBackend import open_storage, StorageUnavailable, POOL_SIZE
+from export import encode_export, FORMATS
+from HistoryCache import HistoryCache, MISSING
+import metrics
+from HotHistory import HotHistory
 from TrackTimer import TrackTimer
+from DashboardState import DashboardState, SIGNAL_GROUPS, ENCODINGS
 
 """ GLOBAL VARIABLES """
 app = Flask(__name__)
 CORS(app)
-socketio = SocketIO(app, cors_allowed_origins="*")
+
+# Several workers can run behind nginx (see config_files), each on its own port.
+# Every worker listens to the change feed itself and only emits to its own
+# clients, the message queue is only needed for emits made from outside a
+# worker. The timeout and track timer are shared between workers through Redis.
+WEBSOCKET_PORT = int(os.environ.get("WESMO_WEBSOCKET_PORT", 5001))
+MESSAGE_QUEUE = os.environ.get("WESMO_MESSAGE_QUEUE")
+WORKER_ID = uuid.uuid4().hex
+CONTROL_CHANNEL = "wesmo:control"
+CONTROL_STATE_KEY = "wesmo:control_state"
+STATE_DB = 2
+
+# A client is sent a ping every PING_INTERVAL seconds and dropped if it doesn't
+# answer within PING_TIMEOUT. A client with more than MAX_CLIENT_BACKLOG
+# packets still waiting to be sent is skipped by live updates until it catches up.
+PING_INTERVAL = int(os.environ.get("WESMO_PING_INTERVAL", 10))
+PING_TIMEOUT = int(os.environ.get("WESMO_PING_TIMEOUT", 20))
+MAX_CLIENT_BACKLOG = int(os.environ.get("WESMO_MAX_CLIENT_BACKLOG", 20))
+
+socketio = SocketIO(
+    app,
+    async_mode=ASYNC_MODE,
+    message_queue=MESSAGE_QUEUE,
+    cors_allowed_origins="*",
+    ping_interval=PING_INTERVAL,
+    ping_timeout=PING_TIMEOUT,
+    max_http_buffer_size=64 * 1024,
+)
 client_list = []
 timeout = False
 track_timer = None
 on_track = False
 
+# Latest value of every signal, kept up to date from the change feed published
+# by mqtt_subscriber.py. Updates are pushed at most MAX_BROADCAST_RATE times a
+# second, and only when something changed. Clients are in one of two rooms,
+# LEGACY_ROOM gets the full list of values on 'data', DELTA_ROOM gets only the
+# changed values on 'delta' (see DashboardState.py). Clients subscribed to
+# signal groups are instead in one room per group and get 'group_data'.
+# Clients asking for a binary encoding of the values are in a copy of each room
+# per encoding, so every update is encoded once per room and encoding.
+MAX_BROADCAST_RATE = float(os.environ.get("WESMO_MAX_BROADCAST_RATE", 20))
+LEGACY_ROOM = "legacy"
+DELTA_ROOM = "deltas"
+dashboard_state = DashboardState()
+client_encodings = {}
+
+# Alarms are pushed to every client on 'alarm' as soon as they arrive, not
+# with the next update, new clients are sent those active on 'alarms'
+active_alarms = {}
+
+# Points of history kept in memory per signal for recent history requests
+HOT_HISTORY_POINTS = int(os.environ.get("WESMO_HOT_HISTORY_POINTS", 30000))
+
+# Queries of history batches, as many at once as there are pooled connections
+batch_executor = ThreadPoolExecutor(max_workers=POOL_SIZE, thread_name_prefix="history-batch")
+
+# History responses shared by clients asking for the same thing
+history_cache = HistoryCache(
+    max_bytes=int(os.environ.get("WESMO_HISTORY_CACHE_MB", 64)) * 2**20,
+    ttl=float(os.environ.get("WESMO_HISTORY_CACHE_TTL", 60)),
+    live_ttl=float(os.environ.get("WESMO_HISTORY_CACHE_LIVE_TTL", 1)),
+)
+
 # Suppress socket logging
 logging.basicConfig(level=logging.ERROR)
 logging.getLogger("engineio").setLevel(logging.WARNING)
@@ -40,11 +134,11 @@ logging.getLogger("werkzeug").setLevel(logging.WARNING)
 
 @app.route("/timeout", methods=["POST"])
 def set_timeout():
-    global timeout
     data = request.get_json()
 
     if "timeout" in data and isinstance(data["timeout"], bool):
-        timeout = data["timeout"]
+        apply_control({"timeout": data["timeout"]})
+        publish_control()
         return jsonify({"message": "Timeout detected", "timeout": timeout}), 200
     else:
         return jsonify({"error": "Invalid data"}), 400
@@ -63,9 +157,13 @@ def create_timer():
         on_track = True
         track_timer.start_timer()
         print(f"{datetime.datetime.now()} - # Starting timer - on_track: {on_track}, track_timer: {track_timer}")
+        publish_control()
 
     if on_track and track_timer:
+        started = track_timer.timer_started
         time = track_timer.check_timer(data)
+        if track_timer.timer_started != started:
+            publish_control()
         return jsonify({"message": "Timer Update", "timer": time}), 200
 
     return (
@@ -80,16 +178,16 @@ def create_timer():
 
 @app.route("/track-timer", methods=["DELETE"])
 def delete_timer():
-    global track_timer, on_track, cursor, conn
+    global track_timer, on_track
 
     if on_track:
         on_track = False
     if track_timer is not None:
         track_timer.reset_timer()
         track_timer = None
-        export_and_clear_database(cursor, conn)
 
     print(f"{datetime.datetime.now()} - # Deleteing timer - on_track: {on_track}, track_timer: {track_timer}")
+    publish_control()
 
     return (
         jsonify(
@@ -101,45 +199,469 @@ def delete_timer():
     )
 
 
+@app.route("/metrics", methods=["GET"])
+def serve_metrics():
+    return Response(metrics.render_metrics(), content_type="text/plain; version=0.0.4")
+
+
+""" HTTP ROUTE FOR EXPORT """
+
+
+@app.route("/export", methods=["GET"])
+def export_data():
+    """_summary_
+    Streams the raw rows of signals over a time range as a file download, e.g.
+    /export?names=Motor Speed,Battery&start=1714521600&end=1714525200&format=parquet
+        Args (query string):
+            names: Comma separated signal names or history groups.
+            start, end: Epoch seconds, by default the start of the open session and now.
+            format: 'csv' (default), 'ndjson' or 'parquet'.
+    """
+    export_format = request.args.get("format", "csv")
+    if export_format not in FORMATS:
+        return jsonify({"error": f"Unknown format, use one of {', '.join(FORMATS)}"}), 400
+    names = []
+    for requested in request.args.get("names", "").split(","):
+        names += [name for name in HISTORY_GROUPS.get(requested, [requested]) if name and name not in names]
+    if not names:
+        return jsonify({"error": "No signals requested"}), 400
+
+    try:
+        end = request.args.get("end", type=float)
+        end = datetime.datetime.fromtimestamp(end, datetime.timezone.utc) if end else datetime.datetime.now(datetime.timezone.utc)
+        start = request.args.get("start", type=float)
+        start = datetime.datetime.fromtimestamp(start, datetime.timezone.utc) if start else history.session_start()
+        if start is None:
+            return jsonify({"error": "No start given and no session open"}), 400
+
+        # The first chunk is read now so a database failure is an error response
+        # rather than an empty file
+        rows = history.export_rows(names, start, end)
+        first = next(rows, None)
+    except StorageUnavailable as e:
+        print(f"{datetime.datetime.now()} -! # Export unavailable: {e}")
+        return jsonify({"error": "Storage unavailable, try again later"}), 503
+
+    content_type, extension = FORMATS[export_format]
+    chunks = itertools.chain([] if first is None else [first], rows)
+    print(f"{datetime.datetime.now()} - # Exporting {len(names)} signals from {start} to {end} as {export_format}")
+    response = Response(
+        encode_export(chunks, export_format),
+        content_type=content_type,
+        headers={"Content-Disposition": f"attachment; filename=wesmo-{start:%Y%m%d-%H%M%S}.{extension}"},
+    )
+    # Called when the response is finished or the client disconnects, which
+    # ends the query and frees the connection
+    response.call_on_close(rows.close)
+    return response
+
+
+""" SHARED STATE """
+
+
+def control_state():
+    return {"timeout": timeout, "on_track": on_track, "track_timer": track_timer and track_timer.state()}
+
+
+def publish_control():
+    """_summary_
+    Shares the timeout and track timer with the other workers. The state is
+    also stored so a worker started later picks it up.
+    """
+    message = json.dumps({"worker": WORKER_ID, **control_state()})
+    try:
+        client = redis.Redis(host="localhost", port=6379, db=STATE_DB)
+        client.set(CONTROL_STATE_KEY, message)
+        client.publish(CONTROL_CHANNEL, message)
+    except redis.RedisError as e:
+        print(f"{datetime.datetime.now()} -! # Failed to share the timeout and track timer: {e}")
+
+
+def apply_control(state):
+    """Takes on the timeout and track timer from another worker (or an HTTP request to this one)."""
+    global timeout, track_timer, on_track
+    if "timeout" in state and state["timeout"] != timeout:
+        timeout = state["timeout"]
+        # The subscriber empties the cache on every change of timeout state
+        dashboard_state.clear()
+        emit_local("snapshot", dashboard_state.snapshot(), to=DELTA_ROOM)
+    if "on_track" in state:
+        on_track = state["on_track"]
+        if state["track_timer"] is None:
+            track_timer = None
+        else:
+            track_timer = track_timer or TrackTimer()
+            track_timer.load_state(state["track_timer"])
+
+
 """ SOCKET HANDLING """
 
 
 @socketio.on("send_history")
 def handle_history(data):
-    historical_data = query_data(data, cursor, conn)
-    socketio.emit("recieve_historic_data", historical_data, to=request.sid)
-
-
-@socketio.on("update_clients")
-def handle_update_clients():
-    if not timeout:
-        latest_data = query_all_latest_data()
-        socketio.emit("data", latest_data)
+    emit_local("recieve_historic_data", history_response(data), to=request.sid)
+
+
+@socketio.on("send_history_window")
+def handle_history_window(data):
+    emit_local("recieve_historic_window", window_response(data), to=request.sid)
+
+
+@socketio.on("send_laps")
+def handle_laps(session_id=None):
+    """Answers on 'recieve_laps' with the laps of a stint, see mqtt_subscriber.query_laps."""
+    emit_local("recieve_laps", query_laps(session_id, history), to=request.sid)
+
+
+@socketio.on("send_history_batch")
+def handle_history_batch(batch):
+    """_summary_
+    Answers the history requests of a whole page at once, on one
+    'recieve_history_batch' event. Requests not in the cache are queried in
+    parallel, each on its own pooled connection.
+        Args:
+            batch (list): Signal or group names, answered like 'send_history' and
+                keyed by the name, and window requests (see 'send_history_window'),
+                keyed by their 'id', or their 'name' if they have none. A
+                request keyed the same as an earlier, different one is dropped.
+    """
+    if not isinstance(batch, list):
+        print(f"{datetime.datetime.now()} -! #  ERROR: History batch must be a list, got '{batch}'")
+        return
+    requests, keys, futures = {}, [], []
+    for data in batch:
+        key = str(data.get("id", data.get("name"))) if isinstance(data, dict) else str(data)
+        if key in requests:
+            # Both would be answered under the one key
+            if requests[key] != data:
+                print(f"{datetime.datetime.now()} -! #  ERROR: History batch has two requests for '{key}', give each an 'id'")
+            continue
+        requests[key] = data
+        keys.append(key)
+        if isinstance(data, dict):
+            futures.append(batch_executor.submit(window_response, data))
+        else:
+            futures.append(batch_executor.submit(history_response, data))
+    emit_local("recieve_history_batch", {key: future.result() for key, future in zip(keys, futures)}, to=request.sid)
+
+
+def history_response(data):
+    if isinstance(data, str):
+        return cached_history(("history", data), history_names(data), None, query_data, data)
+    return query_data(data, history)
+
+
+def window_response(data):
+    try:
+        requested = data.get("names", data.get("name"))
+        names = []
+        for name in requested if isinstance(requested, list) else [requested]:
+            names += history_names(name)
+        key = ("window", json.dumps({k: v for k, v in data.items() if k != "id"}, sort_keys=True))
+    except (AttributeError, TypeError):
+        # Not a valid request, query_window reports why
+        return query_window(data, history)
+    return cached_history(key, names, data.get("end"), query_window, data)
+
+
+def cached_history(key, names, end, query, data):
+    """_summary_
+    Answers a history request from the cache, or queries it and caches the
+    response. Failed queries (None) aren't cached.
+    """
+    response = history_cache.get(key)
+    if response is MISSING:
+        queried_at = time.monotonic()
+        response = query(data, history)
+        if response is not None:
+            history_cache.put(key, response, names, end, queried_at)
+    return response
 
 
 @socketio.on("timer")
 def handle_timer():
     global track_timer
+    # Every data page asks on every update, so only the one asking is answered
     if track_timer:
-        socketio.emit("timerRecieve", track_timer.update_timer())
+        emit_local("timerRecieve", track_timer.update_timer(), to=request.sid)
 
 
 @socketio.on("connect")
 def handle_connect():
     print(f"{datetime.datetime.now()} - # User connected")
     client_list.append(request.sid)
+    # Clients connecting with ?deltas=1 skip the full list entirely
+    if request.args.get("deltas"):
+        subscribe_deltas()
+        if active_alarms:
+            emit_local("alarms", list(active_alarms.values()), to=request.sid)
+        return
+    if request.args.get("encoding") in ENCODINGS:
+        client_encodings[request.sid] = request.args["encoding"]
+        if client_encodings[request.sid] == "packed":
+            emit_local("signal_table", dashboard_state.signal_table(), to=request.sid)
+
+    # New clients get the current values straight away rather than on the next change
+    if active_alarms:
+        emit_local("alarms", list(active_alarms.values()), to=request.sid)
+    join_room(encoded_room(LEGACY_ROOM))
+    latest_data = dashboard_state.latest()
+    if latest_data and not timeout:
+        emit_local("data", encode_for_client(latest_data), to=request.sid)
+
+
+@socketio.on("set_encoding")
+def handle_set_encoding(encoding):
+    """_summary_
+    Switches how the client is sent values on 'data' and 'group_data'.
+        Args:
+            encoding (str): 'json', 'msgpack' or 'packed' (see DashboardState.encode).
+                Packed clients are sent the signal id table on 'signal_table'
+                now and whenever new signals appear.
+    """
+    if encoding not in ENCODINGS:
+        print(f"{datetime.datetime.now()} -! #  ERROR: Unknown encoding '{encoding}'")
+        return
+    current = [room for room in rooms() if room in value_rooms()]
+    for room in current:
+        leave_room(room)
+    client_encodings[request.sid] = encoding
+    for room in current:
+        join_room(encoded_room(base_room(room)))
+    if encoding == "packed":
+        emit_local("signal_table", dashboard_state.signal_table(), to=request.sid)
+
+
+@socketio.on("subscribe_deltas")
+def subscribe_deltas():
+    """_summary_
+    Moves the client to delta updates. The client is sent a snapshot on
+    'snapshot' and from then on only changed values on 'delta'.
+    """
+    # Joined before the snapshot is taken so no delta after it is missed
+    leave_room(encoded_room(LEGACY_ROOM))
+    join_room(DELTA_ROOM)
+    emit_local("snapshot", dashboard_state.snapshot(), to=request.sid)
+
+
+@socketio.on("subscribe")
+def handle_subscribe(groups):
+    """_summary_
+    Subscribes the client to signal groups (see SIGNAL_GROUPS), from then on it
+    only receives the values of those groups, one 'group_data' event per group.
+        Args:
+            groups (list): Group names, or a single group name.
+    """
+    groups = group_names(groups)
+    if groups is None:
+        return
+    unknown = [group for group in groups if group not in SIGNAL_GROUPS]
+    if unknown:
+        print(f"{datetime.datetime.now()} -! #  ERROR: Unknown signal groups {unknown}")
+        return
+    leave_room(encoded_room(LEGACY_ROOM))
+    for group in groups:
+        join_room(encoded_room(group_room(group)))
+        emit_local(
+            "group_data", {"group": group, "data": encode_for_client(dashboard_state.latest(group))}, to=request.sid
+        )
+
+
+@socketio.on("unsubscribe")
+def handle_unsubscribe(groups):
+    groups = group_names(groups)
+    if groups is None:
+        return
+    for group in groups:
+        leave_room(encoded_room(group_room(group)))
+
+
+def group_names(groups):
+    """Returns the requested groups as a list, None if they aren't a name or list of names."""
+    if isinstance(groups, str):
+        return [groups]
+    if isinstance(groups, list) and all(isinstance(group, str) for group in groups):
+        return groups
+    print(f"{datetime.datetime.now()} -! #  ERROR: Signal groups must be a name or list of names, got '{groups}'")
+    return None
+
+
+def group_room(group):
+    return f"group:{group}"
+
+
+def encoded_room(room, encoding=None):
+    """Returns the copy of a room for the encoding, by default the current client's."""
+    encoding = encoding or client_encodings.get(request.sid, "json")
+    return room if encoding == "json" else f"{room}:{encoding}"
+
+
+def base_room(room):
+    for encoding in ENCODINGS:
+        if room.endswith(f":{encoding}"):
+            return room[: -len(encoding) - 1]
+    return room
+
+
+def value_rooms():
+    base_rooms = [LEGACY_ROOM] + [group_room(group) for group in SIGNAL_GROUPS]
+    return {encoded_room(room, encoding) for room in base_rooms for encoding in ENCODINGS}
+
+
+def encode_for_client(records):
+    return dashboard_state.encode(records, client_encodings.get(request.sid, "json"))
+
+
+@socketio.on("resync")
+def handle_resync():
+    """Sent by a delta client which received a delta whose base isn't its version."""
+    emit_local("snapshot", dashboard_state.snapshot(), to=request.sid)
 
 
 @socketio.on("disconnect")
 def handle_disconnect():
     print(f"{datetime.datetime.now()} - # User disconnected")
+    client_encodings.pop(request.sid, None)
+
+
+""" CHANGE FEED """
+
+
+def broadcast_changes():
+    """_summary_
+    Listens on the change feed and pushes the latest values to every client.
+    Changes arriving within 1 / MAX_BROADCAST_RATE seconds of the last push are
+    coalesced into the next one, and nothing is sent while no data arrives.
+    Changes to the timeout and track timer made by other workers arrive on
+    CONTROL_CHANNEL, alarms on ALARM_CHANNEL are pushed out as they arrive.
+    Load test probes on PROBE_CHANNEL are pushed on 'probe' as they arrive,
+    without touching the dashboard state or history or causing a push of values.
+    """
+    min_interval = 1 / MAX_BROADCAST_RATE
+    while True:
+        try:
+            pubsub = redis.Redis(host="localhost", port=6379, db=0).pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(CHANGE_CHANNEL, CONTROL_CHANNEL, ALARM_CHANNEL, PROBE_CHANNEL)
+            history.reset()
+            history_cache.clear()
+            stored = redis.Redis(host="localhost", port=6379, db=STATE_DB).get(CONTROL_STATE_KEY)
+            if stored is not None:
+                apply_control(json.loads(stored))
+            stored = redis.Redis(host="localhost", port=6379, db=ALARM_DB).hgetall(ACTIVE_ALARMS_KEY)
+            active_alarms.clear()
+            active_alarms.update((key.decode(), json.loads(alarm)) for key, alarm in stored.items())
+            # Subscribed first so nothing published while loading is missed
+            dashboard_state.update(query_all_latest_data())
+            print(f"{datetime.datetime.now()} - # Listening for data changes")
+
+            changed = False
+            last_push = 0
+            while True:
+                wait = max(last_push + min_interval - time.monotonic(), 0) if changed else 1.0
+                message = pubsub.get_message(timeout=wait)
+                if message is not None and message["channel"] == CONTROL_CHANNEL.encode():
+                    control = json.loads(message["data"])
+                    if control["worker"] != WORKER_ID:
+                        apply_control(control)
+                elif message is not None and message["channel"] == ALARM_CHANNEL.encode():
+                    push_alarms(json.loads(message["data"]))
+                elif message is not None and message["channel"] == PROBE_CHANNEL.encode():
+                    if not timeout:
+                        emit_local("probe", [json.loads(message["data"])])
+                elif message is not None:
+                    records = json.loads(message["data"])
+                    dashboard_state.update(records)
+                    history.update(records)
+                    history_cache.invalidate(records)
+                    changed = True
+
+                if changed and time.monotonic() - last_push >= min_interval:
+                    changed = False
+                    last_push = time.monotonic()
+                    if not timeout:
+                        push_updates()
+        except redis.RedisError as e:
+            print(f"{datetime.datetime.now()} -! # Lost the change feed, reconnecting: {e}")
+            time.sleep(1)
+
+
+def push_alarms(alarms):
+    for alarm in alarms:
+        if alarm["state"] == "raised":
+            active_alarms[alarm["id"]] = alarm
+        else:
+            active_alarms.pop(alarm["id"], None)
+    # Sent to slow clients too, they are few and matter more than the values
+    emit_local("alarm", alarms)
+
+
+def push_updates():
+    # Each emit to a room is serialised once for all its clients, and nothing
+    # is built for a room without any
+    delta = dashboard_state.take_delta()
+    if delta is not None and has_clients(DELTA_ROOM):
+        # A skipped delta client asks for a snapshot when it sees the next one
+        emit_local("delta", delta, to=DELTA_ROOM, skip_sid=slow_clients(DELTA_ROOM))
+    if delta is not None and delta["signals"]:
+        for room in value_rooms():
+            if room.endswith(":packed") and has_clients(room):
+                emit_local("signal_table", dashboard_state.signal_table(), to=room)
+
+    emit_values("data", LEGACY_ROOM)
+    for group in dashboard_state.take_changed_groups():
+        emit_values("group_data", group_room(group), group)
+
+
+def emit_values(event, room, group=None):
+    """Emits the values of a group (or all of them) to every encoding's copy of the room."""
+    records = None
+    for encoding in ENCODINGS:
+        target = encoded_room(room, encoding)
+        if not has_clients(target):
+            continue
+        if records is None:
+            records = dashboard_state.latest(group)
+        data = dashboard_state.encode(records, encoding)
+        emit_local(
+            event, data if group is None else {"group": group, "data": data}, to=target, skip_sid=slow_clients(target)
+        )
+
+
+def has_clients(room):
+    return bool(socketio.server.manager.rooms.get("/", {}).get(room))
+
+
+def slow_clients(room):
+    """_summary_
+    Returns the clients of a room which haven't been able to keep up, their
+    packets are queued in this process until sent so a slow connection would
+    otherwise hold ever more of them. They miss live updates until the queue
+    drains, every update carries the latest values so nothing is lost for good.
+    """
+    slow = []
+    for sid, eio_sid in socketio.server.manager.get_participants("/", room):
+        socket = socketio.server.eio.sockets.get(eio_sid)
+        if socket is not None and socket.queue.qsize() > MAX_CLIENT_BACKLOG:
+            slow.append(sid)
+    return slow
+
+
+def emit_local(event, data, to=None, skip_sid=None):
+    """_summary_
+    Emits to the clients of this worker. Every worker has its own change feed
+    listener and clients only ever talk to the worker they connected to, so
+    nothing needs to go through the message queue.
+    """
+    socketio.emit(event, data, to=to, skip_sid=skip_sid or None, ignore_queue=True)
 
 
 def start_webserver():
-    global cursor, conn
-    cursor, conn = connect_to_db()
-    print(f"{datetime.datetime.now()} - # Webserver starting")
-    socketio.run(app, port=5001, allow_unsafe_werkzeug=True)
+    global history
+    history = HotHistory(open_storage(), HOT_HISTORY_POINTS)
+    socketio.start_background_task(broadcast_changes)
+    print(f"{datetime.datetime.now()} - # Webserver starting in {ASYNC_MODE} mode on port {WEBSOCKET_PORT}")
+    # The werkzeug server is only used in threading mode
+    socketio.run(app, port=WEBSOCKET_PORT, allow_unsafe_werkzeug=True)
 
 
 def main():
@@ -111,7 +111,7 @@ def publish(client, can0):
             or "ID:      012" in msg
             or "ID:      011" in msg
         ):
-            result = client.publish(topic, str(msg))
+            result = client.publish(topic, str(msg), qos=1)
         # status = result[0]
 
 
@@ -64,7 +64,7 @@ def publish(client):
         with open("data/simulation_data.txt", "r") as file:
             msg = ""
             for line in file:
-                result = client.publish(topic, line.strip())
+                result = client.publish(topic, line.strip(), qos=1)
                 status = result[0]
                 if status != 0:
                     print(f"Failed to send message to topic {topic}")